@@ -7,7 +7,7 @@ setup(
     author='Chuck Muckamuck',
     author_email='Chuck.Muckamuck@gmail.com',
     install_requires=[
-        "boto3>=1.4.3",
+        "boto3>=1.34",
         "requests>=2.18",
         "Click>=6.7",
         "PyYAML>=3.12",
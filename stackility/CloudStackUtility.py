@@ -6,7 +6,7 @@ The main class for the Stackility adventure.
 # pylint: disable=invalid-name
 # pylint: disable=logging-format-interpolation
 
-import boto3
+import copy
 from botocore.exceptions import ClientError
 from cloudformation_validator.ValidateUtility import ValidateUtility
 from bson import json_util
@@ -21,8 +21,25 @@ import json
 import yaml
 import traceback
 import uuid
+import re
+import hashlib
 import requests
 
+from stackility.notifier import StackNotifier
+from stackility.packager import ArtifactPackager
+from stackility.stackset import StackSetDeploy
+from stackility.template_diff import diff_parameters
+from stackility.template_diff import diff_resources
+from stackility.template_diff import load_template
+from stackility.template_diff import print_diff
+from stackility.utility.aws_session import get_client
+from stackility.utility.aws_session import get_session
+from stackility.utility.stage_timer import StageTimer
+from stackility.utility.template_scan import scan_template
+from stackility.utility.journal import RunJournal
+from stackility.utility.journal import file_hash
+from stackility.utility.parameter_check import as_text
+from stackility.utility.parameter_check import check_parameters
 
 try:
     from yaml import CLoader as Loader
@@ -37,6 +54,9 @@ def default_ctor(loader, tag_suffix, node):
     return tag_suffix + ' ' + str(node.value)
 
 
+yaml.add_multi_constructor('', default_ctor, Loader=Loader)
+
+
 try:
     POLL_INTERVAL = int(os.environ.get('CSU_POLL_INTERVAL', 30))
 except:
@@ -55,6 +75,18 @@ complete_states = [
     'UPDATE_ROLLBACK_COMPLETE'
 ]
 
+completed_states = [
+    'CREATE_COMPLETE',
+    'UPDATE_COMPLETE',
+    'DELETE_COMPLETE'
+]
+
+# StatusReason of a FAILED change set that only means there is nothing to do
+no_change_reasons = [
+    "The submitted information didn't contain changes",
+    'No updates are to be performed'
+]
+
 
 class CloudStackUtility:
     """
@@ -62,21 +94,11 @@ class CloudStackUtility:
     """
     ASK = '[ask]'
     SSM = '[ssm:'
-    _verbose = False
-    _template = None
-    _b3Sess = None
-    _cloudFormation = None
-    _config = None
-    _parameters = {}
-    _stackParameters = []
-    _s3 = None
-    _ssm = None
-    _tags = []
-    _templateUrl = None
-    _updateStack = False
-    _yaml = False
-
-    def __init__(self, config_block):
+    SSM_PATH = '[ssm-path:'
+    SECRET = '[secret:'
+    SECRET_BATCH = 20
+
+    def __init__(self, config_block, template_cache=None, stage_timer=None):
         """
         Cloud stack utility init method.
 
@@ -84,6 +106,10 @@ class CloudStackUtility:
             config_block - a dictionary creates from the CLI driver. See that
                            script for the things that are required and
                            optional.
+            template_cache - optional TemplateCache shared by the targets of a
+                             matrix run
+            stage_timer - optional StageTimer that records how long each
+                          stage of the run takes
 
         Returns:
            not a damn thing
@@ -91,12 +117,65 @@ class CloudStackUtility:
         Raises:
             SystemError - if everything isn't just right
         """
+        self._verbose = False
+        self._template = None
+        self._template_parameters = None
+        self._b3Sess = None
+        self._cloudFormation = None
+        self._parameters = {}
+        self._stackParameters = []
+        self._s3 = None
+        self._ssm = None
+        self._secrets = None
+        self._secret_references = {}
+        self._tags = []
+        self._templateUrl = None
+        self._updateStack = False
+        self._yaml = False
+        self._change_set_id = None
+        self._nothing_to_do = False
+        self._notifier = None
+        self._notification_arns = None
+        self._stack_notification_arns = []
+        self._client_request_token = None
+        self._operation_started = None
+        self._stack_set = None
+        self._journal = None
+        self._lock = None
+        self._template_cache = template_cache
+        self._stage_timer = stage_timer or StageTimer()
         if config_block:
-            self._config = config_block
+            self._original_config = copy.deepcopy(config_block)
+            self._config = copy.deepcopy(config_block)
         else:
             logger.error('config block was garbage')
             raise SystemError
 
+    def _reset(self):
+        """
+        Forget everything from a previous run so an instance can be reused.
+        The boto3 clients are kept.
+        """
+        self._config = copy.deepcopy(self._original_config)
+        self._template = None
+        self._template_parameters = None
+        self._parameters = {}
+        self._stackParameters = []
+        self._secret_references = {}
+        self._tags = []
+        self._templateUrl = None
+        self._updateStack = False
+        self._yaml = False
+        self._change_set_id = None
+        self._nothing_to_do = False
+        self._notifier = None
+        self._notification_arns = None
+        self._stack_notification_arns = []
+        self._client_request_token = None
+        self._operation_started = None
+        self._stack_set = None
+        self._journal = None
+
     def upsert(self):
         """
         The main event of the utility. Create or update a Cloud Formation
@@ -106,90 +185,354 @@ class CloudStackUtility:
             None
 
         Returns:
-            True if the stack create/update is started successfully else
-            False if the start goes off in the weeds.
-
-        Exits:
-            If the user asked for a dryrun exit(with a code 0) the thing here. There is no
-            point continuing after that point.
-
+            True if the stack create/update is started successfully, or the
+            dryrun change set was reported, else False if the start goes off
+            in the weeds.
         """
-
-        required_parameters = []
-        self._stackParameters = []
+        self._reset()
+        self._journal = self._open_journal()
 
         try:
             self._initialize_upsert()
         except Exception:
+            self._clear_journal()
             return False
 
+        polling_follows = False
         try:
-            available_parameters = self._parameters.keys()
+            parameters = self._stackParameters
 
-            for parameter_name in self._template.get('Parameters', {}):
-                required_parameters.append(str(parameter_name))
+            with self._stage_timer.stage('analysis'):
+                analyzed = self._analyze_stuff()
 
-            logger.info(' required parameters: ' + str(required_parameters))
-            logger.info('available parameters: ' + str(available_parameters))
+            if not analyzed:
+                raise SystemError('template analysis failed')
 
-            parameters = []
-            for required_parameter in required_parameters:
-                parameter = {}
-                parameter['ParameterKey'] = str(required_parameter)
+            if self._lock_lost():
+                raise SystemError('not starting the stack work without the deploy lock')
 
-                required_parameter = str(required_parameter)
-                if required_parameter in self._parameters:
-                    parameter['ParameterValue'] = self._parameters[required_parameter]
-                else:
-                    parameter['ParameterValue'] = self._parameters[required_parameter.lower()]
-
-                parameters.append(parameter)
-
-            if not self._analyze_stuff():
-                sys.exit(1)
+            if self._config.get('stackset'):
+                return self._start_stack_set(parameters)
 
             if self._config.get('dryrun', False):
                 logger.info('Generating change set')
-                set_id = self._generate_change_set(parameters)
-                if set_id:
-                    self._describe_change_set(set_id)
+                with self._stage_timer.stage('change set'):
+                    set_id = self._generate_change_set(parameters)
+                    if set_id:
+                        self._describe_change_set(set_id)
 
                 logger.info('This was a dryrun')
-                sys.exit(0)
+                return True
 
-            self._tags.append({"Key": "CODE_VERSION_SD", "Value": self._config.get('codeVersion')})
-            self._tags.append({"Key": "ANSWER", "Value": str(42)})
-            if self._updateStack:
-                stack = self._cloudFormation.update_stack(
-                    StackName=self._config.get('environment', {}).get('stack_name', None),
-                    TemplateURL=self._templateUrl,
-                    Parameters=parameters,
-                    Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
-                    Tags=self._tags,
-                    ClientRequestToken=str(uuid.uuid4())
-                )
-                logger.info('existing stack ID: {}'.format(stack.get('StackId', 'unknown')))
+            notify = not self._config.get('plan', False) and not self._config.get('no_poll', False)
+            if self._config.get('plan', False) or self._config.get('via_changeset', False):
+                if notify:
+                    self._notification_arns = self._start_notifier()
+
+                with self._stage_timer.stage('change set'):
+                    set_id = self._generate_change_set(parameters)
+                    response = self._describe_change_set(set_id, cleanup=False) if set_id else None
+
+                if not response:
+                    raise SystemError('change set creation failed')
+
+                if self._config.get('plan', False):
+                    if response.get('Status') == 'FAILED':
+                        reason = response.get('StatusReason', '')
+                        self._cloudFormation.delete_change_set(ChangeSetName=set_id)
+                        if not any(r in reason for r in no_change_reasons):
+                            raise SystemError('change set failed: {}'.format(reason or 'unknown'))
+
+                        self._nothing_to_do = True
+                        print('Nothing would change, there is no plan to apply')
+                        return True
+
+                    self._change_set_id = set_id
+                    print('Apply this plan with: stackility apply {}'.format(set_id))
+                    return True
+
+                with self._stage_timer.stage('execute change set'):
+                    executed = self._execute_change_set(set_id, response)
+
+                if executed is None:
+                    raise SystemError('change set was not executed')
+
+                self._nothing_to_do = not executed
+                polling_follows = executed and not self._config.get('no_poll', False)
+                return True
+
+            with self._stage_timer.stage('create/update'):
+                started = self._journal.get('started') if self._journal else None
+                reattach = bool(started) and self._operation_in_progress(started['token'])
+                if started and not reattach:
+                    logger.info('the operation of the previous run is no longer in progress, starting a new one')
+                    self._journal.clear()
+                    if not self._set_update():
+                        raise SystemError('there was a problem determining update or create')
+
+                # after the last _set_update(), it is what reads the stack's NotificationARNs
+                if notify:
+                    self._notification_arns = self._start_notifier()
+
+                token = self._start_operation()
+                if reattach:
+                    logger.info('reattaching to the operation started by the previous run')
+                elif self._updateStack:
+                    stack = self._cloudFormation.update_stack(
+                        StackName=self._config.get('environment', {}).get('stack_name', None),
+                        TemplateURL=self._templateUrl,
+                        Parameters=parameters,
+                        Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
+                        Tags=self._stack_tags(),
+                        ClientRequestToken=token,
+                        **self._notification_args()
+                    )
+                    logger.info('existing stack ID: {}'.format(stack.get('StackId', 'unknown')))
+                else:
+                    stack = self._cloudFormation.create_stack(
+                        StackName=self._config.get('environment', {}).get('stack_name', None),
+                        TemplateURL=self._templateUrl,
+                        Parameters=parameters,
+                        Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
+                        Tags=self._stack_tags(),
+                        ClientRequestToken=token,
+                        **self._notification_args()
+                    )
+                    logger.info('new stack ID: {}'.format(stack.get('StackId', 'unknown')))
+
+            if self._config.get('no_poll', False):
+                self._clear_journal()
             else:
-                stack = self._cloudFormation.create_stack(
-                    StackName=self._config.get('environment', {}).get('stack_name', None),
-                    TemplateURL=self._templateUrl,
-                    Parameters=parameters,
-                    Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
-                    Tags=self._tags,
-                    ClientRequestToken=str(uuid.uuid4())
-                )
-                logger.info('new stack ID: {}'.format(stack.get('StackId', 'unknown')))
+                polling_follows = True
         except Exception as x:
             if self._verbose:
                 logger.error(x, exc_info=True)
             else:
                 logger.error(x, exc_info=False)
 
+            self._clear_journal()
             return False
+        finally:
+            if not polling_follows:
+                self.release_notifier()
 
         return True
 
-    def _describe_change_set(self, set_id):
+    def _open_journal(self):
+        """
+        The checkpoint journal of this stack if journal_dir (or
+        STACKILITY_JOURNAL_DIR) is set. Runs that do not start a plain
+        create/update are not journaled.
+
+        The fingerprint is the INI data and the template content. A code
+        version made up from the clock (no --version) is left out of it, a
+        resumed run takes the version of the run it picks up from instead.
+
+        Only the stages that talk to AWS and leave something behind are
+        journaled (the upload, create vs update, the create/update itself).
+        Rendering, parsing and checking the template and filling parameters
+        run again on a resume, they rebuild what the run needs in memory and
+        parameter values (secrets) are never written to disk.
+
+        Returns:
+            a RunJournal or None
+        """
+        environment = self._config.get('environment', {})
+        directory = environment.get('journal_dir') or os.environ.get('STACKILITY_JOURNAL_DIR')
+        if not directory:
+            return None
+
+        for option in ['dryrun', 'plan', 'via_changeset', 'stackset']:
+            if self._config.get(option):
+                return None
+
+        try:
+            template_hash = file_hash(self._original_config['environment']['template'])
+        except Exception:
+            return None
+
+        generated = self._original_config.get('codeVersionGenerated', False)
+        inputs = dict(self._original_config)
+        if generated:
+            inputs.pop('codeVersion', None)
+            inputs.pop('codeVersionGenerated', None)
+
+        inputs['template_hash'] = template_hash
+        fingerprint = json.dumps(inputs, sort_keys=True, default=str)
+        journal = RunJournal(
+            os.path.join(directory, 'journal-{}-{}.json'.format(environment.get('region'), environment.get('stack_name'))),
+            hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+        )
+
+        recorded = journal.get('version')
+        if recorded and generated:
+            self._config['codeVersion'] = recorded['code_version']
+            logger.info('code version (from journal): {}'.format(recorded['code_version']))
+        elif not recorded:
+            journal.record('version', code_version=self._config.get('codeVersion'))
+
+        return journal
+
+    def _clear_journal(self):
+        if self._journal:
+            self._journal.clear()
+            self._journal = None
+
+    def _operation_in_progress(self, token):
+        """
+        Is the create/update with this token still running? Only then is
+        there something to reattach to, a finished one is history.
+        """
+        stack_name = self._config.get('environment', {}).get('stack_name', None)
+        try:
+            stack = self._cloudFormation.describe_stacks(StackName=stack_name)['Stacks'][0]
+            if not stack.get('StackStatus', '').endswith('_IN_PROGRESS'):
+                return False
+
+            response = self._cloudFormation.describe_stack_events(StackName=stack_name)
+            events = response.get('StackEvents', [])
+            return bool(events) and events[0].get('ClientRequestToken') == token
+        except Exception:
+            return False
+
+    def diff(self):
+        """
+        Compare the deployed template and parameters of the stack with the
+        local ones and print what an upsert would add, remove and modify.
+        Nothing is uploaded and no change set is made.
+
+        Args:
+            None
+
+        Returns:
+            True if the comparison was made else False
+        """
+        self._reset()
+        try:
+            self._initialize_diff()
+        except Exception:
+            return False
+
+        stack_name = self._config.get('environment', {}).get('stack_name', None)
+        try:
+            with self._stage_timer.stage('fetch deployed'):
+                try:
+                    stack = self._cloudFormation.describe_stacks(StackName=stack_name)['Stacks'][0]
+                    body = self._cloudFormation.get_template(
+                        StackName=stack_name,
+                        TemplateStage='Original'
+                    )['TemplateBody']
+                    deployed = load_template(body)
+                except ClientError as wtf:
+                    if str(wtf).find('does not exist') == -1:
+                        raise
+
+                    logger.info('stack {} not found, everything is new'.format(stack_name))
+                    stack = {}
+                    deployed = {}
+
+            with self._stage_timer.stage('compare'):
+                with open(self._config['environment']['template']) as f:
+                    local = load_template(f.read())
+
+                hidden = set(self._secret_references)
+                hidden.update(k for k, v in (local.get('Parameters') or {}).items() if str(v.get('NoEcho')).lower() == 'true')
+                print_diff(
+                    stack_name,
+                    diff_resources(deployed, local),
+                    diff_parameters(stack.get('Parameters', []), self._stackParameters, hidden)
+                )
+
+            return True
+        except Exception as ruh_roh_shaggy:
+            logger.error('Exception caught in diff(): {}'.format(ruh_roh_shaggy), exc_info=self._verbose)
+            return False
+
+    def create_change_set(self):
+        """
+        Prepare the upsert as usual and create a change set for it but do
+        not wait for the change set, see plan-many. The caller describes and
+        deletes the change set.
+
+        Args:
+            None
+
+        Returns:
+            the change set ID or None if things went sideways
+        """
+        self._reset()
+        try:
+            self._initialize_upsert()
+        except Exception:
+            return None
+
+        try:
+            with self._stage_timer.stage('analysis'):
+                analyzed = self._analyze_stuff()
+
+            if not analyzed:
+                raise SystemError('template analysis failed')
+
+            if self._config.get('stackset'):
+                raise SystemError('change sets are not supported with [stackset]')
+
+            with self._stage_timer.stage('change set'):
+                self._change_set_id = self._generate_change_set(self._stackParameters)
+
+            return self._change_set_id
+        except Exception as ruh_roh_shaggy:
+            logger.error(ruh_roh_shaggy, exc_info=self._verbose)
+
+        return None
+
+    def hold_lock(self, lock):
+        """
+        Remember the deploy lock held for this stack (a LockState) so the
+        run stops if the lock is lost.
+        """
+        self._lock = lock
+
+    def _lock_lost(self):
+        if self._lock is not None and self._lock.lost:
+            logger.error('the deploy lock was lost, another runner may be deploying this stack')
+            return True
+
+        return False
+
+    def _start_stack_set(self, parameters):
+        """
+        Deploy to the accounts and regions of the [stackset] section instead
+        of a single stack, the template was uploaded and parsed once for all
+        of them.
+
+        Returns:
+            True if the stack set operations were started else False
+        """
+        if self._config.get('dryrun', False) or self._config.get('plan', False) or self._config.get('via_changeset', False):
+            logger.error('change sets are not supported with [stackset]')
+            return False
+
+        with self._stage_timer.stage('stack set'):
+            self._stack_set = StackSetDeploy(
+                self._cloudFormation,
+                self._config.get('environment', {}).get('stack_name', None),
+                self._config['stackset']
+            )
+            self._operation_started = time.time()
+            return self._stack_set.start(self._templateUrl, parameters, self._stack_tags())
+
+    def _describe_change_set(self, set_id, cleanup=True):
+        """
+        Wait for the change set to be computed and print it.
+
+        Args:
+            set_id - the change set ID
+            cleanup - delete the change set after printing it
+
+        Returns:
+            the final describe_change_set() response or None if things
+            went sideways
+        """
         complete_states = ['CREATE_COMPLETE', 'FAILED', 'UNKNOWN']
         try:
             logger.info('polling change set, POLL_INTERVAL={}'.format(POLL_INTERVAL))
@@ -202,6 +545,9 @@ class CloudStackUtility:
                 status = response.get('Status', 'UNKNOWN')
 
             logger.info('current set status: {}'.format(status))
+            if status == 'FAILED':
+                logger.info('change set reason: {}'.format(response.get('StatusReason', 'unknown')))
+
             print('\n')
             print('Change set report:')
             for change in response.get('Changes', []):
@@ -214,21 +560,89 @@ class CloudStackUtility:
                 )
                 print('\n')
 
-            logger.info('cleaning up change set')
-            self._cloudFormation.delete_change_set(ChangeSetName=set_id)
-            return True
+            if cleanup:
+                logger.info('cleaning up change set')
+                self._cloudFormation.delete_change_set(ChangeSetName=set_id)
+
+            return response
         except Exception as ruh_roh_shaggy:
             if self._verbose:
                 logger.error(ruh_roh_shaggy, exc_info=True)
             else:
                 logger.error(ruh_roh_shaggy, exc_info=False)
 
-        return False
+        return None
+
+    def _execute_change_set(self, set_id, response):
+        """
+        Execute a computed change set, asking for approval first if the
+        config says so.
+
+        Args:
+            set_id - the change set ID
+            response - the describe_change_set() response of the set
+
+        Returns:
+            True if the stack work was started, False if there was nothing
+            to do and None if the change set was not approved or not usable
+        """
+        if response.get('Status') == 'FAILED':
+            reason = response.get('StatusReason', '')
+            if any(r in reason for r in no_change_reasons):
+                logger.info('change set has no changes, nothing to do')
+                self._cloudFormation.delete_change_set(ChangeSetName=set_id)
+                return False
+
+            logger.error('change set failed: {}'.format(reason or 'unknown'))
+            return None
+
+        if response.get('ExecutionStatus') != 'AVAILABLE':
+            logger.error('change set can not be executed: {}'.format(response.get('ExecutionStatus')))
+            return None
+
+        if self._config.get('wait_for_approval', False):
+            answer = input('Execute change set {} on {}? [y/N]: '.format(set_id, response.get('StackName')))
+            if answer.strip().lower() not in ['y', 'yes']:
+                logger.info('change set was not approved, cleaning up')
+                self._cloudFormation.delete_change_set(ChangeSetName=set_id)
+                return None
+
+        self._config.setdefault('environment', {})['stack_name'] = response.get('StackName')
+        if self._lock_lost():
+            return None
+
+        self._cloudFormation.execute_change_set(
+            ChangeSetName=set_id,
+            ClientRequestToken=self._start_operation()
+        )
+        logger.info('executing change set {}'.format(set_id))
+        return True
+
+    def apply(self, set_id):
+        """
+        Execute a change set created by a plan run. Afterward poll_stack()
+        can be used to wait for the stack.
+
+        Args:
+            set_id - the change set ARN
+
+        Returns:
+            True if the stack work was started or there was nothing to do
+            else False
+        """
+        self._initialize_list()
+        try:
+            response = self._describe_change_set(set_id, cleanup=False)
+            if not response:
+                return False
+
+            return self._execute_change_set(set_id, response) is not None
+        except Exception as wtf:
+            logger.error('Exception caught in apply(): {}'.format(wtf))
+            return False
 
     def _generate_change_set(self, parameters):
         try:
-            self._tags.append({"Key": "CODE_VERSION_SD", "Value": self._config.get('codeVersion')})
-            self._tags.append({"Key": "ANSWER", "Value": str(42)})
             set_name = 'chg{}'.format(int(time.time()))
             if self._updateStack:
                 changes = self._cloudFormation.create_change_set(
@@ -236,9 +650,10 @@ class CloudStackUtility:
                     TemplateURL=self._templateUrl,
                     Parameters=parameters,
                     Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
-                    Tags=self._tags,
+                    Tags=self._stack_tags(),
                     ChangeSetName=set_name,
-                    ChangeSetType='UPDATE'
+                    ChangeSetType='UPDATE',
+                    **self._notification_args()
                 )
             else:
                 changes = self._cloudFormation.create_change_set(
@@ -246,9 +661,10 @@ class CloudStackUtility:
                     TemplateURL=self._templateUrl,
                     Parameters=parameters,
                     Capabilities=['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND'],
-                    Tags=self._tags,
+                    Tags=self._stack_tags(),
                     ChangeSetName=set_name,
-                    ChangeSetType='CREATE'
+                    ChangeSetType='CREATE',
+                    **self._notification_args()
                 )
             if self._verbose:
                 logger.info('Change set: {}'.format(
@@ -264,6 +680,21 @@ class CloudStackUtility:
 
         return None
 
+    def _notification_args(self):
+        if self._notification_arns:
+            return {'NotificationARNs': self._notification_arns}
+
+        return {}
+
+    def _stack_tags(self):
+        """
+        The tags from the INI file plus the ones stackility always adds.
+        """
+        return self._tags + [
+            {"Key": "CODE_VERSION_SD", "Value": self._config.get('codeVersion')},
+            {"Key": "ANSWER", "Value": str(42)}
+        ]
+
     def _render_template(self):
         buf = None
 
@@ -273,6 +704,10 @@ class CloudStackUtility:
                 return True
 
             template_file = self._config.get('environment', {}).get('template', None)
+            if self._template_cache:
+                self._config['environment']['template'] = self._template_cache.render(template_file, context)
+                return True
+
             path, filename = os.path.split(template_file)
             env = jinja2.Environment(
                 loader=jinja2.FileSystemLoader(path or './')
@@ -286,11 +721,49 @@ class CloudStackUtility:
 
         except Exception as wtf:
             print('error: _render_template() caught {}'.format(wtf))
-            sys.exit(1)
+            return False
 
         return buf
 
     def _load_template(self):
+        if self._template_cache:
+            template_file = self._config.get('environment', {}).get('template', None)
+            self._template_parameters, self._yaml = self._template_cache.load(template_file, self._scan_template)
+        else:
+            self._template_parameters, self._yaml = self._scan_template()
+
+        return self._template_parameters is not None
+
+    def _scan_template(self):
+        """
+        Only the Parameters section of the template is needed for an upsert
+        so try the streaming scan first and fall back to a full parse if the
+        scan can not make sense of the template.
+
+        Returns:
+            a tuple of the template Parameters and True if the template is
+            YAML or (None, False) if the template is garbage
+        """
+        template_file = self._config.get('environment', {}).get('template', None)
+        try:
+            parameters, has_resources, is_yaml = scan_template(template_file)
+            if has_resources:
+                logger.info('template is {}'.format('YAML' if is_yaml else 'JSON'))
+                return parameters, is_yaml
+
+            logger.info('template has no Resources')
+            return None, False
+        except Exception as x:
+            logger.debug('Exception caught in scan_template(): {}'.format(x))
+            logger.info('template scan failed, parsing the whole template')
+
+        template, is_yaml = self._parse_template()
+        if template is None:
+            return None, False
+
+        return template.get('Parameters') or {}, is_yaml
+
+    def _parse_template(self):
         template_decoded = False
         template_file = self._config.get('environment', {}).get('template', None)
         self._template = None
@@ -312,7 +785,6 @@ class CloudStackUtility:
 
         if not template_decoded:
             try:
-                yaml.add_multi_constructor('', default_ctor, Loader=Loader)
                 with open(template_file, 'r') as f:
                     self._template = yaml.load(f, Loader=Loader)
 
@@ -327,7 +799,10 @@ class CloudStackUtility:
                 logger.debug('Exception caught in load_template(yaml): {}'.format(x))
                 logger.info('template is not YAML')
 
-        return template_decoded
+        if template_decoded:
+            return self._template, self._yaml
+
+        return None, False
 
     def list(self):
         """
@@ -393,7 +868,19 @@ class CloudStackUtility:
             logger.error('failed to find intial status of smash candidate: {}'.format(wtf))
             return False
 
-        response = self._cloudFormation.delete_stack(StackName=stack_name)
+        self._stack_notification_arns = response['Stacks'][0].get('NotificationARNs', [])
+        if self._start_notifier() and self._notifier.get_topic_arn() not in self._stack_notification_arns:
+            logger.info('stack does not notify {}, polling instead'.format(self._notifier.get_topic_arn()))
+            self._notifier.cleanup()
+            self._notifier = None
+
+        if self._lock_lost():
+            return False
+
+        response = self._cloudFormation.delete_stack(
+            StackName=stack_name,
+            ClientRequestToken=self._start_operation()
+        )
         logger.info('delete started for stack: {}'.format(stack_name))
         logger.debug('delete_stack returned: {}'.format(json.dumps(response, indent=4)))
         return self.poll_stack()
@@ -409,17 +896,17 @@ class CloudStackUtility:
         Returns:
             Good or Bad; True or False
         """
+        if self._cloudFormation:
+            return True
+
         try:
             profile = self._config.get('environment', {}).get('profile')
             region = self._config.get('environment', {}).get('region')
-            if profile:
-                self._b3Sess = boto3.session.Session(profile_name=profile)
-            else:
-                self._b3Sess = boto3.session.Session()
-
-            self._s3 = self._b3Sess.client('s3')
-            self._cloudFormation = self._b3Sess.client('cloudformation', region_name=region)
-            self._ssm = self._b3Sess.client('ssm', region_name=region)
+            self._b3Sess = get_session(profile)
+            self._s3 = get_client('s3', profile)
+            self._cloudFormation = get_client('cloudformation', profile, region)
+            self._ssm = get_client('ssm', profile, region)
+            self._secrets = get_client('secretsmanager', profile, region)
 
             return True
         except Exception as wtf:
@@ -427,13 +914,51 @@ class CloudStackUtility:
             traceback.print_exc(file=sys.stdout)
             return False
 
+    def _package_wanted(self):
+        wanted = self._config.get('package', self._config.get('environment', {}).get('package', False))
+        return str(wanted).lower() == 'true'
+
+    def _package_artifacts(self, upload=True):
+        """
+        Upload the local artifacts (code directories, nested templates, ...)
+        named in the template and point the template at them.
+
+        Args:
+            upload - False to only point the template at where the artifacts
+                     would go, e.g. for diff
+
+        Returns:
+            Good or Bad; True or False
+        """
+        if not self._package_wanted():
+            return True
+
+        try:
+            environment = self._config['environment']
+            original_template = self._original_config['environment']['template']
+            packager = ArtifactPackager(
+                self._s3,
+                environment['bucket'],
+                environment.get('artifact_prefix', 'artifacts'),
+                upload=upload
+            )
+            environment['template'] = packager.package(
+                environment['template'],
+                os.path.dirname(os.path.abspath(original_template))
+            )
+            return True
+        except Exception as wtf:
+            logger.error('Exception caught in package_artifacts(): {}'.format(wtf))
+            traceback.print_exc(file=sys.stdout)
+            return False
+
     def _fill_defaults(self):
         try:
-            parms = self._template['Parameters']
+            parms = self._template_parameters
             for key in parms:
                 key = str(key)
                 if 'Default' in parms[key] and key not in self._parameters:
-                    self._parameters[key] = str(parms[key]['Default'])
+                    self._parameters[key] = as_text(parms[key]['Default'])
 
         except Exception as wtf:
             logger.error('Exception caught in fill_defaults(): {}'.format(wtf))
@@ -442,6 +967,27 @@ class CloudStackUtility:
 
         return True
 
+    def _check_parameters(self):
+        """
+        Check every parameter value against the constraints of the template
+        (AllowedValues, AllowedPattern, lengths, number bounds, missing
+        values) and report all the problems at once, before anything is
+        uploaded or sent to CloudFormation.
+
+        Args:
+            None
+
+        Returns:
+            True if the values are good else False
+        """
+        logger.info(' required parameters: ' + str([str(p) for p in self._template_parameters]))
+        logger.info('available parameters: ' + str(self._parameters.keys()))
+        self._stackParameters, problems = check_parameters(self._template_parameters, self._parameters)
+        for problem in problems:
+            logger.error('parameter problem: {}'.format(problem))
+
+        return not problems
+
     def _get_ssm_parameter(self, p):
         """
         Get parameters from Simple Systems Manager
@@ -461,6 +1007,175 @@ class CloudStackUtility:
 
         return None
 
+    def _get_ssm_path(self, path):
+        """
+        Get every parameter under an SSM hierarchy, a page at a time.
+
+        Args:
+            path - the hierarchy, e.g. /app/prod/
+
+        Returns:
+            a list of (name, value) tuples, values decrypted if needed
+        """
+        if path != '/':
+            path = path.rstrip('/')
+
+        found = []
+        paginator = self._ssm.get_paginator('get_parameters_by_path')
+        for page in paginator.paginate(Path=path, Recursive=True, WithDecryption=True):
+            for parameter in page.get('Parameters', []):
+                found.append((parameter['Name'], parameter.get('Value')))
+
+        return found
+
+    def _fill_ssm_paths(self):
+        """
+        Swap each [ssm-path:/some/path/] entry for the parameters under that
+        path. The name relative to the path, or else the last part of it, is
+        matched with the template parameters, exactly or ignoring case and
+        punctuation (db/port fills DbPort, db-host fills DbHost). Values given
+        in the INI file win, then earlier paths.
+
+        Args:
+            None
+
+        Returns:
+            True if the paths could be read and every match is unambiguous
+            else False
+        """
+        def simple(name):
+            return re.sub('[^0-9a-z]', '', name.lower())
+
+        paths = [
+            (k, v[len(self.SSM_PATH):-1]) for k, v in self._parameters.items()
+            if isinstance(v, str) and v.startswith(self.SSM_PATH) and v.endswith(']')
+        ]
+        if not paths:
+            return True
+
+        template_names = [str(k) for k in self._template_parameters or {}]
+        explicit = set(k.lower() for k in self._parameters if k not in dict(paths))
+        for k, path in paths:
+            del self._parameters[k]
+            try:
+                found = self._get_ssm_path(path)
+            except Exception as ruh_roh:
+                logger.error('could not get SSM path {}: {}'.format(path, ruh_roh), exc_info=False)
+                return False
+
+            logger.info('SSM path {} has {} parameter(s)'.format(path, len(found)))
+            by_path = {}
+            by_leaf = {}
+            for ssm_name, value in found:
+                relative = ssm_name[len(path):] if ssm_name.startswith(path) else ssm_name
+                for name in [n for n in template_names if simple(n) == simple(relative)]:
+                    by_path.setdefault(name, []).append((ssm_name, value))
+
+                leaf = ssm_name.rsplit('/', 1)[-1]
+                matches = [n for n in template_names if n == leaf] or \
+                    [n for n in template_names if simple(n) == simple(leaf)]
+                for name in matches:
+                    by_leaf.setdefault(name, []).append((ssm_name, value))
+
+            for name in template_names:
+                if name in self._parameters or name.lower() in explicit:
+                    continue
+
+                candidates = by_path.get(name) or by_leaf.get(name) or []
+                if len(candidates) > 1:
+                    logger.error('{} matches more than one parameter under {}: {}'.format(
+                        name,
+                        path,
+                        ', '.join(ssm_name for ssm_name, _ in candidates)
+                    ))
+                    return False
+
+                if candidates:
+                    self._parameters[name] = candidates[0][1]
+
+        return True
+
+    def _get_secrets(self, secret_ids):
+        """
+        Get secrets from Secrets Manager, SECRET_BATCH at a time.
+
+        Args:
+            secret_ids - the names or ARNs of the secrets
+
+        Returns:
+            a dict of secret id to secret string, a secret that could not be
+            had is left out.
+        """
+        secrets = {}
+        secret_ids = sorted(set(secret_ids))
+        for i in range(0, len(secret_ids), self.SECRET_BATCH):
+            batch = secret_ids[i:i + self.SECRET_BATCH]
+            kwargs = {'SecretIdList': batch}
+            while True:
+                response = self._secrets.batch_get_secret_value(**kwargs)
+                for secret in response.get('SecretValues', []):
+                    for secret_id in batch:
+                        if secret_id in [secret.get('Name'), secret.get('ARN')] or \
+                                secret.get('ARN', '').startswith(secret_id + '-'):
+                            secrets[secret_id] = secret.get('SecretString')
+
+                for ruh_roh in response.get('Errors', []):
+                    logger.error('secret {}: {}'.format(ruh_roh.get('SecretId'), ruh_roh.get('Message')))
+
+                if not response.get('NextToken'):
+                    break
+                kwargs['NextToken'] = response['NextToken']
+
+        return secrets
+
+    def _fill_secrets(self):
+        """
+        Swap the [secret:id#jsonkey] parameters for their values. Every
+        secret is fetched once no matter how many parameters use it, the
+        #jsonkey part picks a key out of a JSON secret.
+
+        Args:
+            None
+
+        Returns:
+            True if every reference was found else False
+        """
+        wanted = {}
+        for k, v in self._parameters.items():
+            if isinstance(v, str) and v.startswith(self.SECRET) and v.endswith(']'):
+                secret_id, _, json_key = v[len(self.SECRET):-1].partition('#')
+                wanted[k] = (secret_id, json_key)
+                self._secret_references[k] = v
+
+        if not wanted:
+            return True
+
+        try:
+            secrets = self._get_secrets([secret_id for secret_id, _ in wanted.values()])
+        except Exception as ruh_roh:
+            logger.error('could not get secrets: {}'.format(ruh_roh), exc_info=False)
+            return False
+
+        all_good = True
+        for k, (secret_id, json_key) in wanted.items():
+            val = secrets.get(secret_id)
+            try:
+                if val is not None and json_key:
+                    val = json.loads(val).get(json_key)
+                    if val is not None and not isinstance(val, str):
+                        val = json.dumps(val) if isinstance(val, (dict, list)) else as_text(val)
+            except Exception:
+                logger.error('secret {} is not a JSON object'.format(secret_id))
+                val = None
+
+            if val is None:
+                logger.error('secret value for {} not found'.format(self._secret_references[k]))
+                all_good = False
+            else:
+                self._parameters[k] = val
+
+        return all_good
+
     def _fill_parameters(self):
         """
         Fill in the _parameters dict from the properties file.
@@ -475,8 +1190,13 @@ class CloudStackUtility:
             Figure out what could go wrong and at least acknowledge the the
             fact that Murphy was an optimist.
         """
-        self._parameters = self._config.get('parameters', {})
+        self._parameters = dict(self._config.get('parameters', {}))
+        if not self._fill_ssm_paths():
+            return False
+
         self._fill_defaults()
+        if not self._fill_secrets():
+            return False
 
         for k in self._parameters.keys():
             try:
@@ -547,14 +1267,23 @@ class CloudStackUtility:
             None
 
         Returns:
-            True
+            True unless the stack had to be deleted and that failed, or it
+            would have to be deleted for a plan
         """
+        self._updateStack = False
+        if self._config.get('stackset'):
+            return True
+
         try:
-            self._updateStack = False
             stack_name = self._config.get('environment', {}).get('stack_name', None)
             response = self._cloudFormation.describe_stacks(StackName=stack_name)
             stack = response['Stacks'][0]
             stack_status = stack.get('StackStatus')
+            self._stack_notification_arns = stack.get('NotificationARNs', [])
+            if stack_status in deletable_states and self._config.get('plan', False):
+                logger.error('stack is in {}, an upsert would delete it first, a plan does not'.format(stack_status))
+                return False
+
             if stack_status in deletable_states:
                 logger.info('stack is in {} and should be deleted'.format(stack_status))
                 del_stack_resp = self._cloudFormation.delete_stack(StackName=stack_name)
@@ -598,15 +1327,24 @@ class CloudStackUtility:
 
             logger.info('Copying parameters to s3://{}/{}'.format(bucket, propertyfile_key))
             temp_file_name = '/tmp/{}'.format((str(uuid.uuid4()))[:8])
+            archived_parameters = dict(self._parameters)
+            archived_parameters.update(self._secret_references)
             with open(temp_file_name, 'w') as dump_file:
-                json.dump(self._parameters, dump_file, indent=4)
+                json.dump(archived_parameters, dump_file, indent=4)
 
             self._s3.upload_file(temp_file_name, bucket, propertyfile_key)
 
-            logger.info('Copying {} to s3://{}/{}'.format(template_file, bucket, stackfile_key))
-            self._s3.upload_file(template_file, bucket, stackfile_key)
+            if self._template_cache:
+                self._templateUrl = self._template_cache.upload(
+                    template_file,
+                    bucket,
+                    stackfile_key,
+                    lambda: self._upload_template(template_file, bucket, stackfile_key),
+                    lambda source_key: self._copy_template(bucket, source_key, stackfile_key)
+                )
+            else:
+                self._templateUrl = self._upload_template(template_file, bucket, stackfile_key)
 
-            self._templateUrl = 'https://s3.amazonaws.com/{}/{}'.format(bucket, stackfile_key)
             logger.info("template_url: " + self._templateUrl)
             return True
         except Exception as x:
@@ -614,6 +1352,20 @@ class CloudStackUtility:
             traceback.print_exc(file=sys.stdout)
             return False
 
+    def _upload_template(self, template_file, bucket, stackfile_key):
+        logger.info('Copying {} to s3://{}/{}'.format(template_file, bucket, stackfile_key))
+        self._s3.upload_file(template_file, bucket, stackfile_key)
+        return 'https://s3.amazonaws.com/{}/{}'.format(bucket, stackfile_key)
+
+    def _copy_template(self, bucket, source_key, stackfile_key):
+        logger.info('Copying s3://{}/{} to s3://{}/{}'.format(bucket, source_key, bucket, stackfile_key))
+        self._s3.copy_object(
+            Bucket=bucket,
+            Key=stackfile_key,
+            CopySource={'Bucket': bucket, 'Key': source_key}
+        )
+        return 'https://s3.amazonaws.com/{}/{}'.format(bucket, stackfile_key)
+
     def _craft_s3_keys(self):
         """
         We are putting stuff into S3, were supplied the bucket. Here we
@@ -657,13 +1409,117 @@ class CloudStackUtility:
         Returns:
             Good or bad; True or False
         """
+        with self._stage_timer.stage('poll'):
+            done = self._wait_for_stack()
+
+        if self._client_request_token:
+            # the operation of this run is over, nothing left to resume
+            self._clear_journal()
+
+        return done
+
+    def _wait_for_stack(self):
+        if self._stack_set:
+            return self._stack_set.wait(self._lock_lost)
+
+        if self._notifier:
+            try:
+                status = self._wait_for_notification()
+            finally:
+                self.release_notifier()
+
+            if status:
+                return status in completed_states
+
+        return self._poll_stack()
+
+    def release_notifier(self):
+        """
+        Remove the per-run queue and subscription of the notifier, if any.
+        Safe to call more than once.
+        """
+        if self._notifier:
+            self._notifier.cleanup()
+            self._notifier = None
+
+    def _notifications_wanted(self):
+        wanted = self._config.get('notifications', self._config.get('environment', {}).get('notifications', False))
+        return str(wanted).lower() == 'true'
+
+    def _start_notifier(self):
+        """
+        Set up event driven completion through SNS and SQS if the config
+        asks for it. Any problem here means we simply poll.
+
+        Returns:
+            the NotificationARNs for the stack call or None
+        """
+        if not self._notifications_wanted():
+            return None
+
+        environment = self._config.get('environment', {})
+        profile = environment.get('profile')
+        region = environment.get('region')
+        notifier = None
+        try:
+            notifier = StackNotifier(
+                get_client('sns', profile, region, environment.get('sns_endpoint')),
+                get_client('sqs', profile, region, environment.get('sqs_endpoint')),
+                environment.get('notification_topic')
+            )
+            topic_arn = notifier.setup()
+            self._notifier = notifier
+            return [arn for arn in self._stack_notification_arns if arn != topic_arn] + [topic_arn]
+        except Exception as wtf:
+            logger.warning('notifications are not available, polling instead: {}'.format(wtf))
+            if notifier:
+                notifier.cleanup()
+
+        return None
+
+    def _wait_for_notification(self):
+        """
+        Long poll for the final notification of the stack. Every few minutes
+        without a word the stack is checked directly in case a notification
+        went missing.
+
+        Returns:
+            the final StackStatus or None if the notifications let us down
+        """
+        stack_name = self._config.get('environment', {}).get('stack_name', None)
+        logger.info('waiting for notifications about {}'.format(stack_name))
+        check_every = 300
+        if self._config.get('fail_fast', False) or self._deadline() or self._lock is not None:
+            check_every = POLL_INTERVAL
+
+        try:
+            while True:
+                status = self._notifier.wait(stack_name, check_every)
+                if status:
+                    return status
+
+                try:
+                    response = self._cloudFormation.describe_stacks(StackName=stack_name)
+                    status = response['Stacks'][0]['StackStatus']
+                except ClientError as wtf:
+                    if str(wtf).find('does not exist') == -1:
+                        raise
+                    status = 'DELETE_COMPLETE'
+
+                logger.info('current status of {}: {}'.format(stack_name, status))
+                if status.endswith('COMPLETE') or status.endswith('FAILED'):
+                    return status
+
+                if self._doomed(stack_name, status):
+                    return 'FAILED'
+        except Exception as wtf:
+            logger.warning('waiting for notifications did not go well, polling instead: {}'.format(wtf))
+
+        return None
+
+    def _poll_stack(self):
         logger.info('polling stack status, POLL_INTERVAL={}'.format(POLL_INTERVAL))
         time.sleep(POLL_INTERVAL)
-        completed_states = [
-            'CREATE_COMPLETE',
-            'UPDATE_COMPLETE',
-            'DELETE_COMPLETE'
-        ]
         stack_name = self._config.get('environment', {}).get('stack_name', None)
         while True:
             try:
@@ -677,6 +1533,9 @@ class CloudStackUtility:
                     else:
                         return False
 
+                if self._doomed(stack_name, current_status):
+                    return False
+
                 time.sleep(POLL_INTERVAL)
             except ClientError as wtf:
                 if str(wtf).find('does not exist') == -1:
@@ -691,6 +1550,111 @@ class CloudStackUtility:
                 traceback.print_exc(file=sys.stdout)
                 return False
 
+    def _start_operation(self):
+        """
+        Note the start of a create/update/delete, the returned token tags the
+        events of this operation. A run resumed from the journal gets the
+        token of the run it picks up from, CloudFormation treats a retried
+        call with the same token as the same request.
+        """
+        started = self._journal.get('started') if self._journal else None
+        if started:
+            self._client_request_token = started['token']
+            self._operation_started = started['started']
+            return self._client_request_token
+
+        self._client_request_token = str(uuid.uuid4())
+        self._operation_started = time.time()
+        if self._journal:
+            self._journal.record(
+                'started',
+                token=self._client_request_token,
+                update=self._updateStack,
+                started=self._operation_started
+            )
+
+        return self._client_request_token
+
+    def _deadline(self):
+        try:
+            minutes = float(self._config.get('deadline') or 0)
+        except ValueError:
+            minutes = 0
+
+        if minutes > 0 and self._operation_started:
+            return self._operation_started + minutes * 60
+
+        return None
+
+    def _doomed(self, stack_name, current_status):
+        """
+        With fail_fast a resource failure in the current operation ends the
+        wait without waiting for the rollback, with deadline the wait ends
+        when the operation has run too long. In both cases an in progress
+        update is cancelled if cancel_on_failure is set. Losing the deploy
+        lock also ends the wait.
+
+        Args:
+            stack_name - the stack of interest
+            current_status - the current StackStatus
+
+        Returns:
+            True if we should stop waiting for the stack
+        """
+        reason = None
+        deadline = self._deadline()
+        if self._lock_lost():
+            reason = 'the deploy lock was lost'
+        elif deadline and time.time() > deadline:
+            reason = 'the deploy deadline of {} minutes has passed'.format(self._config.get('deadline'))
+        elif self._config.get('fail_fast', False):
+            failure = self._first_resource_failure(stack_name)
+            if failure:
+                reason = '{} ({}) {}: {}'.format(
+                    failure.get('LogicalResourceId'),
+                    failure.get('ResourceType'),
+                    failure.get('ResourceStatus'),
+                    failure.get('ResourceStatusReason', '')
+                )
+
+        if not reason:
+            return False
+
+        logger.error('giving up on {}: {}'.format(stack_name, reason))
+        if self._config.get('cancel_on_failure', False) and current_status == 'UPDATE_IN_PROGRESS':
+            try:
+                self._cloudFormation.cancel_update_stack(StackName=stack_name)
+                logger.info('update of {} cancelled, the rollback continues without us'.format(stack_name))
+            except Exception as wtf:
+                logger.error('cancel_update_stack() did not go well: {}'.format(wtf))
+
+        return True
+
+    def _first_resource_failure(self, stack_name):
+        """
+        Find the first failed resource event of the current operation.
+
+        Args:
+            stack_name - the stack of interest
+
+        Returns:
+            the stack event or None
+        """
+        if not self._client_request_token:
+            return None
+
+        failure = None
+        paginator = self._cloudFormation.get_paginator('describe_stack_events')
+        for page in paginator.paginate(StackName=stack_name):
+            for event in page.get('StackEvents', []):
+                if event.get('ClientRequestToken') != self._client_request_token:
+                    return failure
+
+                if event.get('LogicalResourceId') != stack_name and event.get('ResourceStatus', '').endswith('FAILED'):
+                    failure = event
+
+        return failure
+
     def _initialize_list(self):
         if not self._init_boto3_clients():
             logger.error('session initialization was not good')
@@ -717,32 +1681,89 @@ class CloudStackUtility:
                 return False
 
     def _initialize_upsert(self):
-        if not self._validate_ini_data():
-            logger.error('INI file missing required bits; bucket and/or template and/or stack_name')
-            raise SystemError
-        elif not self._render_template():
-            logger.error('template rendering failed')
-            raise SystemError
-        elif not self._load_template():
-            logger.error('template initialization was not good')
-            raise SystemError
-        elif not self._init_boto3_clients():
-            logger.error('session initialization was not good')
-            raise SystemError
-        elif not self._fill_parameters():
-            logger.error('parameter setup was not good')
-            raise SystemError
-        elif not self._read_tags():
-            logger.error('tags initialization was not good')
-            raise SystemError
-        elif not self._archive_elements():
-            logger.error('saving stuff to S3 did not go well')
-            raise SystemError
-        elif not self._set_update():
-            logger.error('there was a problem determining update or create')
-            raise SystemError
+        steps = [
+            ('validate ini', self._validate_ini_data, 'INI file missing required bits; bucket and/or template and/or stack_name'),
+            ('render template', self._render_template, 'template rendering failed'),
+            ('parse template', self._load_template, 'template initialization was not good'),
+            ('boto3 clients', self._init_boto3_clients, 'session initialization was not good'),
+            ('fill parameters', self._fill_parameters, 'parameter setup was not good'),
+            ('check parameters', self._check_parameters, 'parameter values do not fit the template'),
+            ('read tags', self._read_tags, 'tags initialization was not good'),
+            ('package', self._package_artifacts, 'packaging the template artifacts did not go well'),
+            ('s3 upload', self._archive_once, 'saving stuff to S3 did not go well'),
+            ('set update', self._set_update_once, 'there was a problem determining update or create')
+        ]
+        for stage, step, complaint in steps:
+            with self._stage_timer.stage(stage):
+                good = step()
+
+            if not good:
+                logger.error(complaint)
+                raise SystemError
+
+    def _initialize_diff(self):
+        steps = [
+            ('validate ini', self._validate_ini_data, 'INI file missing required bits; bucket and/or template and/or stack_name'),
+            ('render template', self._render_template, 'template rendering failed'),
+            ('parse template', self._load_template, 'template initialization was not good'),
+            ('boto3 clients', self._init_boto3_clients, 'session initialization was not good'),
+            ('fill parameters', self._fill_parameters, 'parameter setup was not good'),
+            ('check parameters', self._check_parameters, 'parameter values do not fit the template'),
+            ('package', lambda: self._package_artifacts(upload=False), 'packaging artifacts did not go well')
+        ]
+        for stage, step, complaint in steps:
+            with self._stage_timer.stage(stage):
+                good = step()
+
+            if not good:
+                logger.error(complaint)
+                raise SystemError
+
+    def _archive_once(self):
+        """
+        Upload unless the journal says this very template was uploaded by
+        the run being resumed.
+        """
+        if not self._journal:
+            return self._archive_elements()
+
+        template_hash = file_hash(self._config['environment']['template'])
+        uploaded = self._journal.get('s3 upload')
+        if uploaded and uploaded.get('template_hash') == template_hash:
+            self._templateUrl = uploaded['template_url']
+            logger.info('template already uploaded: {}'.format(self._templateUrl))
+            return True
+
+        if not self._archive_elements():
+            return False
+
+        self._journal.record('s3 upload', template_hash=template_hash, template_url=self._templateUrl)
+        return True
+
+    def _set_update_once(self):
+        """
+        Once the previous run started the create/update the stack status no
+        longer says which one it was, the journal does.
+        """
+        started = self._journal.get('started') if self._journal else None
+        if started:
+            self._updateStack = started['update']
+            logger.info('update_stack (from journal): ' + str(self._updateStack))
+            return True
+
+        return self._set_update()
 
     def _analyze_stuff(self):
+        if self._template_cache:
+            return self._template_cache.analyze(
+                self._config['environment']['template'],
+                self._config.get('analysis', {}),
+                self._analyze_template
+            )
+
+        return self._analyze_template()
+
+    def _analyze_template(self):
         template_scanner = self._config.get('analysis', {}).get('template', None)
         tags_scanner = self._config.get('analysis', {}).get('tags', None)
 
@@ -755,7 +1776,7 @@ class CloudStackUtility:
         rule_exceptions = self._config.get('analysis', {}).get('exceptions', None)
         if wrk == 'true' or wrk == 'false':
             enforced = wrk == 'true'
-            self._internally_analyze_stuff(enforced, rule_exceptions)
+            return self._internally_analyze_stuff(enforced, rule_exceptions)
 
         return True
 
@@ -822,14 +1843,14 @@ class CloudStackUtility:
                     error_count = -1
                     if enforced:
                         traceback.print_exc(file=sys.stdout)
-                        sys.exit(1)
+                        return False
 
                 if error_count == 0:
                     logger.info('CloudFormation Validator found zero errors')
                 elif error_count == 1:
                     if enforced:
                         logger.error('CloudFormation Validator found one error')
-                        sys.exit(1)
+                        return False
                     else:
                         logger.warn('CloudFormation Validator found one error')
                 elif error_count > 1:
@@ -837,7 +1858,7 @@ class CloudStackUtility:
                         logger.error(
                             'CloudFormation Validator found {} errors'.format(error_count)
                         )
-                        sys.exit(1)
+                        return False
                     else:
                         logger.warn(
                             'CloudFormation Validator found {} errors'.format(error_count)
@@ -846,9 +1867,27 @@ class CloudStackUtility:
             logger.error('internally_analyze_stuff() exploded: {}'.format(ruh_roh_shaggy))
             traceback.print_exc(file=sys.stdout)
             if enforced:
-                sys.exit(1)
+                return False
 
         return True
 
     def get_cloud_formation_client(self):
         return self._cloudFormation
+
+    def get_stage_timer(self):
+        return self._stage_timer
+
+    def get_stack_name(self):
+        return self._config.get('environment', {}).get('stack_name')
+
+    def is_stack_set(self):
+        return self._stack_set is not None
+
+    def get_change_set_id(self):
+        return self._change_set_id
+
+    def is_update(self):
+        return self._updateStack
+
+    def nothing_to_do(self):
+        return self._nothing_to_do
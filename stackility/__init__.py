@@ -2,6 +2,11 @@ from stackility.CloudStackUtility import CloudStackUtility #noqa
 from stackility.stack_tool import StackTool #noqa
 from stackility.drift import DriftTool #noqa
 from stackility.resources import ResourceTool
+from stackility.teardown import TeardownTool
+from stackility.watcher import WatchTool
+from stackility.timeline import TimelineTool
+from stackility.owner import OwnerTool
+from stackility.prune import PruneTool
 from datetime import datetime
 
 __title__ = 'stackility'
@@ -10,17 +10,33 @@ Major help from: https://www.youtube.com/watch?v=kNke39OZ2k0
 
 from configparser import RawConfigParser
 import time
+import copy
+import cProfile
 import json
 import logging
 import sys
 import os
 import traceback
-import boto3
 import click
 from stackility import CloudStackUtility
 from stackility import StackTool
 from stackility import DriftTool
 from stackility import ResourceTool
+from stackility import TeardownTool
+from stackility import WatchTool
+from stackility import TimelineTool
+from stackility import OwnerTool
+from stackility import PruneTool
+from stackility.matrix import expand_matrix
+from stackility.matrix import MatrixDeploy
+from stackility.plan_many import FleetPlan
+from stackility.daemon import DaemonClient
+from stackility.daemon import StackilityDaemon
+from stackility.daemon import DEFAULT_ADDRESS
+from stackility.deploy_lock import deploy_lock
+from stackility.utility.aws_session import get_client
+from stackility.utility.aws_session import get_session
+from stackility.utility.stage_timer import StageTimer
 
 logging.basicConfig(
     level=logging.INFO,
@@ -53,54 +69,185 @@ def cli():
 )
 @click.option('--no-poll', help='Start the stack work but do not poll', is_flag=True)
 @click.option('--work-directory', '-w', help='Start in the given working directory')
-def upsert(version, stack, ini, dryrun, yaml, no_poll, work_directory):
+@click.option('--profile-run', help='write <PREFIX>.prof (cProfile) and <PREFIX>.trace.json (Chrome trace) for the run', metavar='PREFIX')
+@click.option('--via-changeset', help='create a change set and execute it instead of calling create/update', is_flag=True)
+@click.option('--wait-for-approval', help='with --via-changeset, ask before executing the change set', is_flag=True)
+@click.option('--notify', help='wait for SNS notifications through an SQS queue instead of polling', is_flag=True)
+@click.option('--fail-fast', help='stop waiting as soon as a resource fails', is_flag=True)
+@click.option('--cancel-on-failure', help='with --fail-fast or --deadline, cancel an update that is given up on', is_flag=True)
+@click.option('--deadline', help='give up on the stack after this many minutes', type=float)
+@click.option('--package', help='upload local code directories and nested templates named in the template', is_flag=True)
+def upsert(version, stack, ini, dryrun, yaml, no_poll, work_directory, profile_run, via_changeset, wait_for_approval, notify, fail_fast, cancel_on_failure, deadline, package):
     """
     The main reason we have arrived here. This is the entry-point for the
     utility to create/update a CloudFormation stack.
     """
-    ini_data = read_config_info(ini)
-    if 'environment' not in ini_data:
-        print('[environment] section is required in the INI file')
-        sys.exit(1)
-
-    if version:
-        ini_data['codeVersion'] = version
-    else:
-        ini_data['codeVersion'] = str(int(time.time()))
-
-    if 'region' not in ini_data['environment']:
-        ini_data['environment']['region'] = find_myself()
-
+    ini_data = prepare_ini_data(ini, version, stack, work_directory)
     ini_data['yaml'] = bool(yaml)
     ini_data['no_poll'] = bool(no_poll)
     ini_data['dryrun'] = bool(dryrun)
+    ini_data['via_changeset'] = bool(via_changeset or wait_for_approval)
+    ini_data['wait_for_approval'] = bool(wait_for_approval)
+    if notify:
+        ini_data['notifications'] = True
 
-    if stack:
-        ini_data['environment']['stack_name'] = stack
+    ini_data['fail_fast'] = bool(fail_fast)
+    ini_data['cancel_on_failure'] = bool(cancel_on_failure)
+    if deadline:
+        ini_data['deadline'] = deadline
 
-    if work_directory:
-        try:
-            os.chdir(work_directory)
-        except Exception as wtf:
-            logger.error(wtf)
-            sys.exit(2)
+    if package:
+        ini_data['package'] = True
+
+    targets = expand_matrix(ini_data)
+    if targets:
+        start_matrix_upsert(ini_data, targets)
 
     print(json.dumps(ini_data, indent=2))
+    if not profile_run and not wait_for_approval:
+        forward_upsert(ini_data)
+
+    stage_timer = StageTimer()
+    profiler = cProfile.Profile() if profile_run else None
+    if profiler:
+        profiler.enable()
+
+    try:
+        start_upsert(ini_data, stage_timer)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(f'{profile_run}.prof')
+            stage_timer.write_trace(f'{profile_run}.trace.json')
+            logger.info(f'profile written to {profile_run}.prof and {profile_run}.trace.json')
+
+        stage_timer.print_timeline()
+
+
+@cli.command()
+@click.option('--version', '-v', help='code version')
+@click.option('--stack', '-s', help='stack name')
+@click.option('--ini', '-i', help='INI file with needed information', required=True)
+@click.option('--work-directory', '-w', help='Start in the given working directory')
+def plan(version, stack, ini, work_directory):
+    """
+    Create a change set for the stack and print it. The change set is kept
+    so it can be executed later with the apply command.
+    """
+    ini_data = prepare_ini_data(ini, version, stack, work_directory)
+    ini_data['plan'] = True
+    print(json.dumps(ini_data, indent=2))
+    forward_upsert(ini_data)
     start_upsert(ini_data)
 
 
+@cli.command('plan-many')
+@click.argument('ini', nargs=-1, required=True)
+@click.option('--version', '-v', help='code version')
+@click.option('--work-directory', '-w', help='Start in the given working directory')
+@click.option('--max-workers', help='how many change sets to prepare at the same time', type=int, default=10, show_default=True)
+def plan_many(ini, version, work_directory, max_workers):
+    """
+    Create change sets for many INI files at once, print one report of what
+    would change in every stack and delete the change sets.
+    """
+    ini_files = [os.path.abspath(i) for i in ini]
+    if work_directory:
+        work_directory = os.path.abspath(work_directory)
+
+    targets = []
+    for ini_file in ini_files:
+        ini_data = prepare_ini_data(ini_file, version, None, work_directory)
+        matrix_targets = expand_matrix(ini_data)
+        if not matrix_targets:
+            targets.append((os.path.basename(ini_file), ini_data))
+
+        for target_name, target in matrix_targets:
+            target['environment'].setdefault('region', ini_data['environment']['region'])
+            targets.append(('{}:{}'.format(os.path.basename(ini_file), target_name), target))
+
+    if FleetPlan(targets, max_workers).plan():
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--version', '-v', help='code version')
+@click.option('--stack', '-s', help='stack name')
+@click.option('--ini', '-i', help='INI file with needed information', required=True)
+@click.option('--work-directory', '-w', help='Start in the given working directory')
+def diff(version, stack, ini, work_directory):
+    """
+    Compare the deployed template and parameters of the stack with the local
+    ones, no change set is made.
+    """
+    ini_data = prepare_ini_data(ini, version, stack, work_directory)
+    stack_driver = CloudStackUtility(ini_data)
+    if stack_driver.diff():
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
 @cli.command()
-@click.option('-s', '--stack', required=True)
+@click.argument('change_set')
+@click.option('-r', '--region', help='region of the change set, taken from the ARN if not given')
+@click.option('-f', '--profile', help='AWS profile to access resources')
+@click.option('--no-poll', help='Start the stack work but do not poll', is_flag=True)
+def apply(change_set, region, profile, no_poll):
+    """
+    Execute a change set created by the plan command.
+    """
+    environment = {}
+    if region:
+        environment['region'] = region
+    elif change_set.startswith('arn:'):
+        environment['region'] = change_set.split(':')[3]
+    else:
+        environment['region'] = find_myself()
+
+    if profile:
+        environment['profile'] = profile
+
+    try:
+        cf_client = get_client('cloudformation', environment.get('profile'), environment['region'])
+        environment['stack_name'] = cf_client.describe_change_set(ChangeSetName=change_set)['StackName']
+    except Exception as wtf:
+        logger.error(f'change set {change_set} not found: {wtf}')
+        sys.exit(1)
+
+    with deploy_lock(environment) as locked:
+        if not locked:
+            sys.exit(1)
+
+        ini_data = {'environment': environment, 'no_poll': bool(no_poll)}
+        stack_driver = CloudStackUtility(ini_data)
+        stack_driver.hold_lock(locked)
+        if not stack_driver.apply(change_set):
+            logger.error('change set could not be executed.')
+            sys.exit(1)
+
+        environment['stack_name'] = stack_driver.get_stack_name()
+        finish_upsert(stack_driver, ini_data)
+
+
+@cli.command()
+@click.option('-s', '--stack', multiple=True, help='stack name, may be given more than once')
+@click.option('-p', '--pattern', help='delete every stack whose name matches this pattern, e.g. "dev-*"')
 @click.option('-r', '--region')
 @click.option('-f', '--profile')
-def delete(stack, region, profile):
+def delete(stack, pattern, region, profile):
     """
-    Delete the given CloudFormation stack.
+    Delete the given CloudFormation stack(s).
     """
+    if not stack and not pattern:
+        print('at least one --stack or a --pattern is required')
+        sys.exit(1)
+
     ini_data = {}
     environment = {}
 
-    environment['stack_name'] = stack
     if region:
         environment['region'] = region
     else:
@@ -109,9 +256,21 @@ def delete(stack, region, profile):
     if profile:
         environment['profile'] = profile
 
-    ini_data['environment'] = environment
+    forward_to_daemon('delete', {
+        'environment': environment,
+        'stacks': [s for s in stack],
+        'pattern': pattern
+    })
+
+    if len(stack) == 1 and not pattern:
+        environment['stack_name'] = stack[0]
+        ini_data['environment'] = environment
+        smashed = start_smash(ini_data)
+    else:
+        ini_data['environment'] = environment
+        smashed = start_teardown(ini_data, stack, pattern)
 
-    if start_smash(ini_data):
+    if smashed:
         sys.exit(0)
     else:
         sys.exit(1)
@@ -136,6 +295,7 @@ def list(region, profile):
         environment['profile'] = profile
 
     ini_data['environment'] = environment
+    forward_to_daemon('list', ini_data)
     if start_list(ini_data):
         sys.exit(0)
     else:
@@ -146,17 +306,28 @@ def list(region, profile):
 @click.option('--stack', '-s', help='stack name', required=True)
 @click.option('-r', '--region', help='region where the stack lives')
 @click.option('-f', '--profile', help='AWS profile to access resources')
-def drift(stack, region, profile):
+@click.option('--type', '-t', 'types', multiple=True, help='only check resources of this type, e.g. "AWS::IAM::*", may be given more than once')
+@click.option('--logical-id', '-l', 'logical_ids', multiple=True, help='only check this resource, may be given more than once')
+def drift(stack, region, profile, types, logical_ids):
     """
     Produce a CloudFormation drift report for the given stack.
     """
     logger.debug(f'finding drift - stack: {stack}')
     logger.debug(f'region: {region}')
     logger.debug(f'profile: {profile}')
+    forward_to_daemon('drift', {
+        'stack': stack,
+        'region': region,
+        'profile': profile,
+        'types': [t for t in types],
+        'logical_ids': [x for x in logical_ids]
+    })
     tool = DriftTool(
         Stack=stack,
         Region=region,
         Profile=profile,
+        Types=types,
+        LogicalIds=logical_ids,
         Verbose=True
     )
 
@@ -177,6 +348,7 @@ def resources(stack, region, profile):
     logging.debug(f'finding resources - stack: {stack}')
     logging.debug(f'region: {region}')
     logging.debug(f'profile: {profile}')
+    forward_to_daemon('resources', {'stack': stack, 'region': region, 'profile': profile})
     tool = ResourceTool(
         Stack=stack,
         Region=region,
@@ -190,64 +362,360 @@ def resources(stack, region, profile):
         sys.exit(1)
 
 
-def start_upsert(ini_data):
+@cli.command()
+@click.option('-s', '--stack', multiple=True, help='stack name, may be given more than once')
+@click.option('-p', '--pattern', help='watch every stack whose name matches this pattern, e.g. "dev-*"')
+@click.option('-r', '--region', help='region where the stacks live')
+@click.option('-f', '--profile', help='AWS profile to access resources')
+def watch(stack, pattern, region, profile):
+    """
+    Wait for the work on the given CloudFormation stack(s) to finish.
+    """
+    if not stack and not pattern:
+        print('at least one --stack or a --pattern is required')
+        sys.exit(1)
+
+    tool = WatchTool(
+        Stacks=[s for s in stack],
+        Pattern=pattern,
+        Region=region or find_myself(),
+        Profile=profile
+    )
+
+    if tool.watch():
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--stack', '-s', help='stack name', required=True)
+@click.option('-r', '--region', help='region where the stack lives')
+@click.option('-f', '--profile', help='AWS profile to access resources')
+@click.option('--save', help='append the timeline to this JSONL file')
+def timeline(stack, region, profile, save):
+    """
+    Show where the time of the latest deploy of the stack went.
+    """
+    tool = TimelineTool(
+        Stack=stack,
+        Region=region or find_myself(),
+        Profile=profile,
+        Save=save
+    )
+
+    if tool.report():
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
+@cli.command()
+@click.argument('physical_id', nargs=-1, required=True)
+@click.option('-r', '--region', help='region of the stacks')
+@click.option('-f', '--profile', help='AWS profile to access resources')
+@click.option('--max-age', help='refresh the local index if it is older than this many seconds', default=300, type=int)
+@click.option('--refresh', help='refresh the local index first no matter how old it is', is_flag=True)
+def owner(physical_id, region, profile, max_age, refresh):
+    """
+    Find the stacks that own the given physical resources.
+    """
+    tool = OwnerTool(
+        Region=region or find_myself(),
+        Profile=profile,
+        MaxAge=max_age,
+        Refresh=refresh
+    )
+
+    if tool.find_owners(physical_id):
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('-b', '--bucket', help='bucket holding the archived templates', required=True)
+@click.option('--keep', help='keep this many archives per stack', type=int)
+@click.option('--days', help='keep the archives of this many days', type=float)
+@click.option('-s', '--stack', help='shell style pattern of the stacks to prune (repeatable)', multiple=True)
+@click.option('-r', '--region', help='region of the stacks (repeatable), default every enabled region', multiple=True)
+@click.option('-f', '--profile', help='AWS profile to access resources')
+@click.option('--dryrun', '-d', help='only report what would be deleted', is_flag=True)
+def prune(bucket, keep, days, stack, region, profile, dryrun):
+    """
+    Delete old templates and parameters archived by upsert.
+    """
+    if keep is None and days is None:
+        print('at least one of --keep or --days is required')
+        sys.exit(1)
+
+    tool = PruneTool(
+        Bucket=bucket,
+        Keep=keep,
+        Days=days,
+        Stacks=[s for s in stack],
+        DryRun=dryrun,
+        Regions=[r for r in region],
+        Region=find_myself(),
+        Profile=profile
+    )
+
+    if tool.prune():
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
+@cli.command()
+@click.option('--address', '-a', help=f'http://host:port or unix:///path/to/socket, default {DEFAULT_ADDRESS}')
+@click.option('--workers', '-n', help='number of jobs to run at the same time', default=8, type=int)
+def serve(address, workers):
+    """
+    Run a long lived stackility daemon. Other stackility commands are sent to
+    the daemon when the STACKILITY_DAEMON environment variable holds its address.
+    """
+    the_daemon = StackilityDaemon(Address=address, Workers=workers)
+    if the_daemon.serve():
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
+def forward_to_daemon(command, args):
+    """
+    Send the command to the daemon named in STACKILITY_DAEMON if there is one.
+
+    Args:
+        command - upsert, list, delete, drift or resources
+        args - a dictionary of info to inform the operation
+
+    Returns:
+        if there is no daemon, or it did not accept the job, so the command
+        should run locally
+
+    Exit:
+        0 - good
+        1 - bad
+    """
+    address = os.environ.get('STACKILITY_DAEMON')
+    if not address:
+        return
+
+    client = DaemonClient(address)
+    try:
+        job_id = client.submit(command, args)
+    except (OSError, SystemError) as wtf:
+        logger.warning(f'stackility daemon at {address} did not take the job, running locally: {wtf}')
+        return
+
+    # the daemon has the job now, running it here too would do it twice
+    try:
+        success, output = client.wait(job_id)
+    except (OSError, SystemError) as wtf:
+        logger.error(f'lost track of job {job_id} on the stackility daemon at {address}: {wtf}')
+        sys.exit(1)
+
+    print(output, end='')
+    if success:
+        sys.exit(0)
+    else:
+        sys.exit(1)
+
+
+def prepare_ini_data(ini, version, stack, work_directory):
+    """
+    Read the INI file and fill in the bits given on the command line.
+
+    Args:
+        ini - path to the INI file
+        version - code version or None
+        stack - stack name or None
+        work_directory - directory to start in or None
+
+    Returns:
+        the dictionary of info to run upsert
+
+    Exits:
+        1 - if the INI file is missing the [environment] section
+        2 - if the work directory is no good
+    """
+    ini_data = read_config_info(ini)
+    if 'environment' not in ini_data:
+        print('[environment] section is required in the INI file')
+        sys.exit(1)
+
+    if version:
+        ini_data['codeVersion'] = version
+    else:
+        ini_data['codeVersion'] = str(int(time.time()))
+        ini_data['codeVersionGenerated'] = True
+
+    if 'region' not in ini_data['environment']:
+        ini_data['environment']['region'] = find_myself()
+
+    if stack:
+        ini_data['environment']['stack_name'] = stack
+
+    if work_directory:
+        try:
+            os.chdir(work_directory)
+        except Exception as wtf:
+            logger.error(wtf)
+            sys.exit(2)
+
+    return ini_data
+
+
+def forward_upsert(ini_data):
+    """
+    Send an upsert to the daemon unless it needs to ask questions.
+
+    Args:
+        ini_data - the dictionary of info to run upsert
+    """
+    if CloudStackUtility.ASK in ini_data.get('parameters', {}).values():
+        return
+
+    forwarded = copy.deepcopy(ini_data)
+    template = forwarded['environment'].get('template')
+    if template:
+        forwarded['environment']['template'] = os.path.abspath(template)
+
+    forward_to_daemon('upsert', forwarded)
+
+
+def start_upsert(ini_data, stage_timer=None):
     """
     Helper function to facilitate upsert.
 
     Args:
         ini_date - the dictionary of info to run upsert
+        stage_timer - optional StageTimer to record the stages of the run
 
    Exit:
        0 - good
        1 - bad
     """
-    stack_driver = CloudStackUtility(ini_data)
-    poll_stack = not ini_data.get('no_poll', False)
-    if stack_driver.upsert():
-        logger.info('stack create/update was started successfully.')
-
-        if poll_stack:
-            stack_tool = None
-            try:
-                profile = ini_data.get('environment', {}).get('profile')
-                if profile:
-                    boto3_session = boto3.session.Session(profile_name=profile)
-                else:
-                    boto3_session = boto3.session.Session()
-
-                region = ini_data['environment']['region']
-                stack_name = ini_data['environment']['stack_name']
-
-                cf_client = stack_driver.get_cloud_formation_client()
-
-                if not cf_client:
-                    cf_client = boto3_session.client('cloudformation', region_name=region)
-
-                stack_tool = stack_tool = StackTool(
-                    stack_name,
-                    region,
-                    cf_client
-                )
-            except Exception as wtf:
-                logger.warning(f'there was a problems creating stack tool: {wtf}')
-
-            if stack_driver.poll_stack():
-                try:
-                    logger.info('stack create/update was finished successfully.')
-                    stack_tool.print_stack_info()
-                except Exception as wtf:
-                    logger.warning(f'there was a problems printing stack info: {wtf}')
-
+    with deploy_lock(ini_data.get('environment', {})) as locked:
+        if not locked:
+            sys.exit(1)
+
+        stack_driver = CloudStackUtility(ini_data, stage_timer=stage_timer)
+        stack_driver.hold_lock(locked)
+        if stack_driver.upsert():
+            if ini_data.get('dryrun', False) or ini_data.get('plan', False):
                 sys.exit(0)
-            else:
-                try:
-                    logger.error('stack create/update was did not go well.')
-                    stack_tool.print_stack_events()
-                except Exception as wtf:
-                    logger.warning(f'there was a problems printing stack events: {wtf}')
-                sys.exit(1)
+
+            logger.info('stack create/update was started successfully.')
+            finish_upsert(stack_driver, ini_data)
+        else:
+            logger.error('start of stack create/update did not go well.')
+            sys.exit(1)
+
+
+def finish_upsert(stack_driver, ini_data):
+    """
+    Poll the stack work started by the given driver and report how it went.
+
+    Args:
+        stack_driver - the CloudStackUtility that started the work
+        ini_data - the dictionary of info used to start the work
+
+   Exit:
+       0 - good
+       1 - bad
+    """
+    try:
+        _poll_upsert(stack_driver, ini_data)
+    finally:
+        stack_driver.release_notifier()
+
+
+def _poll_upsert(stack_driver, ini_data):
+    if ini_data.get('no_poll', False):
+        return
+
+    if stack_driver.nothing_to_do():
+        sys.exit(0)
+
+    if stack_driver.is_stack_set():
+        if stack_driver.poll_stack():
+            logger.info('stack set rollout was finished successfully.')
+            sys.exit(0)
+
+        logger.error('stack set rollout did not go well.')
+        sys.exit(1)
+
+    stack_tool = None
+    try:
+        profile = ini_data.get('environment', {}).get('profile')
+        region = ini_data['environment']['region']
+        stack_name = ini_data['environment']['stack_name']
+
+        cf_client = stack_driver.get_cloud_formation_client()
+
+        if not cf_client:
+            cf_client = get_client('cloudformation', profile, region)
+
+        stack_tool = StackTool(
+            stack_name,
+            region,
+            cf_client
+        )
+    except Exception as wtf:
+        logger.warning(f'there was a problems creating stack tool: {wtf}')
+
+    if stack_driver.poll_stack():
+        try:
+            logger.info('stack create/update was finished successfully.')
+            stack_tool.print_stack_info()
+        except Exception as wtf:
+            logger.warning(f'there was a problems printing stack info: {wtf}')
+
+        sys.exit(0)
+    else:
+        try:
+            logger.error('stack create/update was did not go well.')
+            stack_tool.print_stack_events()
+        except Exception as wtf:
+            logger.warning(f'there was a problems printing stack events: {wtf}')
+        sys.exit(1)
+
+
+def start_matrix_upsert(ini_data, targets):
+    """
+    Helper function to facilitate the upsert of every target in a matrix INI
+    file.
+
+    Args:
+        ini_data - the dictionary of info to run upsert
+        targets - a list of (target name, INI dictionary) tuples
+
+   Exit:
+       0 - good
+       1 - bad
+    """
+    seen = set()
+    for target_name, target in targets:
+        if 'region' not in target['environment']:
+            target['environment']['region'] = ini_data['environment']['region']
+
+        where = (target['environment']['region'], target['environment'].get('stack_name'))
+        if where[1] is None or where in seen:
+            logger.error(f'matrix target {target_name} needs its own stack_name/region')
+            sys.exit(1)
+        seen.add(where)
+
+    try:
+        max_workers = int(ini_data.get('matrix', {}).get('max_workers', 0))
+    except ValueError:
+        logger.error('[matrix] max_workers must be a number')
+        sys.exit(1)
+
+    logger.info('matrix targets: {}'.format(', '.join(t[0] for t in targets)))
+    if MatrixDeploy(targets, max_workers).deploy():
+        sys.exit(0)
     else:
-        logger.error('start of stack create/update did not go well.')
         sys.exit(1)
 
 
@@ -275,8 +743,35 @@ def start_smash(command_line):
     Returns:
        True if happy else False
     """
-    stack_driver = CloudStackUtility(command_line)
-    return stack_driver.smash()
+    with deploy_lock(command_line.get('environment', {})) as locked:
+        if not locked:
+            return False
+
+        stack_driver = CloudStackUtility(command_line)
+        stack_driver.hold_lock(locked)
+        return stack_driver.smash()
+
+
+def start_teardown(command_line, stacks, pattern):
+    """
+    Facilitate the smashing of many CloudFormation stacks
+
+    Args:
+        command_line - a dictionary to of info to inform the operation
+        stacks - a sequence of stack names
+        pattern - a stack name pattern or None
+
+    Returns:
+       True if happy else False
+    """
+    tool = TeardownTool(
+        Stacks=[s for s in stacks],
+        Pattern=pattern,
+        Region=command_line.get('environment', {}).get('region'),
+        Profile=command_line.get('environment', {}).get('profile'),
+        Environment=command_line.get('environment', {})
+    )
+    return tool.smash()
 
 
 def find_myself():
@@ -289,7 +784,7 @@ def find_myself():
     Returns:
        An Amazon region
     """
-    s = boto3.session.Session()
+    s = get_session()
     return s.region_name
 
 
@@ -0,0 +1,514 @@
+'''
+A long running stackility process. Jobs (upsert, list, delete, drift and
+resources) arrive over a small local HTTP API, on TCP or a Unix socket, and
+run on a worker pool. The boto3 sessions and clients stay warm between jobs
+so a pipeline step pays for interpreter start up, imports and credential
+resolution once instead of on every command.
+
+The default address is a Unix socket in ~/.stackility that only its owner
+can use. A TCP address needs a shared secret in STACKILITY_DAEMON_TOKEN, the
+daemon and its clients send it as a bearer token.
+
+API:
+    GET  /health             - is anybody home
+    POST /jobs               - {"command": "upsert", "args": {...}} returns {"job_id": "..."}
+    GET  /jobs/<id>?wait=20  - job status, waits up to 20 seconds for the job to finish
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import sys
+import json
+import time
+import hmac
+import uuid
+import socket
+import logging
+import threading
+import contextvars
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+from stackility.CloudStackUtility import CloudStackUtility
+from stackility.stack_tool import StackTool
+from stackility.drift import DriftTool
+from stackility.resources import ResourceTool
+from stackility.teardown import TeardownTool
+from stackility.deploy_lock import deploy_lock
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADDRESS = 'unix://' + os.path.join(os.path.expanduser('~'), '.stackility', 'daemon.sock')
+TOKEN_VARIABLE = 'STACKILITY_DAEMON_TOKEN'
+MAX_FINISHED_JOBS = 1000
+
+
+def run_upsert(args):
+    with deploy_lock(args.get('environment', {})) as locked:
+        return bool(locked) and _run_upsert(args, locked)
+
+
+def _run_upsert(args, locked=None):
+    stack_driver = CloudStackUtility(args)
+    stack_driver.hold_lock(locked)
+    try:
+        return _upsert_and_poll(stack_driver, args)
+    finally:
+        stack_driver.release_notifier()
+
+
+def _upsert_and_poll(stack_driver, args):
+    if not stack_driver.upsert():
+        logger.error('start of stack create/update did not go well.')
+        return False
+
+    if args.get('dryrun', False) or args.get('plan', False) or args.get('no_poll', False):
+        return True
+
+    if stack_driver.nothing_to_do():
+        return True
+
+    if stack_driver.is_stack_set():
+        return stack_driver.poll_stack()
+
+    stack_tool = StackTool(
+        args['environment']['stack_name'],
+        args['environment']['region'],
+        stack_driver.get_cloud_formation_client()
+    )
+    if stack_driver.poll_stack():
+        logger.info('stack create/update was finished successfully.')
+        stack_tool.print_stack_info()
+        return True
+
+    logger.error('stack create/update was did not go well.')
+    stack_tool.print_stack_events()
+    return False
+
+
+def run_list(args):
+    return CloudStackUtility(args).list()
+
+
+def run_delete(args):
+    environment = args['environment']
+    stacks = args.get('stacks', [])
+    if len(stacks) == 1 and not args.get('pattern'):
+        environment['stack_name'] = stacks[0]
+        with deploy_lock(environment) as locked:
+            if not locked:
+                return False
+
+            stack_driver = CloudStackUtility({'environment': environment})
+            stack_driver.hold_lock(locked)
+            return stack_driver.smash()
+
+    return TeardownTool(
+        Stacks=stacks,
+        Pattern=args.get('pattern'),
+        Region=environment.get('region'),
+        Profile=environment.get('profile'),
+        Environment=environment
+    ).smash()
+
+
+def run_drift(args):
+    return DriftTool(
+        Stack=args['stack'],
+        Region=args.get('region'),
+        Profile=args.get('profile'),
+        Types=args.get('types'),
+        LogicalIds=args.get('logical_ids'),
+        Verbose=True
+    ).determine_drift()
+
+
+def run_resources(args):
+    return ResourceTool(
+        Stack=args['stack'],
+        Region=args.get('region'),
+        Profile=args.get('profile'),
+        Verbose=True
+    ).list_resources()
+
+
+COMMANDS = {
+    'upsert': run_upsert,
+    'list': run_list,
+    'delete': run_delete,
+    'drift': run_drift,
+    'resources': run_resources
+}
+
+
+class _JobOutput(object):
+    '''
+    Stand in for sys.stdout that sends whatever a job prints to that job.
+    The job is found from a context variable, so the worker threads a job
+    starts through stackility.utility.threads write to the job too.
+    '''
+    def __init__(self, real):
+        self._real = real
+        self._buffer = contextvars.ContextVar('stackility_job_output', default=None)
+
+    def capture(self, buf):
+        return self._buffer.set(buf)
+
+    def release(self, token):
+        self._buffer.reset(token)
+
+    def current(self):
+        return self._buffer.get()
+
+    def write(self, text):
+        buf = self.current()
+        if buf is not None:
+            buf.append(text)
+            return len(text)
+
+        return self._real.write(text)
+
+    def flush(self):
+        self._real.flush()
+
+    def __getattr__(self, name):
+        return getattr(self._real, name)
+
+
+class _JobLogHandler(logging.Handler):
+    '''
+    Copy log records emitted while running a job into that job's output.
+    '''
+    def __init__(self, job_output):
+        logging.Handler.__init__(self)
+        self._job_output = job_output
+        self.setFormatter(logging.Formatter(
+            '[%(levelname)s] %(asctime)s (%(module)s) %(message)s',
+            '%Y/%m/%d-%H:%M:%S'
+        ))
+
+    def emit(self, record):
+        buf = self._job_output.current()
+        if buf is not None:
+            buf.append(self.format(record) + '\n')
+
+
+class StackilityDaemon(object):
+    '''
+    Run stackility jobs on a worker pool behind a local HTTP API.
+    '''
+
+    def __init__(self, **kwargs):
+        """
+        Args:
+            kwarg[Address]: http://host:port or unix:///path/to/socket
+            kwarg[Workers]: size of the worker pool
+
+        Raises:
+            SystemError if thing are not all good
+        """
+        self._address = kwargs.get('Address') or DEFAULT_ADDRESS
+        self._executor = ThreadPoolExecutor(max_workers=int(kwargs.get('Workers') or 8))
+        self._jobs = {}
+        self._finished = []
+        self._condition = threading.Condition()
+        self._job_output = _JobOutput(sys.stdout)
+
+        self._token = os.environ.get(TOKEN_VARIABLE)
+
+        where = urlparse(self._address)
+        if where.scheme not in ['http', 'unix']:
+            logger.error(f'can not serve on {self._address}')
+            raise SystemError
+
+        if where.scheme == 'http' and not self._token:
+            logger.error(f'serving on TCP needs a shared secret in {TOKEN_VARIABLE}')
+            raise SystemError
+
+    def authorized(self, header):
+        """
+        Check the Authorization header of a request, the Unix socket is
+        protected by its file mode instead.
+        """
+        if not self._token:
+            return True
+
+        return hmac.compare_digest(header or '', f'Bearer {self._token}')
+
+    def submit(self, command, args):
+        """
+        Queue a job.
+
+        Returns:
+            the job ID
+        """
+        if command not in COMMANDS:
+            raise ValueError(f'unknown command: {command}')
+
+        job_id = str(uuid.uuid4())
+        with self._condition:
+            self._jobs[job_id] = {
+                'job_id': job_id,
+                'command': command,
+                'status': 'QUEUED',
+                'success': None,
+                'output': '',
+                'submitted': time.time()
+            }
+
+        self._executor.submit(self._run, job_id, command, args)
+        return job_id
+
+    def _run(self, job_id, command, args):
+        buf = []
+        capture = self._job_output.capture(buf)
+        with self._condition:
+            self._jobs[job_id]['status'] = 'RUNNING'
+
+        try:
+            success = bool(COMMANDS[command](args))
+        except BaseException as wtf:
+            logger.error(f'job {job_id} exploded: {wtf}', exc_info=True)
+            success = False
+        finally:
+            self._job_output.release(capture)
+
+        with self._condition:
+            job = self._jobs[job_id]
+            job['status'] = 'DONE'
+            job['success'] = success
+            job['output'] = ''.join(buf)
+            job['finished'] = time.time()
+            self._finished.append(job_id)
+            while len(self._finished) > MAX_FINISHED_JOBS:
+                self._jobs.pop(self._finished.pop(0), None)
+
+            self._condition.notify_all()
+
+    def status(self, job_id, wait=0):
+        """
+        Get the state of a job, optionally waiting for it to finish.
+
+        Returns:
+            the job dictionary or None if the job is unknown
+        """
+        deadline = time.time() + wait
+        with self._condition:
+            while job_id in self._jobs and self._jobs[job_id]['status'] != 'DONE':
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def serve(self):
+        """
+        Serve until interrupted.
+
+        Returns:
+            True when stopped cleanly
+        """
+        sys.stdout = self._job_output
+        logging.getLogger().addHandler(_JobLogHandler(self._job_output))
+
+        where = urlparse(self._address)
+        handler = _make_handler(self)
+        if where.scheme == 'unix':
+            os.makedirs(os.path.dirname(where.path), mode=0o700, exist_ok=True)
+            if os.path.exists(where.path):
+                os.unlink(where.path)
+
+            # the socket is born 0600, there is no window where others can connect
+            old_umask = os.umask(0o077)
+            try:
+                server = _UnixHTTPServer(where.path, handler)
+            finally:
+                os.umask(old_umask)
+        else:
+            server = ThreadingHTTPServer((where.hostname, where.port or 80), handler)
+
+        logger.info(f'stackility daemon listening on {self._address}')
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            logger.info('stackility daemon stopping')
+        finally:
+            server.server_close()
+            self._executor.shutdown(wait=True)
+            sys.stdout = self._job_output._real
+            if where.scheme == 'unix' and os.path.exists(where.path):
+                os.unlink(where.path)
+
+        return True
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _make_handler(the_daemon):
+    class _Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+            logger.debug(format, *args)
+
+        def _reply(self, code, answer):
+            body = json.dumps(answer).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _allowed(self):
+            if the_daemon.authorized(self.headers.get('Authorization')):
+                return True
+
+            self._reply(401, {'error': 'not authorized'})
+            return False
+
+        def do_GET(self):
+            if not self._allowed():
+                return
+
+            request = urlparse(self.path)
+            if request.path == '/health':
+                self._reply(200, {'status': 'ok', 'pid': os.getpid()})
+                return
+
+            parts = request.path.strip('/').split('/')
+            if len(parts) != 2 or parts[0] != 'jobs':
+                self._reply(404, {'error': 'not found'})
+                return
+
+            try:
+                wait = float(parse_qs(request.query).get('wait', ['0'])[0])
+            except ValueError:
+                wait = 0
+
+            job = the_daemon.status(parts[1], wait)
+            if job:
+                self._reply(200, job)
+            else:
+                self._reply(404, {'error': 'unknown job'})
+
+        def do_POST(self):
+            if not self._allowed():
+                return
+
+            if urlparse(self.path).path != '/jobs':
+                self._reply(404, {'error': 'not found'})
+                return
+
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                job_id = the_daemon.submit(request.get('command'), request.get('args', {}))
+                self._reply(202, {'job_id': job_id})
+            except Exception as wtf:
+                self._reply(400, {'error': str(wtf)})
+
+    return _Handler
+
+
+class _UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self._path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self._path)
+
+
+class DaemonClient(object):
+    '''
+    Forward stackility commands to a running daemon.
+    '''
+
+    def __init__(self, address):
+        self._where = urlparse(address)
+        self._token = os.environ.get(TOKEN_VARIABLE)
+
+    def _connection(self, timeout):
+        if self._where.scheme == 'unix':
+            return _UnixHTTPConnection(self._where.path, timeout=timeout)
+
+        return http.client.HTTPConnection(self._where.hostname, self._where.port or 80, timeout=timeout)
+
+    def _call(self, method, path, body=None, timeout=10):
+        connection = self._connection(timeout)
+        try:
+            headers = {'Content-Type': 'application/json'} if body is not None else {}
+            if self._token:
+                headers['Authorization'] = f'Bearer {self._token}'
+            connection.request(method, path, body=json.dumps(body) if body is not None else None, headers=headers)
+            response = connection.getresponse()
+            answer = json.loads(response.read() or b'{}')
+            if response.status >= 400:
+                raise SystemError(answer.get('error', response.status))
+
+            return answer
+        finally:
+            connection.close()
+
+    def submit(self, command, args):
+        """
+        Hand a command to the daemon.
+
+        Returns:
+            the job ID
+
+        Raises:
+            OSError if the daemon can not be reached, SystemError if it
+            turned the job down
+        """
+        job_id = self._call('POST', '/jobs', {'command': command, 'args': args})['job_id']
+        logger.info(f'job {job_id} submitted to the stackility daemon')
+        return job_id
+
+    def wait(self, job_id, wait=20, retries=3):
+        """
+        Wait for a submitted job, riding out a few failed polls.
+
+        Returns:
+            a tuple of success and the output of the job
+
+        Raises:
+            OSError or SystemError if the daemon stops answering about the job
+        """
+        failures = 0
+        while True:
+            try:
+                job = self._call('GET', f'/jobs/{job_id}?wait={wait}', timeout=wait + 10)
+                failures = 0
+            except OSError as wtf:
+                failures += 1
+                if failures > retries:
+                    raise
+                logger.warning(f'polling job {job_id} did not go well, trying again: {wtf}')
+                time.sleep(failures)
+                continue
+
+            if job['status'] == 'DONE':
+                return job['success'], job['output']
+
+    def run(self, command, args, wait=20):
+        """
+        Run a command on the daemon and wait for it.
+
+        Returns:
+            a tuple of success and the output of the job
+
+        Raises:
+            OSError if the daemon can not be reached
+        """
+        return self.wait(self.submit(command, args), wait)
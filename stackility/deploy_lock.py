@@ -0,0 +1,311 @@
+'''
+A lock per stack held in a DynamoDB item so many CI runners can deploy
+independent stacks at the same time without stepping on each other.
+
+The lock has a lease kept alive by a heartbeat thread, a holder that dies
+simply lets the lease run out. Runners waiting for a lock queue up in the
+lock item and get it in the order they asked for it.
+
+Enabled by lock_table in the [environment] section or STACKILITY_LOCK_TABLE,
+lock_endpoint (or STACKILITY_LOCK_ENDPOINT) points at a local DynamoDB
+stand-in for testing.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import time
+import uuid
+import socket
+import random
+import logging
+import threading
+import contextlib
+from botocore.exceptions import ClientError
+
+from stackility.utility.aws_session import get_client
+from stackility.utility.threads import start_thread
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE = 120
+DEFAULT_WAIT = 60 * 60
+LOCK_POLL = 5
+
+
+def _failed_condition(wtf):
+    return wtf.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException'
+
+
+class DeployLock(object):
+    '''
+    One lock, i.e. one item in the lock table keyed by lock_key.
+    '''
+
+    def __init__(self, dynamodb_client, table, key, lease=DEFAULT_LEASE):
+        """
+        Args:
+            dynamodb_client - boto3 DynamoDB client
+            table - the lock table, made if it does not exist
+            key - what is being locked, e.g. us-east-1/my-stack
+            lease - seconds the lock is good for without a heartbeat
+        """
+        self._dynamodb = dynamodb_client
+        self._table = table
+        self._key = key
+        self._lease = lease
+        self._owner = '{}:{}:{}'.format(socket.gethostname(), os.getpid(), str(uuid.uuid4())[:8])
+        self._stop = threading.Event()
+        self._heartbeat = None
+        self.lost = False
+
+    def _ensure_table(self):
+        try:
+            self._dynamodb.describe_table(TableName=self._table)
+        except ClientError as wtf:
+            if wtf.response.get('Error', {}).get('Code') != 'ResourceNotFoundException':
+                raise
+
+            logger.info(f'creating lock table {self._table}')
+            try:
+                self._dynamodb.create_table(
+                    TableName=self._table,
+                    AttributeDefinitions=[{'AttributeName': 'lock_key', 'AttributeType': 'S'}],
+                    KeySchema=[{'AttributeName': 'lock_key', 'KeyType': 'HASH'}],
+                    BillingMode='PAY_PER_REQUEST'
+                )
+            except ClientError as wtf:
+                if wtf.response.get('Error', {}).get('Code') != 'ResourceInUseException':
+                    raise
+
+            self._dynamodb.get_waiter('table_exists').wait(TableName=self._table)
+
+    def _read(self):
+        response = self._dynamodb.get_item(
+            TableName=self._table,
+            Key={'lock_key': {'S': self._key}},
+            ConsistentRead=True
+        )
+        return response.get('Item', {})
+
+    def _enqueue(self, queued):
+        """
+        Add (or refresh) our place in the queue.
+        """
+        self._dynamodb.update_item(
+            TableName=self._table,
+            Key={'lock_key': {'S': self._key}},
+            UpdateExpression='SET #queue = if_not_exists(#queue, :empty)',
+            ExpressionAttributeNames={'#queue': 'queue'},
+            ExpressionAttributeValues={':empty': {'M': {}}}
+        )
+        self._dynamodb.update_item(
+            TableName=self._table,
+            Key={'lock_key': {'S': self._key}},
+            UpdateExpression='SET #queue.#me = :entry',
+            ExpressionAttributeNames={'#queue': 'queue', '#me': self._owner},
+            ExpressionAttributeValues={':entry': {'M': {
+                'queued': {'N': str(queued)},
+                'seen': {'N': str(time.time())}
+            }}}
+        )
+
+    def _my_turn(self, item, queued):
+        """
+        Nobody still waiting asked before us.
+        """
+        now = time.time()
+        for owner, entry in item.get('queue', {}).get('M', {}).items():
+            if owner == self._owner:
+                continue
+
+            entry = entry.get('M', {})
+            alive = float(entry.get('seen', {}).get('N', 0)) > now - self._lease
+            if alive and (float(entry['queued']['N']), owner) < (queued, self._owner):
+                return False
+
+        return True
+
+    def _take(self):
+        now = time.time()
+        try:
+            self._dynamodb.update_item(
+                TableName=self._table,
+                Key={'lock_key': {'S': self._key}},
+                UpdateExpression='SET holder = :me, expires = :expires, acquired = :now REMOVE #queue.#me',
+                ConditionExpression='attribute_not_exists(holder) OR expires < :now',
+                ExpressionAttributeNames={'#queue': 'queue', '#me': self._owner},
+                ExpressionAttributeValues={
+                    ':me': {'S': self._owner},
+                    ':expires': {'N': str(now + self._lease)},
+                    ':now': {'N': str(now)}
+                }
+            )
+            return True
+        except ClientError as wtf:
+            if _failed_condition(wtf):
+                return False
+            raise
+
+    def acquire(self, wait=DEFAULT_WAIT):
+        """
+        Wait in line for the lock.
+
+        Args:
+            wait - give up after this many seconds
+
+        Returns:
+            True if we hold the lock else False
+        """
+        self._ensure_table()
+        queued = time.time()
+        deadline = queued + wait
+        self._enqueue(queued)
+        holder = None
+        while True:
+            item = self._read()
+            if self._my_turn(item, queued) and self._take():
+                logger.info(f'lock {self._key} acquired by {self._owner}')
+                self._heartbeat = start_thread(self._beat)
+                return True
+
+            current = item.get('holder', {}).get('S')
+            if current != holder:
+                holder = current
+                logger.info(f'waiting for lock {self._key} held by {holder or "the runners ahead of us"}')
+
+            if time.time() > deadline:
+                logger.error(f'gave up waiting for lock {self._key}')
+                self._leave_queue()
+                return False
+
+            time.sleep(LOCK_POLL + random.random())
+            self._enqueue(queued)
+
+    def _beat(self):
+        while not self._stop.wait(self._lease / 3.0):
+            try:
+                self._dynamodb.update_item(
+                    TableName=self._table,
+                    Key={'lock_key': {'S': self._key}},
+                    UpdateExpression='SET expires = :expires',
+                    ConditionExpression='holder = :me',
+                    ExpressionAttributeValues={
+                        ':me': {'S': self._owner},
+                        ':expires': {'N': str(time.time() + self._lease)}
+                    }
+                )
+            except ClientError as wtf:
+                if _failed_condition(wtf):
+                    logger.error(f'lock {self._key} was lost')
+                    self.lost = True
+                    return
+                logger.warning(f'lock heartbeat did not go well: {wtf}')
+            except Exception as wtf:
+                logger.warning(f'lock heartbeat did not go well: {wtf}')
+
+    def _leave_queue(self):
+        try:
+            self._dynamodb.update_item(
+                TableName=self._table,
+                Key={'lock_key': {'S': self._key}},
+                UpdateExpression='REMOVE #queue.#me',
+                ExpressionAttributeNames={'#queue': 'queue', '#me': self._owner}
+            )
+        except Exception as wtf:
+            logger.warning(f'could not leave the lock queue: {wtf}')
+
+    def release(self):
+        """
+        Let go of the lock if we still hold it.
+        """
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+            self._heartbeat = None
+
+        try:
+            self._dynamodb.update_item(
+                TableName=self._table,
+                Key={'lock_key': {'S': self._key}},
+                UpdateExpression='REMOVE holder, expires, acquired',
+                ConditionExpression='holder = :me',
+                ExpressionAttributeValues={':me': {'S': self._owner}}
+            )
+            logger.info(f'lock {self._key} released')
+        except ClientError as wtf:
+            if not _failed_condition(wtf):
+                logger.warning(f'could not release lock {self._key}: {wtf}')
+
+
+class LockState(object):
+    '''
+    What deploy_lock() yields: truthy while the lock is held (or locking is
+    off) and lost once the heartbeat finds someone else holds the lock.
+    '''
+
+    def __init__(self, held, locks=None):
+        self._held = held
+        self._locks = locks or []
+
+    def __bool__(self):
+        return self._held
+
+    @property
+    def lost(self):
+        return any(lock.lost for lock in self._locks)
+
+
+@contextlib.contextmanager
+def deploy_lock(environment, stack_names=None):
+    '''
+    Hold the lock of the stack named in the environment, if locking is
+    turned on, for the body of the with statement.
+
+    Args:
+        environment - the [environment] section (stack_name, region, profile
+                      and optionally lock_table, lock_endpoint, lock_lease
+                      and lock_wait in minutes)
+        stack_names - lock these stacks instead of the one in environment,
+                      they are taken in sorted order so two runners locking
+                      overlapping sets can not deadlock
+
+    Yields:
+        a LockState, True if the lock is held (or locking is off) else False
+    '''
+    table = environment.get('lock_table') or os.environ.get('STACKILITY_LOCK_TABLE')
+    if not table:
+        yield LockState(True)
+        return
+
+    dynamodb = get_client(
+        'dynamodb',
+        environment.get('profile'),
+        environment.get('region'),
+        environment.get('lock_endpoint') or os.environ.get('STACKILITY_LOCK_ENDPOINT')
+    )
+    deadline = time.time() + float(environment.get('lock_wait', DEFAULT_WAIT / 60)) * 60
+    held = []
+    locked = True
+    for stack_name in sorted(set(stack_names or [environment.get('stack_name')])):
+        lock = DeployLock(
+            dynamodb,
+            table,
+            '{}/{}'.format(environment.get('region'), stack_name),
+            int(environment.get('lock_lease', DEFAULT_LEASE))
+        )
+        try:
+            locked = lock.acquire(max(deadline - time.time(), 0))
+        except Exception as wtf:
+            logger.error(f'could not take the deploy lock: {wtf}')
+            locked = False
+
+        if not locked:
+            break
+        held.append(lock)
+
+    try:
+        yield LockState(locked, held)
+    finally:
+        for lock in held:
+            lock.release()
@@ -2,11 +2,17 @@
 Utility to find drift in CloudFormation stacks.
 '''
 import os
+import json
 import time
+import random
+import fnmatch
 import logging
-import boto3
+from botocore.exceptions import ClientError
 from tabulate import tabulate
 
+from stackility.utility.aws_session import get_client
+from stackility.utility.threads import ThreadPoolExecutor
+
 logging.basicConfig(
     level=logging.INFO,
     format='[%(levelname)s] %(asctime)s (%(module)s) %(message)s',
@@ -18,6 +24,26 @@ CALC_DONE_STATES = [
     'DETECTION_COMPLETE'
 ]
 
+DRIFTED_STATES = [
+    'MODIFIED',
+    'DELETED'
+]
+
+# detect_stack_resource_drift() is throttled, keep the fan out modest
+MAX_WORKERS = 8
+MAX_ATTEMPTS = 6
+
+THROTTLED = [
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'RequestLimitExceeded'
+]
+
+# a resource we could not ask about, unlike NOT_CHECKED this fails the run
+CHECK_FAILED = 'CHECK_FAILED'
+NOT_SUPPORTED = 'NOT_SUPPORTED'
+
 
 class DriftTool(object):
     '''
@@ -33,6 +59,8 @@ class DriftTool(object):
 
         Returns:
             kwarg[Profile]: asdasdf
+            kwarg[Types]: only check resources of these types, e.g. AWS::IAM::*
+            kwarg[LogicalIds]: only check these resources
 
         Raises:
             SystemError if thing are not all good
@@ -43,6 +71,8 @@ class DriftTool(object):
             self.nap_time = 15
         self._stack_name = kwargs.get('Stack')
         self._verbose = kwargs.get('Verbose', False)
+        self._types = kwargs.get('Types') or []
+        self._logical_ids = kwargs.get('LogicalIds') or []
         if not self._stack_name:
             logging.error('no stack name given, exiting')
             raise SystemError
@@ -62,17 +92,7 @@ class DriftTool(object):
             Good or Bad; True or False
         """
         try:
-            session = None
-            if profile and region:
-                session = boto3.session.Session(profile_name=profile, region_name=region)
-            elif profile:
-                session = boto3.session.Session(profile_name=profile)
-            elif region:
-                session = boto3.session.Session(region_name=region)
-            else:
-                session = boto3.session.Session()
-
-            self._cloud_formation = session.client('cloudformation')
+            self._cloud_formation = get_client('cloudformation', profile, region)
             return True
         except Exception as wtf:
             logging.error(wtf, exc_info=True)
@@ -88,6 +108,9 @@ class DriftTool(object):
         Returns:
             Good or Bad; True or False
         """
+        if self._types or self._logical_ids:
+            return self._determine_resource_drift()
+
         try:
             response = self._cloud_formation.detect_stack_drift(StackName=self._stack_name)
             drift_request_id = response.get('StackDriftDetectionId', None)
@@ -125,6 +148,145 @@ class DriftTool(object):
             logging.error(wtf, exc_info=True)
             return False
 
+    def _wanted_resources(self):
+        """
+        The resources of the stack that match the --type/--logical-id filters.
+        """
+        wanted = []
+        paginator = self._cloud_formation.get_paginator('list_stack_resources')
+        for page in paginator.paginate(StackName=self._stack_name):
+            for resource in page.get('StackResourceSummaries', []):
+                if self._types and not any(fnmatch.fnmatchcase(resource['ResourceType'], t) for t in self._types):
+                    continue
+                if self._logical_ids and resource['LogicalResourceId'] not in self._logical_ids:
+                    continue
+                wanted.append(resource)
+
+        return wanted
+
+    def _detect_resource_drift(self, resource):
+        """
+        Drift of one resource, backing off when throttled. Resource types
+        without drift detection come back as NOT_SUPPORTED, anything else
+        that goes wrong as CHECK_FAILED.
+        """
+        status = CHECK_FAILED
+        for attempt in range(MAX_ATTEMPTS):
+            try:
+                return self._cloud_formation.detect_stack_resource_drift(
+                    StackName=self._stack_name,
+                    LogicalResourceId=resource['LogicalResourceId']
+                )['StackResourceDrift']
+            except ClientError as wtf:
+                code = wtf.response.get('Error', {}).get('Code')
+                message = wtf.response.get('Error', {}).get('Message', '').lower()
+                if code in THROTTLED or 'rate exceeded' in message:
+                    time.sleep(min(2 ** attempt, 30) * (0.5 + random.random()))
+                    continue
+
+                if 'not supported' in message or 'does not support' in message:
+                    status = NOT_SUPPORTED
+                else:
+                    logging.warning('drift of {} not checked: {}'.format(resource['LogicalResourceId'], wtf))
+                break
+            except Exception as wtf:
+                logging.warning('drift of {} not checked: {}'.format(resource['LogicalResourceId'], wtf))
+                break
+        else:
+            logging.warning('drift of {} not checked: still throttled'.format(resource['LogicalResourceId']))
+
+        return {
+            'LogicalResourceId': resource['LogicalResourceId'],
+            'PhysicalResourceId': resource.get('PhysicalResourceId'),
+            'ResourceType': resource['ResourceType'],
+            'StackResourceDriftStatus': status
+        }
+
+    def _determine_resource_drift(self):
+        """
+        Determine the drift of just the resources matching the filters, many
+        at a time, instead of the whole stack.
+
+        Args:
+            None
+
+        Returns:
+            Good or Bad; True or False
+        """
+        try:
+            resources = self._wanted_resources()
+            if not resources:
+                logging.warning('no resources of {} match the filters'.format(self._stack_name))
+                return False
+
+            logging.info('checking drift of {} resource(s) of {}'.format(len(resources), self._stack_name))
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                drifts = [d for d in executor.map(self._detect_resource_drift, resources)]
+
+            drifted = [d for d in drifts if d.get('StackResourceDriftStatus') in DRIFTED_STATES]
+            failed = [d for d in drifts if d.get('StackResourceDriftStatus') == CHECK_FAILED]
+            unsupported = [d for d in drifts if d.get('StackResourceDriftStatus') == NOT_SUPPORTED]
+            logging.info('drift of {}: {} of {} checked resource(s) drifted'.format(
+                self._stack_name,
+                len(drifted),
+                len(drifts) - len(unsupported) - len(failed)
+            ))
+            if unsupported:
+                logging.info('drift detection is not supported for: {}'.format(
+                    ', '.join(sorted(set(d['ResourceType'] for d in unsupported)))
+                ))
+            if failed:
+                logging.error('drift of {} resource(s) could not be checked'.format(len(failed)))
+
+            if self._verbose:
+                print('Drift Report:')
+                print(tabulate(
+                    [[
+                        d.get('LogicalResourceId', 'unknown'),
+                        d.get('PhysicalResourceId', 'unknown'),
+                        d.get('ResourceType', 'unknown'),
+                        d.get('StackResourceDriftStatus', 'unknown')
+                    ] for d in drifts],
+                    headers=['Logical ID', 'Physical ID', 'Type', 'Drift Info']
+                ))
+                self._print_property_differences(drifted)
+
+            return not drifted and not failed
+        except Exception as wtf:
+            logging.error(wtf, exc_info=True)
+            return False
+
+    @staticmethod
+    def _print_property_differences(drifts):
+        rows = []
+        for drift in drifts:
+            for difference in drift.get('PropertyDifferences', []):
+                rows.append([
+                    drift.get('LogicalResourceId', 'unknown'),
+                    difference.get('PropertyPath'),
+                    difference.get('DifferenceType'),
+                    _short(difference.get('ExpectedValue')),
+                    _short(difference.get('ActualValue'))
+                ])
+
+        if rows:
+            print('\nProperty Differences:')
+            print(tabulate(rows, headers=['Logical ID', 'Property', 'Difference', 'Expected', 'Actual']))
+
+    def _drifted_resources(self):
+        drifts = []
+        request = {
+            'StackName': self._stack_name,
+            'StackResourceDriftStatusFilters': DRIFTED_STATES
+        }
+        while True:
+            response = self._cloud_formation.describe_stack_resource_drifts(**request)
+            drifts.extend(response.get('StackResourceDrifts', []))
+            if not response.get('NextToken'):
+                return drifts
+
+            request['NextToken'] = response['NextToken']
+
     def _print_drift_report(self):
         """
         Report the drift of the stack.
@@ -155,8 +317,21 @@ class DriftTool(object):
                 'Resource Status',
                 'Drift Info'
             ]))
+            self._print_property_differences(self._drifted_resources())
         except Exception as wtf:
             logging.error(wtf, exc_info=True)
             return False
 
         return True
+
+
+def _short(value, limit=60):
+    if value is None:
+        return ''
+
+    try:
+        value = json.dumps(json.loads(value), sort_keys=True)
+    except Exception:
+        pass
+
+    return value if len(value) <= limit else value[:limit - 3] + '...'
@@ -0,0 +1,215 @@
+'''
+Expand one INI file into many upsert targets and deploy them concurrently.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import copy
+import json
+import logging
+import tempfile
+import threading
+
+import jinja2
+from tabulate import tabulate
+
+from stackility.CloudStackUtility import CloudStackUtility
+from stackility.deploy_lock import deploy_lock
+from stackility.utility.threads import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MATRIX = 'matrix'
+TARGET_PREFIX = 'matrix:'
+OVERRIDE_SECTIONS = [
+    'parameters',
+    'tags',
+    'meta-parameters'
+]
+
+
+def expand_matrix(ini_data):
+    """
+    Turn an INI dictionary with [matrix:<name>] sections into one INI
+    dictionary per target. Plain keys in a target section override the
+    [environment] section, keys like parameters.Stage or tags.STAGE override
+    the matching entry of that section.
+
+    Args:
+        ini_data - the dictionary of info read from the INI file
+
+    Returns:
+        a list of (target name, INI dictionary) tuples, empty if the INI file
+        has no matrix.
+    """
+    base = {k: v for k, v in ini_data.items() if k != MATRIX and not k.startswith(TARGET_PREFIX)}
+    targets = []
+    for section in ini_data:
+        if not section.startswith(TARGET_PREFIX):
+            continue
+
+        target_name = section[len(TARGET_PREFIX):]
+        target = copy.deepcopy(base)
+        for key, value in ini_data[section].items():
+            override_section, _, override_key = key.partition('.')
+            if override_section in OVERRIDE_SECTIONS and override_key:
+                target.setdefault(override_section, {})[override_key] = value
+            else:
+                target.setdefault('environment', {})[key] = value
+
+        targets.append((target_name, target))
+
+    return targets
+
+
+class TemplateCache(object):
+    '''
+    Shared by the CloudStackUtility instances of a matrix run so the template
+    is rendered, parsed, analyzed and uploaded once per distinct input rather
+    than once per target (the other targets get a cheap server side copy).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._results = {}
+
+    def _once(self, key, thing_maker):
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            if key not in self._results:
+                self._results[key] = thing_maker()
+
+            return self._results[key]
+
+    def render(self, template_file, context):
+        """
+        Render the Jinja2 template with the given meta-parameters.
+
+        Returns:
+            the path of the rendered template
+        """
+        def renderer():
+            path, filename = os.path.split(template_file)
+            env = jinja2.Environment(loader=jinja2.FileSystemLoader(path or './'))
+            buf = env.get_template(filename).render(context)
+            with tempfile.NamedTemporaryFile(mode='w', suffix='.rdr', delete=False) as tmp:
+                tmp.write(buf)
+                logger.info('template rendered into {}'.format(tmp.name))
+                return tmp.name
+
+        key = ('render', template_file, json.dumps(context, sort_keys=True))
+        return self._once(key, renderer)
+
+    def load(self, template_file, loader):
+        """
+        Load the template with the given loader, loader returns a tuple of
+        the template Parameters and whether it was YAML.
+        """
+        return self._once(('load', template_file), loader)
+
+    def analyze(self, template_file, analysis, analyzer):
+        """
+        Run the static analysis of a template once per analysis configuration.
+        """
+        key = ('analyze', template_file, json.dumps(analysis, sort_keys=True))
+        return self._once(key, analyzer)
+
+    def upload(self, template_file, bucket, stackfile_key, uploader, copier):
+        """
+        Upload the template once per bucket. Every other target gets a server
+        side copy under its own key so each stack's archive is complete and
+        its TemplateURL points into its own prefix.
+
+        Args:
+            template_file - the local template
+            bucket - where it goes
+            stackfile_key - the key of this target's archived template
+            uploader - uploads the template, returns the template URL
+            copier - copies the given key to stackfile_key, returns the
+                     template URL
+
+        Returns:
+            the template URL of this target
+        """
+        url, first_key = self._once(
+            ('upload', template_file, bucket),
+            lambda: (uploader(), stackfile_key)
+        )
+        if first_key == stackfile_key:
+            return url
+
+        return copier(first_key)
+
+
+class MatrixDeploy(object):
+    '''
+    Deploy every target of a matrix INI file concurrently.
+    '''
+
+    def __init__(self, targets, max_workers=None):
+        """
+        Args:
+            targets - a list of (target name, INI dictionary) tuples
+            max_workers - how many targets to deploy at the same time,
+                          defaults to all of them
+        """
+        self._targets = targets
+        self._max_workers = max_workers or max(len(targets), 1)
+        self._cache = TemplateCache()
+
+    def _deploy(self, target_name, ini_data):
+        try:
+            with deploy_lock(ini_data['environment']) as locked:
+                if not locked:
+                    return 'NOT LOCKED'
+
+                return self._deploy_locked(ini_data, locked)
+        except Exception as wtf:
+            logger.error('{}: {}'.format(target_name, wtf), exc_info=True)
+            return 'FAILED'
+
+    def _deploy_locked(self, ini_data, locked=None):
+        stack_driver = CloudStackUtility(ini_data, template_cache=self._cache)
+        stack_driver.hold_lock(locked)
+        if not stack_driver.upsert():
+            return 'START FAILED'
+
+        if ini_data.get('dryrun', False):
+            return 'DRYRUN'
+
+        if ini_data.get('no_poll', False):
+            return 'STARTED'
+
+        if stack_driver.poll_stack():
+            return 'SUCCESS'
+
+        return 'FAILED'
+
+    def deploy(self):
+        """
+        Deploy all the targets.
+
+        Returns:
+            True if every target is good else False
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            futures = [
+                (target_name, ini_data, executor.submit(self._deploy, target_name, ini_data))
+                for target_name, ini_data in self._targets
+            ]
+            rows = []
+            for target_name, ini_data, future in futures:
+                rows.append([
+                    target_name,
+                    ini_data['environment'].get('region'),
+                    ini_data['environment'].get('stack_name'),
+                    future.result()
+                ])
+
+        print('\nMatrix Report:')
+        print(tabulate(rows, headers=['Target', 'Region', 'Stack', 'Result']))
+        return all(row[3] in ['SUCCESS', 'STARTED', 'DRYRUN'] for row in rows)
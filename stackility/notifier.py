@@ -0,0 +1,179 @@
+'''
+Find out a stack is done from the CloudFormation notifications sent to an SNS
+topic instead of polling describe_stacks().
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import re
+import json
+import time
+import uuid
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TOPIC = 'stackility-notifications'
+STACK_RESOURCE = 'AWS::CloudFormation::Stack'
+WAIT_SECONDS = 20
+NOTIFICATION_LINE = re.compile(r"^(\w+)='(.*)'$")
+
+
+def parse_notification(message):
+    '''
+    CloudFormation notifications are lines of Key='value' pairs.
+
+    Args:
+        message - the Message of the SNS notification
+
+    Returns:
+        a dictionary of the pairs
+    '''
+    answer = {}
+    for line in message.splitlines():
+        found = NOTIFICATION_LINE.match(line.strip())
+        if found:
+            answer[found.group(1)] = found.group(2)
+
+    return answer
+
+
+def is_finished(status):
+    return not status.endswith('_IN_PROGRESS') and (status.endswith('COMPLETE') or status.endswith('FAILED'))
+
+
+class StackNotifier(object):
+    '''
+    A per-run SQS queue subscribed to the notification topic. The topic is
+    long lived (it stays in the NotificationARNs of the stacks that use it),
+    the queue and subscription are removed by cleanup().
+    '''
+
+    def __init__(self, sns_client, sqs_client, topic_arn=None):
+        """
+        Args:
+            sns_client - boto3 SNS client
+            sqs_client - boto3 SQS client
+            topic_arn - the notification topic, a topic named
+                        stackility-notifications is created (or found) if
+                        not given
+        """
+        self._sns = sns_client
+        self._sqs = sqs_client
+        self._topic_arn = topic_arn
+        self._queue_url = None
+        self._subscription_arn = None
+
+    def setup(self):
+        """
+        Make the queue and subscribe it to the topic. Do this before starting
+        the stack work so no notification is missed.
+
+        Returns:
+            the topic ARN to put in NotificationARNs
+        """
+        if not self._topic_arn:
+            self._topic_arn = self._sns.create_topic(Name=DEFAULT_TOPIC)['TopicArn']
+
+        queue_name = 'stackility-{}'.format(str(uuid.uuid4())[:8])
+        self._queue_url = self._sqs.create_queue(QueueName=queue_name)['QueueUrl']
+        queue_arn = self._sqs.get_queue_attributes(
+            QueueUrl=self._queue_url,
+            AttributeNames=['QueueArn']
+        )['Attributes']['QueueArn']
+
+        policy = {
+            'Version': '2012-10-17',
+            'Statement': [{
+                'Effect': 'Allow',
+                'Principal': {'Service': 'sns.amazonaws.com'},
+                'Action': 'sqs:SendMessage',
+                'Resource': queue_arn,
+                'Condition': {'ArnEquals': {'aws:SourceArn': self._topic_arn}}
+            }]
+        }
+        self._sqs.set_queue_attributes(
+            QueueUrl=self._queue_url,
+            Attributes={'Policy': json.dumps(policy)}
+        )
+        self._subscription_arn = self._sns.subscribe(
+            TopicArn=self._topic_arn,
+            Protocol='sqs',
+            Endpoint=queue_arn,
+            ReturnSubscriptionArn=True
+        )['SubscriptionArn']
+
+        logger.info('listening for notifications from {} on {}'.format(self._topic_arn, queue_name))
+        return self._topic_arn
+
+    def get_topic_arn(self):
+        return self._topic_arn
+
+    def wait(self, stack_name, timeout):
+        """
+        Long poll the queue for the final notification of the stack.
+
+        Args:
+            stack_name - the stack of interest
+            timeout - give up after this many seconds
+
+        Returns:
+            the final StackStatus or None if it did not show up in time
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            wait_seconds = max(1, min(WAIT_SECONDS, int(deadline - time.time())))
+            response = self._sqs.receive_message(
+                QueueUrl=self._queue_url,
+                MaxNumberOfMessages=10,
+                WaitTimeSeconds=wait_seconds
+            )
+            messages = response.get('Messages', [])
+            if not messages:
+                continue
+
+            self._sqs.delete_message_batch(
+                QueueUrl=self._queue_url,
+                Entries=[
+                    {'Id': str(i), 'ReceiptHandle': m['ReceiptHandle']}
+                    for i, m in enumerate(messages)
+                ]
+            )
+
+            for message in messages:
+                try:
+                    notification = parse_notification(json.loads(message['Body']).get('Message', ''))
+                except Exception:
+                    continue
+
+                if notification.get('StackName') != stack_name:
+                    continue
+
+                status = notification.get('ResourceStatus', '')
+                if notification.get('LogicalResourceId') == stack_name:
+                    logger.info('current status of {}: {}'.format(stack_name, status))
+                    if notification.get('ResourceType') == STACK_RESOURCE and is_finished(status):
+                        return status
+                elif status.endswith('FAILED'):
+                    logger.warning('{} {}: {}'.format(
+                        notification.get('LogicalResourceId'),
+                        status,
+                        notification.get('ResourceStatusReason', '')
+                    ))
+
+        return None
+
+    def cleanup(self):
+        """
+        Remove the subscription and the queue.
+        """
+        try:
+            if self._subscription_arn:
+                self._sns.unsubscribe(SubscriptionArn=self._subscription_arn)
+                self._subscription_arn = None
+
+            if self._queue_url:
+                self._sqs.delete_queue(QueueUrl=self._queue_url)
+                self._queue_url = None
+        except Exception as wtf:
+            logger.warning('notification cleanup did not go well: {}'.format(wtf))
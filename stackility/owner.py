@@ -0,0 +1,220 @@
+'''
+Utility to find the stack that owns a physical resource, e.g. a security group
+or a bucket, from a local index of every stack in a region.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import json
+import time
+import logging
+from tabulate import tabulate
+
+from stackility.utility.aws_session import get_client
+from stackility.utility.threads import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIRECTORY = os.path.join(os.path.expanduser('~'), '.stackility')
+MAX_WORKERS = 8
+
+
+def _short_name(physical_id):
+    '''
+    The last part of an ARN or path, so arn:aws:iam::123:role/foo finds foo.
+    '''
+    return physical_id.replace(':', '/').rstrip('/').split('/')[-1]
+
+
+class OwnerTool(object):
+    '''
+    Keeps an index of physical ID to (stack, logical ID, type) for a region on
+    disk. A refresh walks list_stacks() once and only lists the resources of
+    stacks that changed since the last refresh, concurrently.
+    '''
+
+    def __init__(self, **kwargs):
+        """
+        The initializer sets up stuff to do the work
+
+        Args:
+            kwarg[Region]: region of the stacks
+            kwarg[Profile]: AWS profile to access resources
+            kwarg[MaxAge]: refresh the index if it is older than this many seconds
+            kwarg[Refresh]: refresh the index no matter how old it is
+
+        Raises:
+            SystemError if thing are not all good
+        """
+        self._region = kwargs.get('Region')
+        self._max_age = kwargs.get('MaxAge', 300)
+        self._refresh = kwargs.get('Refresh', False)
+        self._index_file = os.path.join(
+            INDEX_DIRECTORY,
+            'owner-index-{}-{}.json'.format(kwargs.get('Profile') or 'default', self._region)
+        )
+        if not self._init_boto3_clients(kwargs.get('Profile'), kwargs.get('Region')):
+            logger.error('client initialization failed, exiting')
+            raise SystemError
+
+    def _init_boto3_clients(self, profile, region):
+        """
+        The utililty requires boto3 clients to CloudFormation.
+
+        Args:
+            None
+
+        Returns:
+            Good or Bad; True or False
+        """
+        try:
+            self._cloud_formation = get_client('cloudformation', profile, region)
+            return True
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
+
+    def _read_index(self):
+        try:
+            with open(self._index_file) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as wtf:
+            logger.warning(f'ignoring unreadable index {self._index_file}: {wtf}')
+
+        return {'refreshed': 0, 'stacks': {}}
+
+    def _write_index(self, index):
+        os.makedirs(INDEX_DIRECTORY, mode=0o700, exist_ok=True)
+        scratch = self._index_file + '.tmp'
+        with open(scratch, 'w') as f:
+            json.dump(index, f)
+        os.replace(scratch, self._index_file)
+
+    def _stack_resources(self, stack_id):
+        resources = []
+        paginator = self._cloud_formation.get_paginator('list_stack_resources')
+        for page in paginator.paginate(StackName=stack_id):
+            for resource in page.get('StackResourceSummaries', []):
+                if resource.get('PhysicalResourceId'):
+                    resources.append([
+                        resource['PhysicalResourceId'],
+                        resource['LogicalResourceId'],
+                        resource['ResourceType']
+                    ])
+
+        return resources
+
+    def refresh(self, index):
+        """
+        Bring the index up to date.
+
+        Args:
+            index - the index read from disk
+
+        Returns:
+            the refreshed index
+        """
+        current = {}
+        paginator = self._cloud_formation.get_paginator('list_stacks')
+        for page in paginator.paginate():
+            for summary in page.get('StackSummaries', []):
+                if summary['StackStatus'] == 'DELETE_COMPLETE':
+                    continue
+
+                status = summary['StackStatus']
+                changed = summary.get('LastUpdatedTime') or summary.get('CreationTime')
+                current[summary['StackId']] = {
+                    'name': summary['StackName'],
+                    'version': '{}|{}'.format(changed.isoformat() if changed else '', status),
+                    'busy': status.endswith('_IN_PROGRESS')
+                }
+
+        known = index.get('stacks', {})
+        stale = [
+            stack_id for stack_id, summary in current.items()
+            if summary['busy'] or known.get(stack_id, {}).get('version') != summary['version']
+        ]
+        logger.info(f'{len(current)} stack(s) in {self._region}, {len(stale)} to index')
+
+        stacks = {stack_id: known[stack_id] for stack_id in current if stack_id not in stale}
+        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            futures = [(stack_id, executor.submit(self._stack_resources, stack_id)) for stack_id in stale]
+            for stack_id, future in futures:
+                try:
+                    resources = future.result()
+                except Exception as wtf:
+                    logger.warning(f'could not list the resources of {current[stack_id]["name"]}: {wtf}')
+                    continue
+
+                stacks[stack_id] = {
+                    'name': current[stack_id]['name'],
+                    'version': current[stack_id]['version'],
+                    'resources': resources
+                }
+
+        return {'refreshed': time.time(), 'stacks': stacks}
+
+    def get_index(self):
+        """
+        The index, refreshed if it is too old.
+        """
+        index = self._read_index()
+        if self._refresh or time.time() - index.get('refreshed', 0) > self._max_age:
+            index = self.refresh(index)
+            self._write_index(index)
+        else:
+            logger.info('using the index from {:.0f} seconds ago'.format(time.time() - index['refreshed']))
+
+        return index
+
+    @staticmethod
+    def lookup(index, physical_ids):
+        """
+        Find the owners of the given physical IDs. A physical ID that is not
+        found as is is matched on its last ARN/path part.
+
+        Args:
+            index - the index
+            physical_ids - list of physical IDs, names or ARNs
+
+        Returns:
+            list of [physical ID, stack, logical ID, type] rows
+        """
+        exact = {}
+        short = {}
+        for stack in index.get('stacks', {}).values():
+            for physical_id, logical_id, resource_type in stack.get('resources', []):
+                row = [physical_id, stack['name'], logical_id, resource_type]
+                exact.setdefault(physical_id, []).append(row)
+                short.setdefault(_short_name(physical_id), []).append(row)
+
+        rows = []
+        for wanted in physical_ids:
+            found = exact.get(wanted) or short.get(_short_name(wanted))
+            if found:
+                rows.extend(found)
+            else:
+                rows.append([wanted, None, None, None])
+
+        return rows
+
+    def find_owners(self, physical_ids):
+        """
+        Print the stacks owning the given physical IDs.
+
+        Returns:
+            True if every physical ID was found else False
+        """
+        try:
+            rows = self.lookup(self.get_index(), physical_ids)
+            print(tabulate(
+                [[r[0], r[1] or 'not found', r[2] or '', r[3] or ''] for r in rows],
+                headers=['Physical ID', 'Stack', 'Logical ID', 'Type']
+            ))
+            return all(r[1] for r in rows)
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
@@ -0,0 +1,337 @@
+'''
+Package the local artifacts of a template: Lambda code directories, nested
+templates and the like are zipped (or taken as is), uploaded to S3 under the
+hash of their content and the template is rewritten to point at them.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import stat
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+import zipfile
+
+import yaml
+
+from stackility.utility.threads import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS = 8
+CHUNK_SIZE = 1024 * 1024
+SPOOL_SIZE = 64 * 1024 * 1024
+ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+
+# how the S3 location is written back into the template
+S3_URI = 's3-uri'
+HTTPS_URL = 'https-url'
+BUCKET_KEY = 'S3Bucket/S3Key'
+BUCKET_KEY_SHORT = 'Bucket/Key'
+
+# resource type -> list of (property, zip directories, how to write it back)
+PACKAGEABLE = {
+    'AWS::Lambda::Function': [('Code', True, BUCKET_KEY)],
+    'AWS::Lambda::LayerVersion': [('Content', True, BUCKET_KEY)],
+    'AWS::Serverless::Function': [('CodeUri', True, S3_URI)],
+    'AWS::Serverless::LayerVersion': [('ContentUri', True, S3_URI)],
+    'AWS::Serverless::Api': [('DefinitionUri', False, S3_URI)],
+    'AWS::Serverless::HttpApi': [('DefinitionUri', False, S3_URI)],
+    'AWS::Serverless::StateMachine': [('DefinitionUri', False, S3_URI)],
+    'AWS::ApiGateway::RestApi': [('BodyS3Location', False, BUCKET_KEY_SHORT)],
+    'AWS::StepFunctions::StateMachine': [('DefinitionS3Location', False, BUCKET_KEY_SHORT)],
+    'AWS::CloudFormation::Stack': [('TemplateURL', False, HTTPS_URL)],
+    'AWS::Serverless::Application': [('Location', False, HTTPS_URL)]
+}
+
+NESTED_TEMPLATES = ['AWS::CloudFormation::Stack', 'AWS::Serverless::Application']
+
+
+class Tagged(object):
+    '''
+    A YAML node with a short form intrinsic function tag (!Ref, !Sub, ...)
+    kept as is so the template can be written back out.
+    '''
+    def __init__(self, tag, value):
+        self.tag = tag
+        self.value = value
+
+
+class _TaggedLoader(yaml.SafeLoader):
+    pass
+
+
+class _TaggedDumper(yaml.SafeDumper):
+    pass
+
+
+def _construct_tagged(loader, tag_suffix, node):
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+
+    return Tagged('!' + tag_suffix, value)
+
+
+def _represent_tagged(dumper, tagged):
+    if isinstance(tagged.value, list):
+        return dumper.represent_sequence(tagged.tag, tagged.value)
+    if isinstance(tagged.value, dict):
+        return dumper.represent_mapping(tagged.tag, tagged.value)
+
+    return dumper.represent_scalar(tagged.tag, tagged.value)
+
+
+_TaggedLoader.add_multi_constructor('!', _construct_tagged)
+_TaggedDumper.add_representer(Tagged, _represent_tagged)
+
+
+def load_template(template_file):
+    '''
+    Read a template so it can be changed and written back out.
+
+    Returns:
+        a tuple of the template and True if it is YAML
+    '''
+    with open(template_file) as f:
+        body = f.read()
+
+    try:
+        return json.loads(body), False
+    except ValueError:
+        return yaml.load(body, Loader=_TaggedLoader), True
+
+
+def dump_template(template, is_yaml, stream):
+    if is_yaml:
+        yaml.dump(template, stream, Dumper=_TaggedDumper, default_flow_style=False, sort_keys=False)
+    else:
+        json.dump(template, stream, indent=2)
+
+
+def _walk(path):
+    '''
+    Files under a directory in a stable order as (full path, archive name).
+    '''
+    if os.path.isfile(path):
+        yield path, os.path.basename(path)
+        return
+
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            full_path = os.path.join(root, name)
+            yield full_path, os.path.relpath(full_path, path).replace(os.sep, '/')
+
+
+def _mode(full_path):
+    return 0o755 if os.stat(full_path).st_mode & stat.S_IXUSR else 0o644
+
+
+def content_hash(path, zipped):
+    '''
+    The SHA-256 of what would be uploaded for the path, computed from the
+    file names, modes and contents without building anything.
+    '''
+    digest = hashlib.sha256()
+    digest.update(b'zip' if zipped else b'file')
+    for full_path, name in _walk(path):
+        if zipped:
+            digest.update('{}\0{:o}\0'.format(name, _mode(full_path)).encode('utf-8'))
+
+        with open(full_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def build_zip(path):
+    '''
+    Stream the path into a zip with fixed timestamps and ordering so the
+    same content always makes the same bytes.
+
+    Returns:
+        a file object positioned at the start of the zip
+    '''
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    with zipfile.ZipFile(spool, 'w', zipfile.ZIP_DEFLATED) as archive:
+        for full_path, name in _walk(path):
+            info = zipfile.ZipInfo(name, ZIP_DATE)
+            info.external_attr = (stat.S_IFREG | _mode(full_path)) << 16
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with open(full_path, 'rb') as source, archive.open(info, 'w') as target:
+                shutil.copyfileobj(source, target, CHUNK_SIZE)
+
+    spool.seek(0)
+    return spool
+
+
+class ArtifactPackager(object):
+    '''
+    Find local paths in a template, upload what they point at and rewrite
+    the template. Artifacts already in the bucket are not uploaded again.
+    '''
+
+    def __init__(self, s3_client, bucket, prefix='artifacts', max_workers=MAX_WORKERS, upload=True):
+        """
+        Args:
+            s3_client - boto3 S3 client
+            bucket - where the artifacts go
+            prefix - key prefix of the artifacts
+            max_workers - number of uploads running at the same time
+            upload - False to rewrite the template without touching S3, the
+                     keys are the content hashes either way
+        """
+        self._s3 = s3_client
+        self._bucket = bucket
+        self._prefix = prefix.strip('/')
+        self._max_workers = max_workers
+        self._upload_wanted = upload
+        self._lock = threading.Lock()
+        self._uploads = {}
+        self.uploaded = 0
+        self.skipped = 0
+
+    def _exists(self, key):
+        try:
+            self._s3.head_object(Bucket=self._bucket, Key=key)
+            return True
+        except Exception:
+            return False
+
+    def _upload(self, path, zipped, extension):
+        """
+        Upload one artifact unless it is already there.
+
+        Returns:
+            the S3 key of the artifact
+        """
+        key = '{}/{}{}'.format(self._prefix, content_hash(path, zipped), extension)
+        if not self._upload_wanted:
+            return key
+
+        if self._exists(key):
+            logger.info('{} is already in s3://{}/{}'.format(path, self._bucket, key))
+            with self._lock:
+                self.skipped += 1
+            return key
+
+        logger.info('uploading {} to s3://{}/{}'.format(path, self._bucket, key))
+        if zipped:
+            with build_zip(path) as body:
+                self._s3.upload_fileobj(body, self._bucket, key)
+        else:
+            self._s3.upload_file(path, self._bucket, key)
+
+        with self._lock:
+            self.uploaded += 1
+        return key
+
+    def _submit(self, executor, path, zipped, extension):
+        with self._lock:
+            wanted = (path, zipped)
+            if wanted not in self._uploads:
+                self._uploads[wanted] = executor.submit(self._upload, path, zipped, extension)
+
+            return self._uploads[wanted]
+
+    def _location(self, key, style):
+        if style == S3_URI:
+            return 's3://{}/{}'.format(self._bucket, key)
+        if style == HTTPS_URL:
+            return 'https://s3.amazonaws.com/{}/{}'.format(self._bucket, key)
+        if style == BUCKET_KEY:
+            return {'S3Bucket': self._bucket, 'S3Key': key}
+
+        return {'Bucket': self._bucket, 'Key': key}
+
+    def _local_path(self, value, base_directory):
+        if not isinstance(value, str) or '://' in value:
+            return None
+
+        path = os.path.normpath(os.path.join(base_directory, value))
+        return path if os.path.exists(path) else None
+
+    def _package_template(self, executor, template_file, base_directory):
+        """
+        Rewrite one template, nested templates are packaged first.
+
+        Returns:
+            a tuple of the rewritten template, True if it is YAML and the
+            number of artifacts found
+        """
+        template, is_yaml = load_template(template_file)
+        pending = []
+        for logical_id, resource in (template.get('Resources') or {}).items():
+            if not isinstance(resource, dict):
+                continue
+
+            resource_type = resource.get('Type')
+            properties = resource.get('Properties') or {}
+            for name, zip_directories, style in PACKAGEABLE.get(resource_type, []):
+                path = self._local_path(properties.get(name), base_directory)
+                if not path:
+                    continue
+
+                if resource_type in NESTED_TEMPLATES and os.path.isfile(path):
+                    path = self._package_nested(executor, path)
+
+                zipped = zip_directories and not (os.path.isfile(path) and path.endswith(('.zip', '.jar')))
+                extension = '.zip' if zipped else os.path.splitext(path)[1]
+                logger.info('{}.{} is local: {}'.format(logical_id, name, path))
+                pending.append((properties, name, style, self._submit(executor, path, zipped, extension)))
+
+        for properties, name, style, future in pending:
+            properties[name] = self._location(future.result(), style)
+
+        return template, is_yaml, len(pending)
+
+    def _package_nested(self, executor, template_file):
+        template, is_yaml, count = self._package_template(
+            executor,
+            template_file,
+            os.path.dirname(template_file)
+        )
+        if not count:
+            return template_file
+
+        suffix = '.yaml' if is_yaml else '.json'
+        with tempfile.NamedTemporaryFile(mode='w', suffix=suffix, delete=False) as tmp:
+            dump_template(template, is_yaml, tmp)
+            return tmp.name
+
+    def package(self, template_file, base_directory):
+        """
+        Package the artifacts of the template.
+
+        Args:
+            template_file - the template
+            base_directory - where relative paths in the template start from
+
+        Returns:
+            the name of the rewritten template or the given one if there was
+            nothing to package
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            template, is_yaml, count = self._package_template(executor, template_file, base_directory)
+
+        logger.info('{} artifact(s): {} uploaded, {} already in the bucket'.format(
+            count,
+            self.uploaded,
+            self.skipped
+        ))
+        if not count:
+            return template_file
+
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.pkg', delete=False) as tmp:
+            dump_template(template, is_yaml, tmp)
+            logger.info('packaged template written to {}'.format(tmp.name))
+            return tmp.name
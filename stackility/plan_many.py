@@ -0,0 +1,182 @@
+'''
+Plan the changes of many stacks at once: create a change set for every INI
+file concurrently, wait for all of them in one loop, print one report and
+delete the change sets again.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import time
+import logging
+
+import click
+from tabulate import tabulate
+
+from stackility.CloudStackUtility import CloudStackUtility
+from stackility.CloudStackUtility import no_change_reasons
+from stackility.matrix import TemplateCache
+from stackility.utility.threads import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WORKERS = 10
+CHANGE_SET_DONE = ['CREATE_COMPLETE', 'FAILED', 'DELETE_COMPLETE', 'DELETE_FAILED']
+
+try:
+    POLL_INTERVAL = int(os.environ.get('CSU_POLL_INTERVAL', 5))
+except ValueError:
+    POLL_INTERVAL = 5
+
+
+class FleetPlan(object):
+    '''
+    The change sets of many stacks, one per target.
+    '''
+
+    def __init__(self, targets, max_workers=None):
+        """
+        Args:
+            targets - a list of (target name, INI dictionary) tuples
+            max_workers - how many change sets to prepare at the same time
+        """
+        self._targets = targets
+        self._max_workers = max_workers or DEFAULT_WORKERS
+        self._cache = TemplateCache()
+        self._plans = []
+
+    def _new_plan(self, target_name, ini_data):
+        return {
+            'target': target_name,
+            'region': ini_data['environment'].get('region'),
+            'stack': ini_data['environment'].get('stack_name'),
+            'ini_data': ini_data,
+            'driver': None,
+            'set_id': None,
+            'status': 'START FAILED',
+            'changes': []
+        }
+
+    def _create(self, plan):
+        """
+        Create the change set of one plan, the set ID lands in the plan as
+        soon as there is one so it gets cleaned up whatever happens next.
+        """
+        try:
+            plan['ini_data']['plan'] = True
+            plan['driver'] = CloudStackUtility(plan['ini_data'], template_cache=self._cache)
+            plan['set_id'] = plan['driver'].create_change_set()
+            if plan['set_id']:
+                plan['status'] = 'CREATE_PENDING'
+        except Exception as wtf:
+            logger.error('{}: {}'.format(plan['target'], wtf), exc_info=True)
+
+    def _describe(self, plan):
+        """
+        One look at a change set, all the pages of changes once it is done.
+        """
+        cf = plan['driver'].get_cloud_formation_client()
+        response = cf.describe_change_set(ChangeSetName=plan['set_id'])
+        plan['status'] = response.get('Status', 'UNKNOWN')
+        if plan['status'] not in CHANGE_SET_DONE:
+            return
+
+        plan['reason'] = response.get('StatusReason', '')
+        changes = response.get('Changes', [])
+        while response.get('NextToken'):
+            response = cf.describe_change_set(ChangeSetName=plan['set_id'], NextToken=response['NextToken'])
+            changes.extend(response.get('Changes', []))
+
+        plan['changes'] = [c.get('ResourceChange', {}) for c in changes if c.get('Type') == 'Resource']
+        if plan['status'] == 'FAILED' and any(n in plan['reason'] for n in no_change_reasons):
+            plan['status'] = 'NO CHANGES'
+
+    def _wait(self):
+        """
+        Poll every pending change set in one loop until they are all done.
+        """
+        pending = [p for p in self._plans if p['set_id']]
+        while pending:
+            for plan in pending:
+                try:
+                    self._describe(plan)
+                except Exception as wtf:
+                    logger.error('{}: {}'.format(plan['target'], wtf))
+                    plan['status'] = 'UNKNOWN'
+
+            pending = [p for p in pending if p['status'] not in CHANGE_SET_DONE + ['NO CHANGES', 'UNKNOWN']]
+            if pending:
+                logger.info('waiting for {} change set(s)'.format(len(pending)))
+                time.sleep(POLL_INTERVAL)
+
+    def _cleanup(self, plan):
+        """
+        Delete the change set, and the empty REVIEW_IN_PROGRESS stack a
+        change set for a new stack leaves behind.
+        """
+        if not plan['set_id']:
+            return
+
+        cf = plan['driver'].get_cloud_formation_client()
+        try:
+            cf.delete_change_set(ChangeSetName=plan['set_id'])
+            if not plan['driver'].is_update():
+                cf.delete_stack(StackName=plan['stack'])
+        except Exception as wtf:
+            logger.warning('could not clean up the change set of {}: {}'.format(plan['target'], wtf))
+
+    def _report(self):
+        rows = []
+        replacements = []
+        for plan in self._plans:
+            actions = [c.get('Action') for c in plan['changes']]
+            replaced = [c for c in plan['changes'] if c.get('Replacement') in ['True', 'Conditional']]
+            rows.append([
+                plan['target'],
+                plan['region'],
+                plan['stack'],
+                plan['status'],
+                actions.count('Add'),
+                actions.count('Modify'),
+                actions.count('Remove'),
+                click.style(str(len(replaced)), fg='red', bold=True) if replaced else 0
+            ])
+            for change in replaced:
+                replacements.append([
+                    plan['stack'],
+                    change.get('LogicalResourceId'),
+                    change.get('ResourceType'),
+                    click.style(change.get('Replacement'), fg='red', bold=True)
+                ])
+
+        click.echo('\nPlan Report:')
+        click.echo(tabulate(rows, headers=['Target', 'Region', 'Stack', 'Status', 'Add', 'Modify', 'Remove', 'Replace']))
+        if replacements:
+            click.echo('\nReplacements:')
+            click.echo(tabulate(replacements, headers=['Stack', 'Logical ID', 'Type', 'Replacement']))
+
+        for plan in self._plans:
+            if plan['status'] == 'FAILED':
+                click.echo('\n{}: {}'.format(plan['target'], plan.get('reason')))
+
+    def plan(self):
+        """
+        Plan all the targets.
+
+        Returns:
+            True if every change set was computed else False
+        """
+        self._plans = [self._new_plan(target_name, ini_data) for target_name, ini_data in self._targets]
+        try:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                for plan in self._plans:
+                    executor.submit(self._create, plan)
+
+            self._wait()
+        finally:
+            with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+                for plan in self._plans:
+                    executor.submit(self._cleanup, plan)
+
+        self._report()
+        return all(p['status'] in ['CREATE_COMPLETE', 'NO CHANGES'] for p in self._plans)
@@ -0,0 +1,254 @@
+'''
+Utility to prune the templates and parameters archived in S3 by upsert.
+
+Every upsert writes templates/<stack>/<version>/<yyyy>/<mm>/<dd>/<hh:mm:ss>/
+and nothing ever cleans up, this keeps the last N archives and/or the ones
+of the last N days of each stack.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import time
+import calendar
+import fnmatch
+import logging
+from botocore.exceptions import ClientError
+from tabulate import tabulate
+
+from stackility.utility.aws_session import get_client
+from stackility.utility.threads import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+ARCHIVE_ROOT = 'templates/'
+VERSION_TAG = 'CODE_VERSION_SD'
+DELETE_BATCH = 1000
+MAX_WORKERS = 8
+
+
+def parse_archive_key(key):
+    """
+    Pull the stack, version and time out of an archive key.
+
+    Args:
+        key - e.g. templates/my-stack/42/2024/01/31/12:00:00/stack.json
+
+    Returns:
+        a tuple of (stack, version, archive prefix, epoch seconds) or None if
+        the key is not an archive key
+    """
+    parts = key.split('/')
+    if len(parts) < 8 or parts[0] != ARCHIVE_ROOT.rstrip('/'):
+        return None
+
+    try:
+        when = calendar.timegm(time.strptime('/'.join(parts[-5:-1]), '%Y/%m/%d/%H:%M:%S'))
+    except ValueError:
+        return None
+
+    return parts[1], '/'.join(parts[2:-5]), '/'.join(parts[:-1]) + '/', when
+
+
+class PruneTool(object):
+    '''
+    Utility to prune the archives of many stacks. The newest archive of a
+    stack is always kept and so are the versions the live stacks of that
+    name were deployed with (the CODE_VERSION_SD tag) in any of the regions,
+    they all archive under the same key. A stack whose live version cannot
+    be told is not pruned at all.
+    '''
+
+    def __init__(self, **kwargs):
+        """
+        The initializer sets up stuff to do the work
+
+        Args:
+            kwarg[Bucket]: the bucket holding the archives
+            kwarg[Keep]: keep this many archives per stack
+            kwarg[Days]: keep the archives of this many days
+            kwarg[Stacks]: shell style patterns of the stacks to prune
+            kwarg[DryRun]: only report what would be deleted
+            kwarg[Regions]: regions where the stacks live, default every
+                            region enabled for the account
+            kwarg[Region]: region to ask for the enabled regions
+            kwarg[Profile]: AWS profile to access resources
+
+        Raises:
+            SystemError if thing are not all good
+        """
+        self._bucket = kwargs.get('Bucket')
+        self._keep = kwargs.get('Keep')
+        self._days = kwargs.get('Days')
+        self._patterns = kwargs.get('Stacks') or ['*']
+        self._dry_run = kwargs.get('DryRun', False)
+        if not self._bucket or (self._keep is None and self._days is None):
+            logger.error('a bucket and --keep and/or --days are required, exiting')
+            raise SystemError
+
+        if not self._init_boto3_clients(kwargs.get('Profile'), kwargs.get('Region'), kwargs.get('Regions')):
+            logger.error('client initialization failed, exiting')
+            raise SystemError
+
+    def _init_boto3_clients(self, profile, region, regions):
+        """
+        The utililty requires boto3 clients to S3 and CloudFormation in
+        every region.
+
+        Args:
+            None
+
+        Returns:
+            Good or Bad; True or False
+        """
+        try:
+            self._s3 = get_client('s3', profile)
+            if not regions:
+                ec2 = get_client('ec2', profile, region)
+                regions = [r['RegionName'] for r in ec2.describe_regions()['Regions']]
+
+            self._cloud_formations = [get_client('cloudformation', profile, r) for r in sorted(set(regions))]
+            logger.info('looking for live stacks in {}'.format(', '.join(sorted(set(regions)))))
+            return True
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
+
+    def _archived_stacks(self):
+        stacks = []
+        paginator = self._s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket, Prefix=ARCHIVE_ROOT, Delimiter='/'):
+            for prefix in page.get('CommonPrefixes', []):
+                stack_name = prefix['Prefix'][len(ARCHIVE_ROOT):].rstrip('/')
+                if any(fnmatch.fnmatch(stack_name, p) for p in self._patterns):
+                    stacks.append(stack_name)
+
+        return stacks
+
+    def _archives(self, stack_name):
+        """
+        Returns:
+            dict of archive prefix to (version, epoch seconds, [keys])
+        """
+        archives = {}
+        paginator = self._s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self._bucket, Prefix='{}{}/'.format(ARCHIVE_ROOT, stack_name)):
+            for thing in page.get('Contents', []):
+                parsed = parse_archive_key(thing['Key'])
+                if parsed:
+                    _, version, prefix, when = parsed
+                    archives.setdefault(prefix, (version, when, []))[2].append(thing['Key'])
+
+        return archives
+
+    def _live_tags(self, cloud_formation, stack_name):
+        """
+        The tags of the live stack (or stack set) in one region, None if
+        there is no such thing there. Anything but a clear "not there" is
+        raised.
+        """
+        try:
+            return cloud_formation.describe_stacks(StackName=stack_name)['Stacks'][0].get('Tags', [])
+        except ClientError as wtf:
+            if str(wtf).find('does not exist') == -1:
+                raise
+
+        try:
+            return cloud_formation.describe_stack_set(StackSetName=stack_name)['StackSet'].get('Tags', [])
+        except ClientError as wtf:
+            if wtf.response.get('Error', {}).get('Code') != 'StackSetNotFoundException':
+                raise
+
+        return None
+
+    def _live_versions(self, stack_name):
+        """
+        The code versions the live stacks (or stack sets) of this name were
+        deployed with, across the regions.
+
+        Returns:
+            a set of versions, or None if a region could not tell
+        """
+        versions = set()
+        for cloud_formation in self._cloud_formations:
+            try:
+                tags = self._live_tags(cloud_formation, stack_name)
+            except Exception as wtf:
+                logger.warning('skipping {}, could not tell its live version in {}: {}'.format(
+                    stack_name,
+                    cloud_formation.meta.region_name,
+                    wtf
+                ))
+                return None
+
+            versions.update(t['Value'] for t in tags or [] if t['Key'] == VERSION_TAG)
+
+        return versions
+
+    def _doomed(self, stack_name):
+        """
+        Decide what goes for one stack.
+
+        Returns:
+            a tuple of (report row, keys to delete)
+        """
+        archives = self._archives(stack_name)
+        live_versions = self._live_versions(stack_name)
+        if live_versions is None:
+            return [stack_name, 'unknown', len(archives), len(archives), 0, 0], []
+
+        newest_first = sorted(archives.items(), key=lambda a: a[1][1], reverse=True)
+        cutoff = time.time() - self._days * 86400 if self._days is not None else None
+
+        doomed = []
+        pruned = 0
+        for i, (prefix, (version, when, keys)) in enumerate(newest_first):
+            keep = i == 0 or version in live_versions
+            keep = keep or (self._keep is not None and i < self._keep)
+            keep = keep or (cutoff is not None and when >= cutoff)
+            if not keep:
+                pruned += 1
+                doomed.extend(keys)
+
+        row = [stack_name, ', '.join(sorted(live_versions)) or '-', len(archives), len(archives) - pruned, pruned, len(doomed)]
+        return row, doomed
+
+    def _delete(self, keys):
+        response = self._s3.delete_objects(
+            Bucket=self._bucket,
+            Delete={'Objects': [{'Key': k} for k in keys], 'Quiet': True}
+        )
+        for ruh_roh in response.get('Errors', []):
+            logger.error('could not delete {}: {}'.format(ruh_roh.get('Key'), ruh_roh.get('Message')))
+
+        return len(response.get('Errors', []))
+
+    def prune(self):
+        """
+        Prune the archives of every stack that matches.
+
+        Returns:
+            True if every doomed key was deleted else False
+        """
+        try:
+            stacks = self._archived_stacks()
+            logger.info('{} stack(s) have archives in s3://{}/{}'.format(len(stacks), self._bucket, ARCHIVE_ROOT))
+            with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                results = [r for r in executor.map(self._doomed, stacks)]
+
+            doomed = [k for _, keys in results for k in keys]
+            failed = 0
+            if doomed and not self._dry_run:
+                batches = [doomed[i:i + DELETE_BATCH] for i in range(0, len(doomed), DELETE_BATCH)]
+                logger.info('deleting {} object(s) in {} batch(es)'.format(len(doomed), len(batches)))
+                with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    failed = sum(executor.map(self._delete, batches))
+
+            print('Prune Report{}:'.format(' (dry run, nothing deleted)' if self._dry_run else ''))
+            print(tabulate(
+                [row for row, _ in results],
+                headers=['Stack', 'Live Versions', 'Archives', 'Kept', 'Pruned', 'Objects']
+            ))
+            return failed == 0
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
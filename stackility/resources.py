@@ -5,9 +5,10 @@ import sys
 import datetime
 import json
 import logging
-import boto3
 from tabulate import tabulate
 
+from stackility.utility.aws_session import get_client
+
 logging.basicConfig(
     level=logging.INFO,
     format='[%(levelname)s] %(asctime)s (%(module)s) %(message)s',
@@ -74,17 +75,7 @@ class ResourceTool(object):
             Good or Bad; True or False
         """
         try:
-            session = None
-            if profile and region:
-                session = boto3.session.Session(profile_name=profile, region_name=region)
-            elif profile:
-                session = boto3.session.Session(profile_name=profile)
-            elif region:
-                session = boto3.session.Session(region_name=region)
-            else:
-                session = boto3.session.Session()
-
-            self._cloud_formation = session.client('cloudformation')
+            self._cloud_formation = get_client('cloudformation', profile, region)
             return True
         except Exception as wtf:
             logging.error(wtf, exc_info=True)
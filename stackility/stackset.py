@@ -0,0 +1,232 @@
+'''
+Roll a template out to many accounts and regions as a CloudFormation StackSet,
+driven by the [stackset] section of the INI file.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import time
+import uuid
+import logging
+from botocore.exceptions import ClientError
+from tabulate import tabulate
+
+logger = logging.getLogger(__name__)
+
+try:
+    POLL_INTERVAL = int(os.environ.get('CSU_POLL_INTERVAL', 30))
+except Exception:
+    POLL_INTERVAL = 30
+
+CAPABILITIES = ['CAPABILITY_IAM', 'CAPABILITY_NAMED_IAM', 'CAPABILITY_AUTO_EXPAND']
+DONE_STATES = ['SUCCEEDED', 'FAILED', 'STOPPED']
+
+# INI option -> OperationPreferences key and type
+PREFERENCES = {
+    'max_concurrent_count': ('MaxConcurrentCount', int),
+    'max_concurrent_percentage': ('MaxConcurrentPercentage', int),
+    'failure_tolerance_count': ('FailureToleranceCount', int),
+    'failure_tolerance_percentage': ('FailureTolerancePercentage', int),
+    'region_concurrency': ('RegionConcurrencyType', str),
+    'concurrency_mode': ('ConcurrencyMode', str)
+}
+
+
+def _split(value):
+    return [x.strip() for x in (value or '').replace('\n', ',').split(',') if x.strip()]
+
+
+class StackSetDeploy(object):
+    '''
+    Create or update a StackSet and its instances, then follow every
+    operation that was started from one polling loop.
+
+    The [stackset] section:
+        accounts - comma separated account IDs
+        organizational_units - comma separated OU IDs (SERVICE_MANAGED)
+        regions - comma separated regions, also the region order
+        permission_model - SELF_MANAGED (default) or SERVICE_MANAGED
+        administration_role_arn, execution_role_name - SELF_MANAGED roles
+        max_concurrent_count | max_concurrent_percentage
+        failure_tolerance_count | failure_tolerance_percentage
+        region_concurrency - SEQUENTIAL or PARALLEL
+        concurrency_mode - STRICT_FAILURE_TOLERANCE or SOFT_FAILURE_TOLERANCE
+    '''
+
+    def __init__(self, cloud_formation, stack_set_name, settings):
+        """
+        Args:
+            cloud_formation - boto3 CloudFormation client
+            stack_set_name - name of the StackSet
+            settings - the [stackset] section
+
+        Raises:
+            SystemError if the section does not say where to deploy
+        """
+        self._cloud_formation = cloud_formation
+        self._name = stack_set_name
+        self._settings = settings
+        self._accounts = _split(settings.get('accounts'))
+        self._organizational_units = _split(settings.get('organizational_units'))
+        self._regions = _split(settings.get('regions'))
+        self._service_managed = settings.get('permission_model', 'SELF_MANAGED').upper() == 'SERVICE_MANAGED'
+        self._operations = []
+        if not self._regions or not (self._accounts or self._organizational_units):
+            logger.error('[stackset] needs regions and accounts or organizational_units')
+            raise SystemError
+
+    def _preferences(self):
+        preferences = {'RegionOrder': self._regions}
+        for option, (key, kind) in PREFERENCES.items():
+            if self._settings.get(option):
+                preferences[key] = kind(self._settings[option])
+
+        return preferences
+
+    def _targets(self):
+        if self._service_managed:
+            return {'DeploymentTargets': {'OrganizationalUnitIds': self._organizational_units}}
+
+        return {'Accounts': self._accounts}
+
+    def _exists(self):
+        try:
+            self._cloud_formation.describe_stack_set(StackSetName=self._name)
+            return True
+        except ClientError as wtf:
+            if wtf.response.get('Error', {}).get('Code') == 'StackSetNotFoundException':
+                return False
+            raise
+
+    def _missing_instances(self):
+        """
+        The (account, region) pairs asked for that do not have an instance.
+        """
+        existing = set()
+        paginator = self._cloud_formation.get_paginator('list_stack_instances')
+        for page in paginator.paginate(StackSetName=self._name):
+            for instance in page.get('Summaries', []):
+                existing.add((instance.get('Account'), instance.get('Region')))
+
+        missing_regions = set()
+        for region in self._regions:
+            if self._service_managed:
+                # accounts under an OU are not known up front, let CloudFormation sort it out
+                if not any(r == region for _, r in existing):
+                    missing_regions.add(region)
+            elif any((account, region) not in existing for account in self._accounts):
+                missing_regions.add(region)
+
+        return [r for r in self._regions if r in missing_regions]
+
+    def _note(self, kind, operation_id):
+        logger.info('stack set {} operation {} started'.format(kind, operation_id))
+        self._operations.append((kind, operation_id))
+
+    def start(self, template_url, parameters, tags):
+        """
+        Create the StackSet or update it, then add the missing instances. The
+        set uses managed execution so the operations queue up instead of
+        failing with OperationInProgressException.
+
+        Returns:
+            Good or Bad; True or False
+        """
+        common = {
+            'StackSetName': self._name,
+            'TemplateURL': template_url,
+            'Parameters': parameters,
+            'Capabilities': CAPABILITIES,
+            'Tags': tags,
+            'ManagedExecution': {'Active': True}
+        }
+        if self._service_managed:
+            common['PermissionModel'] = 'SERVICE_MANAGED'
+            common['AutoDeployment'] = {'Enabled': True, 'RetainStacksOnAccountRemoval': False}
+        else:
+            for option, key in [('administration_role_arn', 'AdministrationRoleARN'), ('execution_role_name', 'ExecutionRoleName')]:
+                if self._settings.get(option):
+                    common[key] = self._settings[option]
+
+        try:
+            if self._exists():
+                response = self._cloud_formation.update_stack_set(
+                    OperationPreferences=self._preferences(),
+                    OperationId=str(uuid.uuid4()),
+                    **common
+                )
+                self._note('update', response['OperationId'])
+            else:
+                self._cloud_formation.create_stack_set(ClientRequestToken=str(uuid.uuid4()), **common)
+                logger.info('stack set {} created'.format(self._name))
+
+            missing_regions = self._missing_instances()
+            if missing_regions:
+                response = self._cloud_formation.create_stack_instances(
+                    StackSetName=self._name,
+                    Regions=missing_regions,
+                    OperationPreferences=self._preferences(),
+                    OperationId=str(uuid.uuid4()),
+                    **self._targets()
+                )
+                self._note('create instances', response['OperationId'])
+
+            return True
+        except Exception as wtf:
+            logger.error('stack set {} did not start: {}'.format(self._name, wtf))
+            return False
+
+    def wait(self, give_up=None):
+        """
+        Poll every operation in one loop until they are all done and report
+        the result for each account and region.
+
+        Args:
+            give_up - optional callable, stop waiting when it returns True
+
+        Returns:
+            True if every operation succeeded else False
+        """
+        pending = dict((operation_id, kind) for kind, operation_id in self._operations)
+        finished = {}
+        logger.info('polling {} stack set operation(s), POLL_INTERVAL={}'.format(len(pending), POLL_INTERVAL))
+        while pending:
+            time.sleep(POLL_INTERVAL)
+            for operation_id in [o for o in pending]:
+                operation = self._cloud_formation.describe_stack_set_operation(
+                    StackSetName=self._name,
+                    OperationId=operation_id
+                )['StackSetOperation']
+                status = operation['Status']
+                if status in DONE_STATES:
+                    logger.info('stack set {} operation {}: {}'.format(pending[operation_id], operation_id, status))
+                    finished[operation_id] = (pending.pop(operation_id), status)
+
+            if pending:
+                logger.info('{} stack set operation(s) still running'.format(len(pending)))
+                if give_up and give_up():
+                    return False
+
+        self._print_report(finished)
+        return all(status == 'SUCCEEDED' for _, status in finished.values())
+
+    def _print_report(self, finished):
+        rows = []
+        paginator = self._cloud_formation.get_paginator('list_stack_set_operation_results')
+        for operation_id, (kind, status) in finished.items():
+            for page in paginator.paginate(StackSetName=self._name, OperationId=operation_id):
+                for result in page.get('Summaries', []):
+                    rows.append([
+                        kind,
+                        result.get('Account'),
+                        result.get('Region'),
+                        result.get('Status'),
+                        result.get('StatusReason', '')
+                    ])
+
+        print('Stack Set Report:')
+        print(tabulate(
+            sorted(rows, key=lambda r: (r[0], r[2], r[1])),
+            headers=['Operation', 'Account', 'Region', 'Status', 'Reason']
+        ))
@@ -0,0 +1,296 @@
+'''
+Utility to delete many CloudFormation stacks in export/import dependency order.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import time
+import fnmatch
+import logging
+from tabulate import tabulate
+
+from stackility.deploy_lock import deploy_lock
+from stackility.utility.aws_session import get_client
+
+logger = logging.getLogger(__name__)
+
+DELETE_DONE_STATES = [
+    'DELETE_COMPLETE',
+    'DELETE_FAILED'
+]
+
+
+class TeardownTool(object):
+    '''
+    Utility to delete many CloudFormation stacks. Stacks that import an
+    export are deleted before the stack that exports it, independent stacks
+    are deleted at the same time and all of the pending deletes are watched
+    from a single polling loop.
+    '''
+
+    def __init__(self, **kwargs):
+        """
+        The initializer sets up stuff to do the work
+
+        Args:
+            kwarg[Stacks]: list of stack names to delete
+            kwarg[Pattern]: shell style pattern of stack names to delete
+            kwarg[Region]: region where the stacks live
+            kwarg[Profile]: AWS profile to access resources
+            kwarg[Environment]: the [environment] settings for the deploy
+                                locks (lock_table etc.), optional
+
+        Raises:
+            SystemError if thing are not all good
+        """
+        try:
+            self.nap_time = int(os.environ.get('CSU_POLL_INTERVAL', 30))
+        except Exception:
+            self.nap_time = 30
+
+        self._stacks = kwargs.get('Stacks') or []
+        self._pattern = kwargs.get('Pattern')
+        self._environment = dict(kwargs.get('Environment') or {})
+        self._environment.setdefault('region', kwargs.get('Region'))
+        self._environment.setdefault('profile', kwargs.get('Profile'))
+        if not self._stacks and not self._pattern:
+            logger.error('no stack names or pattern given, exiting')
+            raise SystemError
+
+        if not self._init_boto3_clients(kwargs.get('Profile'), kwargs.get('Region')):
+            logger.error('client initialization failed, exiting')
+            raise SystemError
+
+    def _init_boto3_clients(self, profile, region):
+        """
+        The utililty requires boto3 clients to CloudFormation.
+
+        Args:
+            None
+
+        Returns:
+            Good or Bad; True or False
+        """
+        try:
+            self._cloud_formation = get_client('cloudformation', profile, region)
+            return True
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
+
+    def _live_stacks(self):
+        """
+        Find the stacks that have not been deleted.
+
+        Returns:
+            dict of stack name to stack ID
+        """
+        live = {}
+        paginator = self._cloud_formation.get_paginator('list_stacks')
+        for page in paginator.paginate():
+            for summary in page.get('StackSummaries', []):
+                if summary['StackStatus'] != 'DELETE_COMPLETE':
+                    live[summary['StackName']] = summary['StackId']
+
+        return live
+
+    def _find_dependencies(self, targets):
+        """
+        Map each target stack to the set of stacks that import its exports.
+
+        Args:
+            targets - dict of stack name to stack ID
+
+        Returns:
+            dict of stack name to set of importing stack names
+        """
+        stack_names = {stack_id: name for name, stack_id in targets.items()}
+        importers = {name: set() for name in targets}
+
+        paginator = self._cloud_formation.get_paginator('list_exports')
+        for page in paginator.paginate():
+            for export in page.get('Exports', []):
+                exporter = stack_names.get(export.get('ExportingStackId'))
+                if not exporter:
+                    continue
+
+                import_pages = self._cloud_formation.get_paginator('list_imports').paginate(
+                    ExportName=export['Name']
+                )
+                try:
+                    for import_page in import_pages:
+                        importers[exporter].update(import_page.get('Imports', []))
+                    importers[exporter].discard(exporter)
+                except Exception as wtf:
+                    if 'is not imported by any stack' not in str(wtf):
+                        raise
+
+        return importers
+
+    def _select_targets(self):
+        live = self._live_stacks()
+        targets = {}
+        for stack_name in self._stacks:
+            if stack_name in live:
+                targets[stack_name] = live[stack_name]
+            else:
+                logger.warning(f'your stack is in another castle: {stack_name}')
+
+        if self._pattern:
+            for stack_name, stack_id in live.items():
+                if fnmatch.fnmatchcase(stack_name, self._pattern):
+                    targets[stack_name] = stack_id
+
+        return targets
+
+    def smash(self):
+        """
+        Delete the selected stacks.
+
+        Args:
+            None
+
+        Returns:
+            True if all of the stacks are gone else False
+        """
+        try:
+            targets = self._select_targets()
+            if not targets:
+                logger.warning('no stacks matched, nothing to delete')
+                return False
+
+            importers = self._find_dependencies(targets)
+            blocked = False
+            for stack_name, imported_by in importers.items():
+                outsiders = imported_by - set(targets)
+                if outsiders:
+                    blocked = True
+                    logger.error('{} has exports imported by stacks not being deleted: {}'.format(
+                        stack_name,
+                        ', '.join(sorted(outsiders))
+                    ))
+
+            if blocked:
+                return False
+
+            with deploy_lock(self._environment, stack_names=targets) as locked:
+                if not locked:
+                    return False
+
+                logger.info('deleting stack(s): {}'.format(', '.join(sorted(targets))))
+                results, reasons = self._delete_in_order(targets, importers, locked)
+
+            self._print_report(results, reasons)
+            return all(status == 'DELETE_COMPLETE' for status in results.values())
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
+
+    def _delete_in_order(self, targets, importers, locked=None):
+        """
+        Start each delete as soon as everything importing from that stack is
+        gone and watch every pending delete from one loop.
+
+        Args:
+            targets - dict of stack name to stack ID
+            importers - dict of stack name to set of importing stack names
+            locked - the LockState of the stacks, no new deletes are started
+                     once it is lost
+
+        Returns:
+            dict of stack name to final status and dict of stack name to the
+            reason a delete failed or was skipped
+        """
+        results = {}
+        reasons = {}
+        pending = {}
+        waiting = dict(importers)
+
+        while waiting or pending:
+            progressed = False
+            for stack_name in sorted(waiting):
+                imported_by = waiting[stack_name]
+                if any(results.get(s) in ['DELETE_FAILED', 'FAILED', 'SKIPPED'] for s in imported_by):
+                    logger.error(f'skipping {stack_name}, an importing stack was not deleted')
+                    results[stack_name] = 'SKIPPED'
+                    reasons[stack_name] = 'an importing stack was not deleted'
+                    del waiting[stack_name]
+                    progressed = True
+                    continue
+
+                if any(results.get(s) != 'DELETE_COMPLETE' for s in imported_by):
+                    continue
+
+                if locked is not None and locked.lost:
+                    logger.error(f'skipping {stack_name}, the deploy lock was lost')
+                    results[stack_name] = 'SKIPPED'
+                    reasons[stack_name] = 'the deploy lock was lost'
+                    del waiting[stack_name]
+                    progressed = True
+                    continue
+
+                del waiting[stack_name]
+                progressed = True
+                try:
+                    self._cloud_formation.delete_stack(StackName=stack_name)
+                except Exception as wtf:
+                    # e.g. termination protection, the other deletes carry on
+                    logger.error(f'could not delete {stack_name}: {wtf}')
+                    results[stack_name] = 'FAILED'
+                    reasons[stack_name] = str(wtf)
+                    continue
+
+                logger.info(f'delete started for stack: {stack_name}')
+                pending[stack_name] = targets[stack_name]
+
+            if not pending:
+                if waiting and not progressed:
+                    logger.error('circular imports between: {}'.format(', '.join(sorted(waiting))))
+                    for stack_name in waiting:
+                        results[stack_name] = 'SKIPPED'
+                        reasons[stack_name] = 'circular imports'
+                    waiting = {}
+                continue
+
+            time.sleep(self.nap_time)
+            for stack_name, summary in self._current_states(pending).items():
+                status = summary['StackStatus']
+                logger.info(f'current status of {stack_name}: {status}')
+                if status in DELETE_DONE_STATES:
+                    results[stack_name] = status
+                    if status != 'DELETE_COMPLETE':
+                        reasons[stack_name] = summary.get('StackStatusReason', '')
+                    del pending[stack_name]
+
+        return results, reasons
+
+    def _current_states(self, pending):
+        """
+        Find the status of all the pending stacks with one paginated
+        list_stacks() walk.
+
+        Args:
+            pending - dict of stack name to stack ID
+
+        Returns:
+            dict of stack name to its stack summary
+        """
+        by_id = {stack_id: name for name, stack_id in pending.items()}
+        states = {}
+        paginator = self._cloud_formation.get_paginator('list_stacks')
+        for page in paginator.paginate():
+            for summary in page.get('StackSummaries', []):
+                stack_name = by_id.get(summary['StackId'])
+                if stack_name:
+                    states[stack_name] = summary
+
+        return states
+
+    def _print_report(self, results, reasons):
+        rows = [
+            [stack_name, results[stack_name], reasons.get(stack_name, '')]
+            for stack_name in sorted(results)
+        ]
+        print('Delete Report:')
+        print(tabulate(rows, headers=['Stack', 'Status', 'Reason']))
@@ -0,0 +1,177 @@
+'''
+Compare a deployed template and its parameters with the local ones without
+asking CloudFormation for a change set.
+'''
+import re
+import json
+import datetime
+import yaml
+from tabulate import tabulate
+
+HIDDEN = '****'
+BOOL_TAG = 'tag:yaml.org,2002:bool'
+TIMESTAMP_TAG = 'tag:yaml.org,2002:timestamp'
+
+# the parts of a resource besides Properties that are worth a mention
+RESOURCE_ATTRIBUTES = [
+    'Type',
+    'Condition',
+    'DependsOn',
+    'DeletionPolicy',
+    'UpdateReplacePolicy',
+    'UpdatePolicy',
+    'CreationPolicy',
+    'Metadata'
+]
+
+
+class _IntrinsicLoader(yaml.SafeLoader):
+    '''
+    Turns the short form of intrinsic functions into the long form so a
+    YAML template compares equal to the same template written in JSON.
+    '''
+
+
+def _intrinsic(loader, tag_suffix, node):
+    function = tag_suffix if tag_suffix == 'Ref' or tag_suffix == 'Condition' else 'Fn::' + tag_suffix
+    if isinstance(node, yaml.ScalarNode):
+        value = loader.construct_scalar(node)
+        if function == 'Fn::GetAtt':
+            value = value.split('.', 1)
+    elif isinstance(node, yaml.SequenceNode):
+        value = loader.construct_sequence(node, deep=True)
+    else:
+        value = loader.construct_mapping(node, deep=True)
+
+    return {function: value}
+
+
+yaml.add_multi_constructor('!', _intrinsic, Loader=_IntrinsicLoader)
+
+# only true/false are booleans and nothing is a date, on/yes/2010-09-09 stay strings
+_IntrinsicLoader.yaml_implicit_resolvers = dict(
+    (first, [(tag, regexp) for tag, regexp in resolvers if tag not in [BOOL_TAG, TIMESTAMP_TAG]])
+    for first, resolvers in yaml.SafeLoader.yaml_implicit_resolvers.items()
+)
+_IntrinsicLoader.add_implicit_resolver(BOOL_TAG, re.compile(r'^(?:true|True|TRUE|false|False|FALSE)$'), list('tTfF'))
+
+
+def load_template(body):
+    '''
+    Args:
+        body - the template as text (JSON or YAML) or already decoded
+
+    Returns:
+        the template as a dict
+    '''
+    if isinstance(body, dict):
+        return body
+
+    try:
+        return json.loads(body)
+    except ValueError:
+        return yaml.load(body, Loader=_IntrinsicLoader)
+
+
+def _normalised(thing):
+    '''
+    Scalars as the strings CloudFormation sees, so 80 and true in YAML
+    compare equal to "80" and "true" in JSON.
+    '''
+    if isinstance(thing, dict):
+        return dict((str(k), _normalised(v)) for k, v in thing.items())
+    if isinstance(thing, list):
+        return [_normalised(v) for v in thing]
+    if thing is None:
+        return None
+    if isinstance(thing, bool):
+        return str(thing).lower()
+    if isinstance(thing, (datetime.date, datetime.datetime)):
+        return thing.isoformat()
+
+    return str(thing)
+
+
+def _changed_keys(old, new, prefix):
+    keys = sorted(set(old) | set(new))
+    return ['{}{}'.format(prefix, k) for k in keys if old.get(k) != new.get(k)]
+
+
+def diff_resources(deployed, local):
+    '''
+    Args:
+        deployed - the template of the stack
+        local - the template that would be deployed
+
+    Returns:
+        a list of [change, logical id, type, what changed] rows, change is
+        Add, Remove or Modify
+    '''
+    old = _normalised((deployed or {}).get('Resources') or {})
+    new = _normalised((local or {}).get('Resources') or {})
+    rows = []
+    for logical_id in sorted(set(old) | set(new)):
+        if logical_id not in old:
+            rows.append(['Add', logical_id, new[logical_id].get('Type'), ''])
+        elif logical_id not in new:
+            rows.append(['Remove', logical_id, old[logical_id].get('Type'), ''])
+        elif old[logical_id] != new[logical_id]:
+            changed = _changed_keys(
+                old[logical_id].get('Properties') or {},
+                new[logical_id].get('Properties') or {},
+                'Properties.'
+            )
+            changed += [a for a in RESOURCE_ATTRIBUTES if old[logical_id].get(a) != new[logical_id].get(a)]
+            rows.append(['Modify', logical_id, new[logical_id].get('Type'), ', '.join(changed)])
+
+    return rows
+
+
+def diff_parameters(deployed, local, hidden):
+    '''
+    Args:
+        deployed - the Parameters of describe_stacks()
+        local - the Parameters that would be deployed
+        hidden - names of parameters whose values are not to be shown
+
+    Returns:
+        a list of [change, parameter, deployed value, local value] rows, a
+        NoEcho value that CloudFormation will not tell us is not compared
+    '''
+    old = {p['ParameterKey']: p.get('ParameterValue') for p in deployed or []}
+    new = {p['ParameterKey']: p.get('ParameterValue') for p in local or []}
+
+    def show(name, value):
+        return HIDDEN if name in hidden and value is not None else value
+
+    rows = []
+    for name in sorted(set(old) | set(new)):
+        if name not in old:
+            rows.append(['Add', name, None, show(name, new[name])])
+        elif name not in new:
+            rows.append(['Remove', name, show(name, old[name]), None])
+        elif old[name] == HIDDEN:
+            rows.append(['Not compared', name, HIDDEN, show(name, new[name])])
+        elif old[name] != new[name]:
+            rows.append(['Modify', name, show(name, old[name]), show(name, new[name])])
+
+    return rows
+
+
+def print_diff(stack_name, resource_rows, parameter_rows):
+    '''
+    Print the differences found by diff_resources() and diff_parameters().
+    '''
+    if not resource_rows and not parameter_rows:
+        print('{} is up to date with the local template and parameters'.format(stack_name))
+        return
+
+    if resource_rows:
+        print('Resource changes of {}:'.format(stack_name))
+        print(tabulate(resource_rows, headers=['Change', 'Logical ID', 'Type', 'Changed']))
+        print()
+
+    if parameter_rows:
+        print('Parameter changes of {}:'.format(stack_name))
+        print(tabulate(parameter_rows, headers=['Change', 'Parameter', 'Deployed', 'Local']))
+        print()
@@ -0,0 +1,294 @@
+'''
+Utility to turn the events of the latest stack operation into a timeline.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import re
+import json
+import logging
+from tabulate import tabulate
+
+from stackility.template_diff import load_template
+from stackility.utility.aws_session import get_client
+
+logger = logging.getLogger(__name__)
+
+# events this close together are treated as happening at the same time
+SLACK_SECONDS = 1.0
+
+SUB_VARIABLE = re.compile(r'\$\{([^!}][^}]*)\}')
+
+
+def _references(thing, found):
+    '''
+    Collect the logical IDs named by Ref, Fn::GetAtt and Fn::Sub anywhere
+    in a piece of a template.
+    '''
+    if isinstance(thing, list):
+        for item in thing:
+            _references(item, found)
+        return
+
+    if not isinstance(thing, dict):
+        return
+
+    for key, value in thing.items():
+        if key == 'Ref' and isinstance(value, str):
+            found.add(value)
+        elif key == 'Fn::GetAtt':
+            if isinstance(value, str):
+                found.add(value.split('.', 1)[0])
+            elif isinstance(value, list) and value and isinstance(value[0], str):
+                found.add(value[0])
+        elif key == 'Fn::Sub':
+            text, variables = (value, {}) if isinstance(value, str) else (value + [None, None])[:2]
+            variables = variables if isinstance(variables, dict) else {}
+            if isinstance(text, str):
+                for name in SUB_VARIABLE.findall(text):
+                    name = name.split('.', 1)[0].strip()
+                    if name not in variables:
+                        found.add(name)
+            _references(variables, found)
+        else:
+            _references(value, found)
+
+
+class TimelineTool(object):
+    '''
+    Utility to find out where the time of a deploy went: how long each
+    resource took, which chain of resources decided the length of the
+    deploy (the critical path) and which resource types are the slowest.
+    '''
+
+    def __init__(self, **kwargs):
+        """
+        The initializer sets up stuff to do the work
+
+        Args:
+            kwarg[Stack]: stack name
+            kwarg[Region]: region where the stack lives
+            kwarg[Profile]: AWS profile to access resources
+            kwarg[Save]: optional JSONL file the timeline is appended to
+
+        Raises:
+            SystemError if thing are not all good
+        """
+        self._stack_name = kwargs.get('Stack')
+        self._region = kwargs.get('Region')
+        self._save = kwargs.get('Save')
+        if not self._stack_name:
+            logger.error('no stack name given, exiting')
+            raise SystemError
+
+        if not self._init_boto3_clients(kwargs.get('Profile'), kwargs.get('Region')):
+            logger.error('client initialization failed, exiting')
+            raise SystemError
+
+    def _init_boto3_clients(self, profile, region):
+        """
+        The utililty requires boto3 clients to CloudFormation.
+
+        Args:
+            None
+
+        Returns:
+            Good or Bad; True or False
+        """
+        try:
+            self._cloud_formation = get_client('cloudformation', profile, region)
+            return True
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
+
+    def _latest_events(self):
+        """
+        The events of the most recent operation, oldest first.
+        """
+        events = []
+        current_request_token = None
+        paginator = self._cloud_formation.get_paginator('describe_stack_events')
+        for page in paginator.paginate(StackName=self._stack_name):
+            for event in page.get('StackEvents', []):
+                request_token = event.get('ClientRequestToken', 'unknown')
+                if current_request_token is None:
+                    current_request_token = request_token
+                elif current_request_token != request_token:
+                    events.reverse()
+                    return current_request_token, events
+
+                events.append(event)
+
+        events.reverse()
+        return current_request_token, events
+
+    def _dependencies(self):
+        """
+        Which resources each resource refers to, from the deployed template.
+
+        Returns:
+            dict of logical ID to set of logical IDs or None if the template
+            is not available
+        """
+        try:
+            body = self._cloud_formation.get_template(
+                StackName=self._stack_name,
+                TemplateStage='Processed'
+            )['TemplateBody']
+            resources = load_template(body).get('Resources', {})
+            answer = {}
+            for logical_id, definition in resources.items():
+                found = set()
+                _references(definition, found)
+                depends_on = definition.get('DependsOn') or []
+                found.update([depends_on] if isinstance(depends_on, str) else depends_on)
+                answer[logical_id] = set(other for other in found if other in resources and other != logical_id)
+
+            return answer
+        except Exception as wtf:
+            logger.info('template dependencies not available, using timing only: {}'.format(wtf))
+
+        return None
+
+    def build(self):
+        """
+        Build the timeline of the most recent operation.
+
+        Returns:
+            a dictionary describing the deploy or None
+        """
+        token, events = self._latest_events()
+        if not events:
+            return None
+
+        spans = []
+        open_spans = {}
+        stack_status = None
+        for event in events:
+            logical_id = event.get('LogicalResourceId')
+            status = event.get('ResourceStatus', '')
+            when = event['Timestamp'].timestamp()
+            if logical_id == self._stack_name:
+                stack_status = status
+                continue
+
+            action = status.split('_')[0]
+            key = (logical_id, action)
+            if status.endswith('_IN_PROGRESS'):
+                if key not in open_spans:
+                    open_spans[key] = {
+                        'logical_id': logical_id,
+                        'type': event.get('ResourceType'),
+                        'action': action,
+                        'start': when
+                    }
+            elif key in open_spans:
+                span = open_spans.pop(key)
+                span['end'] = when
+                span['duration'] = when - span['start']
+                span['status'] = status
+                spans.append(span)
+
+        started = events[0]['Timestamp'].timestamp()
+        finished = events[-1]['Timestamp'].timestamp()
+        return {
+            'stack': self._stack_name,
+            'region': self._region,
+            'token': token,
+            'status': stack_status,
+            'started': started,
+            'finished': finished,
+            'duration': finished - started,
+            'resources': spans,
+            'critical_path': self._critical_path(spans, self._dependencies()),
+            'slowest_types': self._slowest_types(spans)
+        }
+
+    @staticmethod
+    def _critical_path(spans, dependencies):
+        """
+        Walk back from the span that finished last, each step going to the
+        latest finishing span it could have been waiting on.
+        """
+        if not spans:
+            return []
+
+        path = []
+        current = max(spans, key=lambda s: s['end'])
+        while current:
+            path.append(current['logical_id'])
+            candidates = [
+                s for s in spans
+                if s['end'] <= current['start'] + SLACK_SECONDS and s is not current and s['logical_id'] not in path
+            ]
+            if dependencies is not None:
+                wanted = dependencies.get(current['logical_id'], set())
+                candidates = [s for s in candidates if s['logical_id'] in wanted]
+
+            current = max(candidates, key=lambda s: s['end']) if candidates else None
+
+        path.reverse()
+        return path
+
+    @staticmethod
+    def _slowest_types(spans):
+        by_type = {}
+        for span in spans:
+            stats = by_type.setdefault(span['type'], {'type': span['type'], 'count': 0, 'total': 0.0, 'max': 0.0})
+            stats['count'] += 1
+            stats['total'] += span['duration']
+            stats['max'] = max(stats['max'], span['duration'])
+
+        return sorted(by_type.values(), key=lambda s: s['total'], reverse=True)
+
+    def report(self):
+        """
+        Print the timeline and save it if asked.
+
+        Returns:
+            Good or Bad; True or False
+        """
+        try:
+            timeline = self.build()
+            if not timeline:
+                print('\nNo stack events found\n')
+                return False
+
+            rows = []
+            for span in sorted(timeline['resources'], key=lambda s: s['start']):
+                rows.append([
+                    '{:.0f}'.format(span['start'] - timeline['started']),
+                    '{:.0f}'.format(span['duration']),
+                    span['logical_id'],
+                    span['type'],
+                    span['status'],
+                    '*' if span['logical_id'] in timeline['critical_path'] else ''
+                ])
+
+            print('\nTimeline of {} ({}, {:.0f} seconds):'.format(
+                self._stack_name,
+                timeline['status'],
+                timeline['duration']
+            ))
+            print(tabulate(rows, headers=['Start (s)', 'Duration (s)', 'Logical ID', 'Type', 'Status', 'Critical']))
+
+            print('\nCritical path:')
+            print('  ' + ' -> '.join(timeline['critical_path']))
+
+            print('\nSlowest resource types:')
+            print(tabulate(
+                [[t['type'], t['count'], '{:.0f}'.format(t['total']), '{:.0f}'.format(t['max'])] for t in timeline['slowest_types']],
+                headers=['Type', 'Count', 'Total (s)', 'Max (s)']
+            ))
+
+            if self._save:
+                with open(self._save, 'a') as f:
+                    f.write(json.dumps(timeline) + '\n')
+                logger.info('timeline appended to {}'.format(self._save))
+
+            return True
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+
+        return False
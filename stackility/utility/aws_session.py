@@ -0,0 +1,150 @@
+'''
+Process wide cache of boto3 sessions and clients. Resolving credentials and
+creating clients is slow so everything in stackility asks here instead of
+building its own; a long running process (see stackility serve) keeps them
+warm between jobs.
+
+Credentials of assume-role (and MFA) profiles are also kept on disk so
+consecutive commands skip STS and the MFA prompt until shortly before the
+credentials expire. The cache lives in ~/.stackility/credentials, or where
+STACKILITY_CREDENTIAL_CACHE says; set it to off to turn the cache off.
+'''
+import os
+import logging
+import threading
+import boto3
+
+from stackility.utility.cassette import get_cassette
+
+logger = logging.getLogger(__name__)
+
+CREDENTIAL_CACHE = os.path.join(os.path.expanduser('~'), '.stackility', 'credentials')
+CACHED_PROVIDERS = ['assume-role', 'assume-role-with-web-identity']
+
+_lock = threading.RLock()
+_sessions = {}
+_clients = {}
+
+
+class _CredentialCache(object):
+    '''
+    botocore's JSON file cache kept private to the user, the directory is
+    0700 and every file 0600. The cache is an extra, anything going wrong in
+    it is a cache miss and never gets in the way of resolving credentials.
+    '''
+
+    def __init__(self, working_dir):
+        from botocore.utils import JSONFileCache
+
+        os.makedirs(working_dir, mode=0o700, exist_ok=True)
+        os.chmod(working_dir, 0o700)
+        self._cache = JSONFileCache(working_dir)
+
+    def __contains__(self, cache_key):
+        try:
+            return cache_key in self._cache
+        except Exception as wtf:
+            logger.debug('credential cache lookup failed: {}'.format(wtf))
+            return False
+
+    def __getitem__(self, cache_key):
+        try:
+            return self._cache[cache_key]
+        except KeyError:
+            raise
+        except Exception as wtf:
+            logger.debug('credential cache read failed: {}'.format(wtf))
+            raise KeyError(cache_key)
+
+    def __setitem__(self, cache_key, value):
+        previous = os.umask(0o077)
+        try:
+            self._cache[cache_key] = value
+        except Exception as wtf:
+            logger.debug('credential cache write failed: {}'.format(wtf))
+        finally:
+            os.umask(previous)
+
+    def __delitem__(self, cache_key):
+        try:
+            del self._cache[cache_key]
+        except Exception as wtf:
+            logger.debug('credential cache delete failed: {}'.format(wtf))
+
+
+def _cache_credentials(session):
+    '''
+    Point the assume-role providers of a session at the on-disk cache. The
+    providers key the cache on the role and refresh the credentials a few
+    minutes before they expire. This leans on botocore internals, if they
+    are not what we expect the session just goes without the cache.
+    '''
+    working_dir = os.environ.get('STACKILITY_CREDENTIAL_CACHE', CREDENTIAL_CACHE)
+    if working_dir.lower() == 'off':
+        return
+
+    try:
+        cache = _CredentialCache(os.path.expanduser(working_dir))
+        resolver = session._session.get_component('credential_provider')
+        for method in CACHED_PROVIDERS:
+            provider = resolver.get_provider(method)
+            if hasattr(provider, 'cache'):
+                provider.cache = cache
+    except Exception as wtf:
+        logger.debug('credential cache not used: {}'.format(wtf))
+
+
+def get_session(profile=None, region=None):
+    '''
+    Get the boto3 session for the given profile and region.
+
+    Args:
+        profile - the credentials profile or None for the default chain
+        region - the region or None for the default region
+
+    Returns:
+        a boto3 session
+    '''
+    key = (profile, region)
+    with _lock:
+        if key not in _sessions:
+            if profile:
+                _sessions[key] = boto3.session.Session(profile_name=profile, region_name=region)
+            else:
+                _sessions[key] = boto3.session.Session(region_name=region)
+
+            _cache_credentials(_sessions[key])
+
+        return _sessions[key]
+
+
+def get_client(service, profile=None, region=None, endpoint_url=None):
+    '''
+    Get a boto3 client, clients are thread safe so they are shared.
+
+    Args:
+        service - the AWS service name, e.g. cloudformation
+        profile - the credentials profile or None for the default chain
+        region - the region or None for the default region
+        endpoint_url - talk to a local stand-in of the service instead of AWS
+
+    Returns:
+        a boto3 client
+    '''
+    key = (service, profile, region, endpoint_url)
+    with _lock:
+        if key not in _clients:
+            client = get_session(profile, region).client(service, endpoint_url=endpoint_url)
+            cassette = get_cassette()
+            _clients[key] = cassette.attach(client) if cassette else client
+
+        return _clients[key]
+
+
+def forget():
+    '''
+    Drop every cached session and client, e.g. after credentials change.
+    '''
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
@@ -0,0 +1,239 @@
+'''
+Record the AWS traffic of a stackility run to a cassette file and play it back
+later without touching AWS, e.g. to measure changes to polling, batching and
+concurrency against the traffic of a real deploy.
+
+The cassette is picked up from the environment:
+
+    STACKILITY_CASSETTE       - the cassette file (JSON lines)
+    STACKILITY_CASSETTE_MODE  - record, replay (recorded latency) or
+                                replay-fast (no latency), default replay
+
+Every client made by stackility.utility.aws_session gets hooked, recording
+happens in after-call and replay answers in before-call so no request leaves
+the process.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import io
+import os
+import json
+import time
+import base64
+import logging
+import datetime
+import threading
+from botocore.awsrequest import AWSResponse
+from botocore.response import StreamingBody
+
+logger = logging.getLogger(__name__)
+
+RECORD = 'record'
+REPLAY = 'replay'
+REPLAY_FAST = 'replay-fast'
+MODES = [RECORD, REPLAY, REPLAY_FAST]
+
+# these change on every run so they are left out when matching requests
+VOLATILE_PARAMETERS = ['ClientRequestToken', 'Body']
+
+_lock = threading.Lock()
+_cassette = None
+_loaded = False
+
+
+def _encode(thing):
+    if isinstance(thing, datetime.datetime):
+        return {'__datetime__': thing.isoformat()}
+    if isinstance(thing, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(bytes(thing)).decode('ascii')}
+
+    return {'__repr__': repr(thing)}
+
+
+def _decode(thing):
+    if isinstance(thing, list):
+        return [_decode(x) for x in thing]
+    if not isinstance(thing, dict):
+        return thing
+
+    if len(thing) == 1:
+        if '__datetime__' in thing:
+            return datetime.datetime.fromisoformat(thing['__datetime__'])
+        if '__bytes__' in thing:
+            return base64.b64decode(thing['__bytes__'])
+        if '__stream__' in thing:
+            data = base64.b64decode(thing['__stream__'])
+            return StreamingBody(io.BytesIO(data), len(data))
+
+    return {k: _decode(v) for k, v in thing.items()}
+
+
+def _request_key(service, operation, params):
+    wanted = {k: v for k, v in (params or {}).items() if k not in VOLATILE_PARAMETERS}
+    return '{}.{}:{}'.format(
+        service,
+        operation,
+        json.dumps(wanted, sort_keys=True, default=_encode)
+    )
+
+
+class Cassette(object):
+    '''
+    The recorded interactions and the botocore event handlers that make or
+    use them.
+    '''
+
+    def __init__(self, file_name, mode=REPLAY):
+        """
+        Args:
+            file_name - the cassette file
+            mode - record, replay or replay-fast
+
+        Raises:
+            ValueError for an unknown mode, OSError if a cassette to replay
+            can not be read
+        """
+        if mode not in MODES:
+            raise ValueError(f'unknown cassette mode: {mode}')
+
+        self._file_name = file_name
+        self._mode = mode
+        self._lock = threading.Lock()
+        self._by_request = {}
+        self._by_operation = {}
+        if mode == RECORD:
+            self._output = open(file_name, 'w')
+            logger.info(f'recording AWS traffic to {file_name}')
+        else:
+            self._output = None
+            self._load()
+            logger.info(f'replaying AWS traffic from {file_name} ({mode})')
+
+    def _load(self):
+        count = 0
+        with open(self._file_name) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                interaction = json.loads(line)
+                key = _request_key(interaction['service'], interaction['operation'], interaction['params'])
+                self._by_request.setdefault(key, []).append(interaction)
+                operation = '{}.{}'.format(interaction['service'], interaction['operation'])
+                self._by_operation.setdefault(operation, []).append(interaction)
+                count += 1
+
+        logger.info(f'{count} interaction(s) in the cassette')
+
+    def attach(self, client):
+        """
+        Hook a boto3 client to this cassette.
+
+        Args:
+            client - a boto3 client
+
+        Returns:
+            the client
+        """
+        events = client.meta.events
+        events.register('before-parameter-build', self._remember_params)
+        if self._mode == RECORD:
+            events.register('before-call', self._start_clock)
+            events.register('after-call', self._record)
+        else:
+            events.register('before-call', self._replay)
+
+        return client
+
+    @staticmethod
+    def _names(model):
+        return model.service_model.service_name, model.name
+
+    def _remember_params(self, params, context, **kwargs):
+        context['cassette_params'] = json.loads(json.dumps(params, default=_encode))
+
+    def _start_clock(self, context, **kwargs):
+        context['cassette_start'] = time.time()
+
+    def _record(self, http_response, parsed, model, context, **kwargs):
+        try:
+            started = context.get('cassette_start', time.time())
+            body = parsed.get('Body') if isinstance(parsed, dict) else None
+            stream = None
+            if isinstance(body, StreamingBody):
+                data = body.read()
+                parsed['Body'] = StreamingBody(io.BytesIO(data), len(data))
+                stream = base64.b64encode(data).decode('ascii')
+
+            service, operation = self._names(model)
+            answer = json.loads(json.dumps(parsed, default=_encode))
+            if stream is not None:
+                answer['Body'] = {'__stream__': stream}
+
+            interaction = {
+                'service': service,
+                'operation': operation,
+                'params': context.get('cassette_params', {}),
+                'status_code': http_response.status_code,
+                'started': started,
+                'duration': time.time() - started,
+                'response': answer
+            }
+            with self._lock:
+                self._output.write(json.dumps(interaction) + '\n')
+                self._output.flush()
+        except Exception as wtf:
+            logger.warning(f'could not record an interaction: {wtf}')
+
+    def _replay(self, model, context, **kwargs):
+        service, operation = self._names(model)
+        key = _request_key(service, operation, context.get('cassette_params'))
+        with self._lock:
+            # the same request if it was recorded, else the next recorded
+            # call of the same operation
+            interaction = None
+            for candidates in [self._by_request.get(key, []), self._by_operation.get(f'{service}.{operation}', [])]:
+                interaction = next((c for c in candidates if not c.get('used')), None)
+                if interaction:
+                    break
+
+            if interaction is None:
+                raise LookupError(f'no recorded response for {service}.{operation} in {self._file_name}')
+
+            interaction['used'] = True
+
+        if self._mode == REPLAY:
+            time.sleep(interaction.get('duration', 0))
+
+        http_response = AWSResponse(
+            'https://{}.cassette'.format(service),
+            interaction.get('status_code', 200),
+            {},
+            None
+        )
+        return http_response, _decode(interaction['response'])
+
+    def close(self):
+        if self._output:
+            self._output.close()
+            self._output = None
+
+
+def get_cassette():
+    '''
+    The cassette named in the environment, if any.
+
+    Returns:
+        a Cassette or None
+    '''
+    global _cassette
+    global _loaded
+    with _lock:
+        if not _loaded:
+            _loaded = True
+            file_name = os.environ.get('STACKILITY_CASSETTE')
+            if file_name:
+                _cassette = Cassette(file_name, os.environ.get('STACKILITY_CASSETTE_MODE', REPLAY))
+
+        return _cassette
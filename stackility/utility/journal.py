@@ -0,0 +1,88 @@
+'''
+A small on-disk journal of the stages an upsert has finished, so a run that
+dies half way can be picked up by the next run instead of starting over.
+'''
+import os
+import json
+import time
+import hashlib
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def file_hash(file_name):
+    '''
+    SHA-256 of a file.
+    '''
+    digest = hashlib.sha256()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+class RunJournal(object):
+    '''
+    The checkpoints of one stack's upsert. A journal written for different
+    inputs (the fingerprint) is ignored and replaced.
+    '''
+
+    def __init__(self, file_name, fingerprint):
+        """
+        Args:
+            file_name - where the journal lives
+            fingerprint - identifies the inputs of the run
+        """
+        self._file_name = file_name
+        self._fingerprint = fingerprint
+        self._entries = {}
+        try:
+            with open(file_name) as f:
+                journal = json.load(f)
+
+            if journal.get('fingerprint') == fingerprint:
+                self._entries = journal.get('stages', {})
+                logger.info('resuming from journal {}, finished stages: {}'.format(
+                    file_name,
+                    ', '.join(self._entries) or 'none'
+                ))
+            else:
+                logger.info('journal {} is for other inputs, starting over'.format(file_name))
+        except FileNotFoundError:
+            pass
+        except Exception as wtf:
+            logger.warning('ignoring unreadable journal {}: {}'.format(file_name, wtf))
+
+    def get(self, stage):
+        """
+        Returns:
+            what was recorded for the stage or None if it was not finished
+        """
+        return self._entries.get(stage)
+
+    def record(self, stage, **data):
+        """
+        Note a finished stage, the journal is rewritten atomically.
+        """
+        data['at'] = time.time()
+        self._entries[stage] = data
+        directory = os.path.dirname(self._file_name)
+        if directory:
+            os.makedirs(directory, mode=0o700, exist_ok=True)
+
+        scratch = self._file_name + '.tmp'
+        with open(scratch, 'w') as f:
+            json.dump({'fingerprint': self._fingerprint, 'stages': self._entries}, f, indent=2)
+        os.replace(scratch, self._file_name)
+
+    def clear(self):
+        """
+        The run is over, good or bad, nothing to resume.
+        """
+        self._entries = {}
+        try:
+            os.unlink(self._file_name)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,124 @@
+'''
+Check parameter values against the constraints in the Parameters section of
+a template before anything is sent to AWS.
+'''
+import re
+import logging
+
+logger = logging.getLogger(__name__)
+
+LIST_TYPES = ['CommaDelimitedList', 'List<Number>']
+SSM_TYPE = 'AWS::SSM::Parameter::'
+
+
+def as_text(value):
+    '''
+    YAML hands us ints and bools for things like AllowedValues: [1, true].
+    '''
+    if isinstance(value, bool):
+        return str(value).lower()
+
+    return str(value)
+
+
+def _is_list(parameter_type):
+    return parameter_type in LIST_TYPES or parameter_type.startswith('List<')
+
+
+def _is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
+
+
+def _check_one(name, value, definition):
+    '''
+    The problems with one value (or one item of a list value, the lengths
+    are only checked for a value that is not a list).
+    '''
+    problems = []
+    parameter_type = str(definition.get('Type', 'String'))
+    numeric = parameter_type in ['Number', 'List<Number>']
+
+    allowed_values = definition.get('AllowedValues')
+    if allowed_values is not None and value not in [as_text(v) for v in allowed_values]:
+        problems.append('{} must be one of {}'.format(name, ', '.join(as_text(v) for v in allowed_values)))
+
+    if numeric:
+        if not _is_number(value):
+            problems.append('{} must be a number'.format(name))
+        else:
+            if 'MinValue' in definition and float(value) < float(definition['MinValue']):
+                problems.append('{} must be at least {}'.format(name, as_text(definition['MinValue'])))
+            if 'MaxValue' in definition and float(value) > float(definition['MaxValue']):
+                problems.append('{} must be at most {}'.format(name, as_text(definition['MaxValue'])))
+    else:
+        pattern = definition.get('AllowedPattern')
+        if pattern is not None:
+            try:
+                if not re.fullmatch(str(pattern), value):
+                    problems.append('{} must match the pattern {}'.format(name, pattern))
+            except re.error as wtf:
+                logger.warning('not checking {} against {}, not a pattern Python understands: {}'.format(
+                    name,
+                    pattern,
+                    wtf
+                ))
+
+        if _is_list(parameter_type):
+            return problems
+
+        if 'MinLength' in definition and len(value) < int(definition['MinLength']):
+            problems.append('{} must be at least {} characters long'.format(name, as_text(definition['MinLength'])))
+        if 'MaxLength' in definition and len(value) > int(definition['MaxLength']):
+            problems.append('{} must be at most {} characters long'.format(name, as_text(definition['MaxLength'])))
+
+    return problems
+
+
+def check_parameters(template_parameters, values):
+    '''
+    Check every template parameter in one pass.
+
+    Args:
+        template_parameters - the Parameters section of the template
+        values - the parameter values, a key may also be given in lower case
+
+    Returns:
+        a tuple of the Parameters list for CloudFormation and the list of
+        problems found, the list is only good to use if there are none
+    '''
+    parameters = []
+    problems = []
+    for name, definition in (template_parameters or {}).items():
+        name = str(name)
+        definition = definition if isinstance(definition, dict) else {}
+        if name in values:
+            value = values[name]
+        elif name.lower() in values:
+            value = values[name.lower()]
+        else:
+            problems.append('{} has no value and no Default'.format(name))
+            continue
+
+        value = as_text(value)
+        parameter_type = str(definition.get('Type', 'String'))
+        if parameter_type.startswith(SSM_TYPE):
+            # the value is the name of an SSM parameter, CloudFormation checks what it resolves to
+            parameters.append({'ParameterKey': name, 'ParameterValue': value})
+            continue
+
+        items = [v.strip() for v in value.split(',')] if _is_list(parameter_type) else [value]
+        found = []
+        for item in items:
+            found.extend(p for p in _check_one(name, item, definition) if p not in found)
+
+        if found and definition.get('ConstraintDescription'):
+            found.append('{}: {}'.format(name, definition['ConstraintDescription']))
+
+        problems.extend(found)
+        parameters.append({'ParameterKey': name, 'ParameterValue': value})
+
+    return parameters, problems
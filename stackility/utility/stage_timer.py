@@ -0,0 +1,81 @@
+'''
+Record how long each stage of a stackility run takes.
+'''
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+from tabulate import tabulate
+
+
+class StageTimer(object):
+    '''
+    Collects (stage, start, end) records, prints them as a timeline and
+    writes them as Chrome trace events (load the file in chrome://tracing
+    or https://ui.perfetto.dev).
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = []
+        self._created = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        '''
+        Time the body of a with block as the given stage.
+        '''
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            with self._lock:
+                self._stages.append((name, start, end, threading.get_ident()))
+
+    def stages(self):
+        with self._lock:
+            return [s for s in self._stages]
+
+    def print_timeline(self):
+        '''
+        Print the recorded stages in the order they started.
+        '''
+        stages = sorted(self.stages(), key=lambda s: s[1])
+        if not stages:
+            return
+
+        total = max(s[2] for s in stages) - self._created
+        rows = []
+        for name, start, end, _ in stages:
+            duration = end - start
+            rows.append([
+                name,
+                '{:.3f}'.format(start - self._created),
+                '{:.3f}'.format(duration),
+                '{:.1f}'.format(100.0 * duration / total) if total > 0 else '-'
+            ])
+
+        print('\nStage timeline:')
+        print(tabulate(rows, headers=['Stage', 'Start (s)', 'Duration (s)', '% of run']))
+
+    def write_trace(self, trace_file):
+        '''
+        Write the stages as Chrome trace-event JSON.
+        '''
+        events = []
+        for name, start, end, thread_id in self.stages():
+            events.append({
+                'name': name,
+                'cat': 'stackility',
+                'ph': 'X',
+                'ts': int((start - self._created) * 1000000),
+                'dur': int((end - start) * 1000000),
+                'pid': os.getpid(),
+                'tid': thread_id
+            })
+
+        with open(trace_file, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, indent=2)
@@ -0,0 +1,304 @@
+'''
+Pull the Parameters section out of a CloudFormation template without
+building an object tree for the rest of the template.
+'''
+import re
+import json
+from itertools import accumulate
+from itertools import islice
+from itertools import repeat
+
+import yaml
+from yaml.events import AliasEvent
+from yaml.events import MappingEndEvent
+from yaml.events import MappingStartEvent
+from yaml.events import ScalarEvent
+from yaml.events import SequenceEndEvent
+from yaml.events import SequenceStartEvent
+from yaml.nodes import MappingNode
+from yaml.nodes import ScalarNode
+from yaml.nodes import SequenceNode
+from yaml.resolver import Resolver
+
+try:
+    from yaml import CLoader as Loader
+except ImportError:
+    from yaml import Loader
+
+JSON_CHUNK = 1024 * 1024
+_JSON_TOKEN = re.compile(r'["{}\[\]:,]')
+_JSON_STRING = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"', re.DOTALL)
+_JSON_SKIP = re.compile(r'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]', re.DOTALL)
+_JSON_COMPLETE = re.compile(r'[^"]*(?:"[^"\\]*(?:\\.[^"\\]*)*"[^"]*)*', re.DOTALL)
+_JSON_STEP = {'{': 1, '[': 1, '}': -1, ']': -1}
+_JSON_SPACE = re.compile(r'\s*')
+_JSON_DECODER = json.JSONDecoder()
+
+
+class _ScanConstructor(yaml.constructor.SafeConstructor):
+    '''
+    Builds Python values from the few nodes we keep.
+    '''
+
+
+def _short_form_ctor(loader, tag_suffix, node):
+    '''
+    Same treatment of the short form of intrinsic functions as the full load.
+    '''
+    return tag_suffix + ' ' + str(node.value)
+
+
+_ScanConstructor.add_multi_constructor('', _short_form_ctor)
+
+
+def scan_template(template_file):
+    '''
+    A JSON template is read a chunk at a time and only the structure of the
+    top level is followed, the value of Parameters is the one thing decoded
+    (with json, which keeps YAML 1.1 scalar rules away from JSON). The walk
+    stops once Parameters and Resources have been seen. For a YAML template
+    walk the parse events, only the Parameters section is composed and every
+    other top level section is skipped event by event. Either way memory use
+    does not grow with the size of the template.
+
+    Args:
+        template_file - path to the template
+
+    Returns:
+        a tuple of the Parameters dictionary, True if there is a Resources
+        section and True if the template is YAML
+
+    Raises:
+        ValueError if the template is not a mapping or is bad JSON,
+        yaml.YAMLError if it can not be parsed
+    '''
+    with open(template_file, 'r') as f:
+        is_yaml = _first_character(f) != '{'
+        f.seek(0)
+        if not is_yaml:
+            return _scan_json(f)
+
+        events = yaml.parse(f, Loader=Loader)
+        _expect(events, 'StreamStartEvent')
+        _expect(events, 'DocumentStartEvent')
+        if not isinstance(next(events), MappingStartEvent):
+            raise ValueError('template is not a mapping')
+
+        parameters = {}
+        has_resources = False
+        while True:
+            event = next(events)
+            if isinstance(event, MappingEndEvent):
+                break
+
+            if not isinstance(event, ScalarEvent):
+                raise ValueError('unexpected top level key in template')
+
+            if event.value == 'Parameters':
+                node = _compose(events, next(events), Resolver(), {})
+                parameters = _ScanConstructor().construct_document(node) or {}
+            else:
+                has_resources = has_resources or event.value == 'Resources'
+                _skip(events, next(events))
+
+    return parameters, has_resources, is_yaml
+
+
+class _JsonReader(object):
+    '''
+    Walk a JSON document read from a file a chunk at a time. Values that are
+    not wanted are skipped by counting brackets outside of strings, a whole
+    chunk at a time while the value can not end in it.
+    '''
+
+    def __init__(self, f):
+        self._f = f
+        self._buffer = ''
+        self._position = 0
+
+    def _more(self, size=JSON_CHUNK):
+        chunk = self._f.read(size)
+        if not chunk:
+            return False
+
+        self._buffer = self._buffer[self._position:] + chunk
+        self._position = 0
+        return True
+
+    def _next_character(self):
+        while True:
+            self._position = _JSON_SPACE.match(self._buffer, self._position).end()
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+            if not self._more():
+                raise ValueError('template ends too soon')
+
+    def token(self):
+        '''
+        Returns:
+            the next string, bracket, colon or comma
+        '''
+        while True:
+            found = _JSON_TOKEN.search(self._buffer, self._position)
+            if not found:
+                self._position = len(self._buffer)
+                if not self._more():
+                    raise ValueError('template ends too soon')
+                continue
+
+            if found.group() != '"':
+                self._position = found.end()
+                return found.group()
+
+            string = _JSON_STRING.match(self._buffer, found.start())
+            if string:
+                self._position = string.end()
+                return string.group()
+
+            self._position = found.start()
+            if not self._more():
+                raise ValueError('unterminated string in template')
+
+    def value(self):
+        '''
+        Decode the value that starts here.
+        '''
+        self._next_character()
+        size = JSON_CHUNK
+        while True:
+            try:
+                value, self._position = _JSON_DECODER.raw_decode(self._buffer, self._position)
+                return value
+            except ValueError:
+                if not self._more(size):
+                    raise
+                size *= 2
+
+    def skip(self):
+        '''
+        Step over the value that starts here without decoding it.
+        '''
+        first = self._next_character()
+        if first == '"':
+            self.token()
+            return
+        if first not in '{[':
+            return
+
+        self._position += 1
+        depth = 1
+        while True:
+            # strings must not be cut in half, a JSON string has no raw line
+            # breaks so up to the last one is safe, else stop short of an
+            # unfinished string
+            cut = self._buffer.rfind('\n', self._position) + 1
+            if cut <= self._position:
+                cut = _JSON_COMPLETE.match(self._buffer, self._position).end()
+            tokens = _JSON_SKIP.findall(self._buffer, self._position, cut)
+            depths = list(accumulate(map(_JSON_STEP.get, tokens, repeat(0))))
+            if not depths or depth + min(depths) > 0:
+                depth += depths[-1] if depths else 0
+                self._position = cut
+            else:
+                done = depths.index(-depth)
+                found = next(islice(_JSON_SKIP.finditer(self._buffer, self._position, cut), done, None))
+                self._position = found.end()
+                return
+
+            if not self._more():
+                raise ValueError('template ends too soon')
+
+
+def _scan_json(f):
+    reader = _JsonReader(f)
+    if reader.token() != '{':
+        raise ValueError('template is not a mapping')
+
+    parameters = {}
+    found_parameters = False
+    has_resources = False
+    token = reader.token()
+    while token != '}':
+        if not token.startswith('"') or reader.token() != ':':
+            raise ValueError('unexpected top level key in template')
+
+        key = json.loads(token)
+        has_resources = has_resources or key == 'Resources'
+        if key == 'Parameters':
+            parameters = reader.value() or {}
+            found_parameters = True
+
+        if found_parameters and has_resources:
+            break
+
+        if key != 'Parameters':
+            reader.skip()
+
+        token = reader.token()
+        if token == ',':
+            token = reader.token()
+
+    return parameters, has_resources, False
+
+
+def _first_character(f):
+    for line in f:
+        stripped = line.strip()
+        if stripped and not stripped.startswith('#'):
+            return stripped[0]
+
+    return ''
+
+
+def _expect(events, event_name):
+    event = next(events)
+    if type(event).__name__ != event_name:
+        raise ValueError('expected {} found {}'.format(event_name, type(event).__name__))
+
+
+def _skip(events, event):
+    depth = 1 if isinstance(event, (MappingStartEvent, SequenceStartEvent)) else 0
+    while depth:
+        event = next(events)
+        if isinstance(event, (MappingStartEvent, SequenceStartEvent)):
+            depth += 1
+        elif isinstance(event, (MappingEndEvent, SequenceEndEvent)):
+            depth -= 1
+
+
+def _compose(events, event, resolver, anchors):
+    if isinstance(event, AliasEvent):
+        return anchors[event.anchor]
+
+    if isinstance(event, ScalarEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = resolver.resolve(ScalarNode, event.value, event.implicit)
+        node = ScalarNode(tag, event.value, style=event.style)
+    elif isinstance(event, SequenceStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = resolver.resolve(SequenceNode, None, event.implicit)
+        node = SequenceNode(tag, [])
+        child = next(events)
+        while not isinstance(child, SequenceEndEvent):
+            node.value.append(_compose(events, child, resolver, anchors))
+            child = next(events)
+    elif isinstance(event, MappingStartEvent):
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = resolver.resolve(MappingNode, None, event.implicit)
+        node = MappingNode(tag, [])
+        child = next(events)
+        while not isinstance(child, MappingEndEvent):
+            key = _compose(events, child, resolver, anchors)
+            value = _compose(events, next(events), resolver, anchors)
+            node.value.append((key, value))
+            child = next(events)
+    else:
+        raise ValueError('unexpected event {}'.format(event))
+
+    if event.anchor is not None:
+        anchors[event.anchor] = node
+
+    return node
@@ -0,0 +1,32 @@
+'''
+Worker threads that run in the context of whoever started them, so context
+variables (e.g. which daemon job the output belongs to) follow the work
+into the pool.
+'''
+import threading
+import contextvars
+from concurrent import futures
+
+
+class ThreadPoolExecutor(futures.ThreadPoolExecutor):
+    '''
+    A ThreadPoolExecutor whose tasks run in a copy of the context they were
+    submitted from, map() goes through submit() so it is covered too.
+    '''
+
+    def submit(self, fn, /, *args, **kwargs):
+        context = contextvars.copy_context()
+        return super().submit(context.run, fn, *args, **kwargs)
+
+
+def start_thread(target, daemon=True):
+    '''
+    Start a thread running target in a copy of the current context.
+
+    Returns:
+        the started thread
+    '''
+    context = contextvars.copy_context()
+    thread = threading.Thread(target=context.run, args=(target,), daemon=daemon)
+    thread.start()
+    return thread
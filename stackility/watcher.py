@@ -0,0 +1,162 @@
+'''
+Utility to watch many CloudFormation stacks until their work is done.
+'''
+# pylint: disable=broad-except
+# pylint: disable=invalid-name
+
+import os
+import time
+import fnmatch
+import logging
+from tabulate import tabulate
+
+from stackility.utility.aws_session import get_client
+
+logger = logging.getLogger(__name__)
+
+GOOD_STATES = [
+    'CREATE_COMPLETE',
+    'UPDATE_COMPLETE',
+    'IMPORT_COMPLETE',
+    'DELETE_COMPLETE'
+]
+
+GONE = 'DELETE_COMPLETE'
+NOT_FOUND = 'NOT_FOUND'
+
+
+def is_busy(status):
+    '''
+    Is the stack still doing something?
+
+    Args:
+        status - a StackStatus
+
+    Returns:
+        True if CloudFormation is still working on the stack
+    '''
+    return status.endswith('_IN_PROGRESS') and status != 'REVIEW_IN_PROGRESS'
+
+
+class WatchTool(object):
+    '''
+    Utility to watch many CloudFormation stacks. Every cycle is one paginated
+    describe_stacks() walk of the region, filtered locally, so the number of
+    API calls does not grow with the number of stacks being watched.
+    '''
+
+    def __init__(self, **kwargs):
+        """
+        The initializer sets up stuff to do the work
+
+        Args:
+            kwarg[Stacks]: list of stack names to watch
+            kwarg[Pattern]: shell style pattern of stack names to watch
+            kwarg[Region]: region where the stacks live
+            kwarg[Profile]: AWS profile to access resources
+
+        Raises:
+            SystemError if thing are not all good
+        """
+        try:
+            self.nap_time = int(os.environ.get('CSU_POLL_INTERVAL', 30))
+        except Exception:
+            self.nap_time = 30
+
+        self._stacks = kwargs.get('Stacks') or []
+        self._pattern = kwargs.get('Pattern')
+        if not self._stacks and not self._pattern:
+            logger.error('no stack names or pattern given, exiting')
+            raise SystemError
+
+        if not self._init_boto3_clients(kwargs.get('Profile'), kwargs.get('Region')):
+            logger.error('client initialization failed, exiting')
+            raise SystemError
+
+    def _init_boto3_clients(self, profile, region):
+        """
+        The utililty requires boto3 clients to CloudFormation.
+
+        Args:
+            None
+
+        Returns:
+            Good or Bad; True or False
+        """
+        try:
+            self._cloud_formation = get_client('cloudformation', profile, region)
+            return True
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
+
+    def _all_stacks(self):
+        """
+        One walk of describe_stacks() over the whole region.
+
+        Returns:
+            dict of stack name to status
+        """
+        states = {}
+        paginator = self._cloud_formation.get_paginator('describe_stacks')
+        for page in paginator.paginate():
+            for stack in page.get('Stacks', []):
+                states[stack['StackName']] = stack['StackStatus']
+
+        return states
+
+    def watch(self):
+        """
+        Wait for all the selected stacks to finish their work.
+
+        Args:
+            None
+
+        Returns:
+            True if every stack ended up in a good state else False
+        """
+        try:
+            states = self._all_stacks()
+            watched = {}
+            for stack_name in self._stacks:
+                if stack_name in states:
+                    watched[stack_name] = states[stack_name]
+                else:
+                    logger.warning(f'your stack is in another castle: {stack_name}')
+                    watched[stack_name] = NOT_FOUND
+
+            if self._pattern:
+                for stack_name, status in states.items():
+                    if fnmatch.fnmatchcase(stack_name, self._pattern):
+                        watched[stack_name] = status
+
+            if not watched:
+                logger.warning('no stacks matched, nothing to watch')
+                return False
+
+            logger.info('watching {} stack(s), POLL_INTERVAL={}'.format(len(watched), self.nap_time))
+            while any(is_busy(status) for status in watched.values()):
+                time.sleep(self.nap_time)
+                states = self._all_stacks()
+                for stack_name, status in watched.items():
+                    if not is_busy(status):
+                        continue
+
+                    current_status = states.get(stack_name, GONE)
+                    if current_status != status:
+                        logger.info(f'current status of {stack_name}: {current_status}')
+                    watched[stack_name] = current_status
+
+                busy = len([s for s in watched.values() if is_busy(s)])
+                logger.info(f'{busy} of {len(watched)} stack(s) still busy')
+
+            self._print_report(watched)
+            return all(status in GOOD_STATES for status in watched.values())
+        except Exception as wtf:
+            logger.error(wtf, exc_info=True)
+            return False
+
+    def _print_report(self, watched):
+        rows = [[stack_name, watched[stack_name]] for stack_name in sorted(watched)]
+        print('Watch Report:')
+        print(tabulate(rows, headers=['Stack', 'Status']))
@@ -0,0 +1,119 @@
+'''
+Jobs run through the daemon relay what they (and the threads they start)
+print and log back to the client.
+'''
+import os
+import sys
+import json
+import time
+import logging
+import contextlib
+import tempfile
+import threading
+from unittest import mock
+
+import pytest
+
+moto = pytest.importorskip('moto')
+
+from stackility import daemon  # noqa: E402
+from stackility import drift  # noqa: E402
+from stackility.utility import aws_session  # noqa: E402
+
+TEMPLATE = json.dumps({
+    'Resources': {
+        'Topic': {'Type': 'AWS::SNS::Topic'}
+    }
+})
+
+
+@contextlib.contextmanager
+def serving():
+    '''
+    A daemon serving on a throw away Unix socket and a client talking to it,
+    started from the test itself so the daemon's stand in for sys.stdout is
+    not put back by pytest's output capture.
+    '''
+    os.environ.pop(daemon.TOKEN_VARIABLE, None)
+    os.environ['CSU_POLL_INTERVAL'] = '0'
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    os.environ['AWS_DEFAULT_REGION'] = 'us-east-1'
+
+    real_stdout = sys.stdout
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    level = root.level
+    root.setLevel(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as workspace:
+        socket_path = os.path.join(workspace, 'run', 'daemon.sock')
+        the_daemon = daemon.StackilityDaemon(Address=f'unix://{socket_path}', Workers=2)
+        threading.Thread(target=the_daemon.serve, daemon=True).start()
+        for _ in range(50):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.1)
+
+        try:
+            yield daemon.DaemonClient(f'unix://{socket_path}')
+        finally:
+            sys.stdout = real_stdout
+            root.handlers[:] = handlers
+            root.setLevel(level)
+
+
+@moto.mock_aws
+def test_delete_many_relays_output():
+    aws_session.forget()
+    cloud_formation = aws_session.get_client('cloudformation', region='us-east-1')
+    for stack_name in ['relay-a', 'relay-b', 'relay-c']:
+        cloud_formation.create_stack(StackName=stack_name, TemplateBody=TEMPLATE)
+
+    with serving() as client:
+        success, output = client.run('delete', {
+            'environment': {'region': 'us-east-1'},
+            'stacks': [],
+            'pattern': 'relay-*'
+        })
+
+    assert success
+    for stack_name in ['relay-a', 'relay-b', 'relay-c']:
+        assert f'delete started for stack: {stack_name}' in output
+    assert 'Delete Report:' in output
+
+
+def test_pool_thread_output_reaches_the_job():
+    worker_threads = set()
+
+    class _Paginator(object):
+        def paginate(self, **kwargs):
+            return [{'StackResourceSummaries': [
+                {'LogicalResourceId': f'Topic{i}', 'ResourceType': 'AWS::SNS::Topic'}
+                for i in range(4)
+            ]}]
+
+    class _CloudFormation(object):
+        def get_paginator(self, name):
+            return _Paginator()
+
+        def detect_stack_resource_drift(self, StackName, LogicalResourceId):
+            worker_threads.add(threading.get_ident())
+            print(f'worker checked {LogicalResourceId}')
+            return {'StackResourceDrift': {
+                'LogicalResourceId': LogicalResourceId,
+                'ResourceType': 'AWS::SNS::Topic',
+                'StackResourceDriftStatus': 'IN_SYNC'
+            }}
+
+    with serving() as client, mock.patch.object(drift, 'get_client', lambda *args: _CloudFormation()):
+        success, output = client.run('drift', {
+            'stack': 'relay',
+            'region': 'us-east-1',
+            'types': ['AWS::SNS::*']
+        })
+
+    assert success
+    assert worker_threads
+    for i in range(4):
+        assert f'worker checked Topic{i}' in output
@@ -0,0 +1,59 @@
+'''
+A stack that refuses to be deleted does not stop the rest of the teardown.
+'''
+import os
+import json
+from unittest import mock
+
+import pytest
+from botocore.exceptions import ClientError
+
+moto = pytest.importorskip('moto')
+
+from stackility.teardown import TeardownTool  # noqa: E402
+from stackility.utility import aws_session  # noqa: E402
+
+
+TEMPLATE = json.dumps({
+    'Resources': {
+        'Topic': {'Type': 'AWS::SNS::Topic'}
+    }
+})
+
+
+@moto.mock_aws
+def test_protected_stack_is_reported_and_the_rest_deleted(capsys):
+    os.environ['CSU_POLL_INTERVAL'] = '0'
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+    aws_session.forget()
+    cloud_formation = aws_session.get_client('cloudformation', region='us-east-1')
+    for stack_name in ['tear-base', 'tear-user', 'tear-free']:
+        cloud_formation.create_stack(StackName=stack_name, TemplateBody=TEMPLATE)
+
+    tool = TeardownTool(Pattern='tear-*', Region='us-east-1')
+    delete_stack = tool._cloud_formation.delete_stack
+
+    def _protected(StackName):
+        if StackName == 'tear-user':
+            raise ClientError(
+                {'Error': {
+                    'Code': 'ValidationError',
+                    'Message': f'Stack [{StackName}] cannot be deleted while TerminationProtection is enabled'
+                }},
+                'DeleteStack'
+            )
+        return delete_stack(StackName=StackName)
+
+    # tear-user imports from tear-base, moto has no list_imports to find that
+    importers = {'tear-base': {'tear-user'}, 'tear-user': set(), 'tear-free': set()}
+    with mock.patch.object(tool, '_find_dependencies', lambda targets: importers), \
+            mock.patch.object(tool._cloud_formation, 'delete_stack', _protected):
+        assert not tool.smash()
+
+    report = capsys.readouterr().out
+    assert 'Delete Report:' in report
+    rows = {line.split()[0]: line for line in report.splitlines() if line.startswith('tear-')}
+    assert 'FAILED' in rows['tear-user'] and 'TerminationProtection' in rows['tear-user']
+    assert 'SKIPPED' in rows['tear-base']
+    assert 'DELETE_COMPLETE' in rows['tear-free']